@@ -0,0 +1,269 @@
+"""
+持久化 BM25 倒排索引（替代每次启动都重新分词、重建的 BM25Retriever）。
+
+索引目录下每一代（generation）是一组紧凑的数组文件，启动时直接 np.load(mmap_mode="r")：
+    vocab.json            词表（term id 即下标，只追加不重排，缓存的 token id 始终有效）
+    term_offsets.npy      每个 term 的倒排表在 postings_* 中的起止位置
+    postings_docs.npy     倒排表：文档下标（按 term、文档排序）
+    postings_tfs.npy      倒排表：词频
+    idf.npy / doc_lengths.npy
+    tokens.npy / token_offsets.npy   每个文档的分词结果（token id），即分词缓存
+    docs.jsonl / doc_offsets.npy     文档原文与元数据（mmap），检索时按偏移只读取命中的文档，可多线程并发检索
+    meta.json             参数、文档数、平均长度、每个文档的内容哈希（写完其它文件后最后写入）
+CURRENT 文件指向当前代；更新时写出新一代再原子替换 CURRENT，崩溃不会留下半写的索引。
+
+update() 按文档内容哈希比对：内容未变的文档复用分词缓存，只有新增/变化的文档才调用 jieba，
+倒排表由缓存的 token id 用 numpy 一次性重建（秒级以内）。
+"""
+import hashlib
+import json
+import mmap
+import os
+import shutil
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+def chunk_hash(text: str, metadata: dict = None) -> str:
+    """文档（chunk）内容哈希：文本 + 元数据，内容不变则哈希不变"""
+    h = hashlib.sha1()
+    h.update((text or "").encode("utf-8"))
+    h.update(json.dumps(metadata or {}, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    return h.hexdigest()
+
+
+def stable_node_id(text: str, metadata: dict = None) -> str:
+    """稳定的节点 ID：与 SimpleNodeParser 回退实现同样以 item_id/table_id/source 开头，后缀为内容哈希"""
+    meta = metadata or {}
+    doc_id = meta.get("item_id") or meta.get("table_id") or meta.get("source")
+    digest = chunk_hash(text, meta)[:16]
+    return f"{doc_id}_{digest}" if doc_id else digest
+
+
+class BM25Index:
+    ARRAYS = ["term_offsets", "postings_docs", "postings_tfs", "idf", "doc_lengths",
+              "tokens", "token_offsets", "doc_offsets"]
+
+    def __init__(self, index_dir: str, tokenizer: Callable[[str], List[str]], tokenizer_id: str = "",
+                 k1: float = 1.5, b: float = 0.75):
+        """
+        index_dir: 索引目录
+        tokenizer: 分词函数（如 jieba.lcut）
+        tokenizer_id: 分词配置标识（如自定义词表），变化时分词缓存失效
+        """
+        self.index_dir = index_dir
+        self.tokenizer = tokenizer
+        self.tokenizer_id = tokenizer_id
+        self.k1 = k1
+        self.b = b
+        self.meta = None
+        self._docs_file = None
+        self._docs = None
+        os.makedirs(index_dir, exist_ok=True)
+        self._load()
+
+    # ---------- 加载 ----------
+    def _current_dir(self) -> Optional[str]:
+        current = os.path.join(self.index_dir, "CURRENT")
+        if not os.path.exists(current):
+            return None
+        with open(current, encoding="utf-8") as f:
+            gen_dir = os.path.join(self.index_dir, f.read().strip())
+        return gen_dir if os.path.exists(os.path.join(gen_dir, "meta.json")) else None
+
+    def _load(self):
+        gen_dir = self._current_dir()
+        self._release()
+        if gen_dir is None:
+            self.meta = None
+            return
+        with open(os.path.join(gen_dir, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        with open(os.path.join(gen_dir, "vocab.json"), encoding="utf-8") as f:
+            self.terms = json.load(f)
+        self.vocab = {term: i for i, term in enumerate(self.terms)}
+        for name in self.ARRAYS:
+            setattr(self, name, np.load(os.path.join(gen_dir, f"{name}.npy"), mmap_mode="r"))
+        # 按偏移切片读取，不共享文件指针（seek + read 在多线程检索时会读错位置）
+        self._docs_file = open(os.path.join(gen_dir, "docs.jsonl"), "rb")
+        if os.fstat(self._docs_file.fileno()).st_size:
+            self._docs = mmap.mmap(self._docs_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.gen_dir = gen_dir
+
+    @property
+    def num_docs(self) -> int:
+        return self.meta["num_docs"] if self.meta else 0
+
+    def is_current(self, keys: List[str]) -> bool:
+        return (
+            self.meta is not None
+            and self.meta["chunks"] == keys
+            and self.meta["tokenizer_id"] == self.tokenizer_id
+            and self.meta["k1"] == self.k1
+            and self.meta["b"] == self.b
+        )
+
+    def _release(self):
+        """释放当前一代的 mmap 与文件句柄"""
+        if self._docs is not None:
+            self._docs.close()
+            self._docs = None
+        if self._docs_file is not None:
+            self._docs_file.close()
+            self._docs_file = None
+        for name in self.ARRAYS:
+            self.__dict__.pop(name, None)
+
+    # ---------- 增量更新 ----------
+    def update(self, documents: list) -> Dict[str, int]:
+        """
+        使索引与 documents 一致（顺序即文档下标）。
+        返回统计：reused（复用分词缓存）、tokenized（重新分词）、removed（删除）。
+        """
+        texts = [getattr(d, "text", "") or "" for d in documents]
+        metas = [getattr(d, "metadata", {}) or {} for d in documents]
+        keys = [chunk_hash(t, m) for t, m in zip(texts, metas)]
+        if self.is_current(keys):
+            return {"reused": len(keys), "tokenized": 0, "removed": 0}
+
+        # 旧索引中的分词缓存（词表只追加，token id 保持有效）
+        cached, terms = {}, []
+        if self.meta is not None and self.meta["tokenizer_id"] == self.tokenizer_id:
+            terms = list(self.terms)
+            for i, key in enumerate(self.meta["chunks"]):
+                cached.setdefault(key, i)
+        vocab = {term: i for i, term in enumerate(terms)}
+
+        doc_tokens, tokenized = [], 0
+        for text, key in zip(texts, keys):
+            if key in cached:
+                i = cached[key]
+                doc_tokens.append(np.asarray(self.tokens[self.token_offsets[i]:self.token_offsets[i + 1]]))
+                continue
+            ids = []
+            for token in self.tokenizer(text):
+                token = token.strip()
+                if not token:
+                    continue
+                if token not in vocab:
+                    vocab[token] = len(terms)
+                    terms.append(token)
+                ids.append(vocab[token])
+            doc_tokens.append(np.asarray(ids, dtype=np.int32))
+            tokenized += 1
+        removed = len(set(self.meta["chunks"]) - set(keys)) if self.meta is not None else 0
+
+        self._write(texts, metas, keys, terms, doc_tokens)
+        self._load()
+        return {"reused": len(keys) - tokenized, "tokenized": tokenized, "removed": removed}
+
+    def _write(self, texts, metas, keys, terms, doc_tokens):
+        num_docs, num_terms = len(keys), len(terms)
+        lengths = np.array([len(t) for t in doc_tokens], dtype=np.int64)
+        token_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        tokens = np.concatenate(doc_tokens).astype(np.int32) if doc_tokens else np.zeros(0, dtype=np.int32)
+
+        # 倒排表：按 (term, doc) 排序去重计数
+        doc_ids = np.repeat(np.arange(num_docs, dtype=np.int64), lengths)
+        pairs, tfs = np.unique(tokens.astype(np.int64) * max(num_docs, 1) + doc_ids, return_counts=True)
+        postings_terms = pairs // max(num_docs, 1)
+        postings_docs = (pairs % max(num_docs, 1)).astype(np.int32)
+        df = np.bincount(postings_terms, minlength=num_terms)
+        term_offsets = np.concatenate([[0], np.cumsum(df)]).astype(np.int64)
+        # Lucene BM25 idf
+        idf = np.log(1 + (num_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+        generation = (self.meta["generation"] + 1) if self.meta else 0
+        gen_name = f"gen-{generation:06d}"
+        gen_dir = os.path.join(self.index_dir, gen_name)
+        shutil.rmtree(gen_dir, ignore_errors=True)
+        os.makedirs(gen_dir)
+
+        doc_offsets = [0]
+        with open(os.path.join(gen_dir, "docs.jsonl"), "wb") as f:
+            for text, meta in zip(texts, metas):
+                line = json.dumps({"node_id": stable_node_id(text, meta), "text": text, "metadata": meta},
+                                  ensure_ascii=False).encode("utf-8") + b"\n"
+                f.write(line)
+                doc_offsets.append(doc_offsets[-1] + len(line))
+
+        arrays = {
+            "term_offsets": term_offsets,
+            "postings_docs": postings_docs,
+            "postings_tfs": tfs.astype(np.float32),
+            "idf": idf,
+            "doc_lengths": lengths.astype(np.float32),
+            "tokens": tokens,
+            "token_offsets": token_offsets,
+            "doc_offsets": np.array(doc_offsets, dtype=np.int64),
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(gen_dir, f"{name}.npy"), array)
+        with open(os.path.join(gen_dir, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(terms, f, ensure_ascii=False)
+        meta = {
+            "generation": generation,
+            "num_docs": num_docs,
+            "avgdl": float(lengths.mean()) if num_docs else 0.0,
+            "k1": self.k1,
+            "b": self.b,
+            "tokenizer_id": self.tokenizer_id,
+            "chunks": keys,
+        }
+        with open(os.path.join(gen_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+        # 原子切换到新一代，再清理旧代（Windows 上仍被映射的文件删不掉，留待下次清理）
+        tmp = os.path.join(self.index_dir, "CURRENT.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(gen_name)
+        os.replace(tmp, os.path.join(self.index_dir, "CURRENT"))
+        self._release()
+        for name in os.listdir(self.index_dir):
+            if name.startswith("gen-") and name != gen_name:
+                shutil.rmtree(os.path.join(self.index_dir, name), ignore_errors=True)
+
+    # ---------- 检索 ----------
+    def scores(self, query: str) -> np.ndarray:
+        """所有文档的 BM25 分数"""
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        if not self.num_docs:
+            return scores
+        avgdl = max(self.meta["avgdl"], 1e-9)
+        norm = self.k1 * (1 - self.b + self.b * np.asarray(self.doc_lengths) / avgdl)
+        for token in self.tokenizer(query):
+            term = self.vocab.get(token.strip())
+            if term is None:
+                continue
+            start, end = self.term_offsets[term], self.term_offsets[term + 1]
+            docs = self.postings_docs[start:end]
+            tfs = self.postings_tfs[start:end]
+            scores[docs] += self.idf[term] * tfs * (self.k1 + 1) / (tfs + norm[docs])
+        return scores
+
+    def document(self, i: int) -> dict:
+        return json.loads(self._docs[int(self.doc_offsets[i]):int(self.doc_offsets[i + 1])])
+
+    def search(self, query: str, top_k: int = 5,
+               accept: Optional[Callable[[dict], bool]] = None) -> List[Tuple[dict, float]]:
+        """
+        返回 [(文档, 分数)]，按分数降序，只包含分数 > 0 的文档。
+        accept: 可选的文档过滤函数（如元数据过滤），在排序后的候选上逐个判断。
+        """
+        scores = self.scores(query)
+        candidates = np.flatnonzero(scores > 0)
+        if accept is None and len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        results = []
+        for i in candidates:
+            doc = self.document(int(i))
+            if accept is None or accept(doc):
+                results.append((doc, float(scores[i])))
+                if len(results) >= top_k:
+                    break
+        return results
+
+    def close(self):
+        self._release()
@@ -19,6 +19,7 @@ LLAMA_CLOUD_API_KEY = os.getenv("LLAMA_CLOUD_API_KEY")
 # print(f"config: LLAMA_CLOUD_API_KEY: {LLAMA_CLOUD_API_KEY}")
 
 TOP_N = int(os.getenv("TOP_N", 5))  # Default to 5 if not set
+RERANK_BUDGET = int(os.getenv("RERANK_BUDGET", 30))  # 融合后最多送入 rerank 的候选数
 
 QQ_EMAIL = os.getenv("QQ_EMAIL")
 QQ_APP_PASSWORD = os.getenv("QQ_APP_PASSWORD")
@@ -0,0 +1,184 @@
+"""
+Chroma 向量库的并发、批量 embedding 导入（替代 batch_size=1 + 每 10 个 insert_nodes 的串行构建）。
+
+- 多线程并发调用 embedding 接口，每次请求一批文本；批大小从服务上限（text-embedding-v3 为 10）开始，
+  某批失败时对半拆分后只重试这批，并调低后续批大小，连续成功后再逐步调回上限。
+- 计算好的向量按 upsert_batch_size 批量 upsert 进 Chroma（节点 ID 为内容哈希，重复 upsert 无副作用）。
+- 断点续传：构建期间 collection 元数据为 {"ingestion": "building"}，全部写入后才标记为 "complete"；
+  中途崩溃后再次启动只 embedding collection 中还没有的节点，不会把半成品当成完整索引加载。
+"""
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List
+
+try:
+    from llama_index.core.schema import MetadataMode
+    from llama_index.core.vector_stores.utils import node_to_metadata_dict
+except Exception:
+    from llama_index.schema import MetadataMode
+    from llama_index.vector_stores.utils import node_to_metadata_dict
+
+INGESTION_KEY = "ingestion"
+BUILDING, COMPLETE = "building", "complete"
+
+
+def ingestion_status(collection) -> str:
+    """collection 的导入状态：building / complete；旧版本建好的 collection 没有标记，返回 None"""
+    return (collection.metadata or {}).get(INGESTION_KEY)
+
+
+def set_ingestion_status(collection, status: str, **extra):
+    # hnsw 参数创建后不可修改，modify 时不能带上
+    metadata = {k: v for k, v in (collection.metadata or {}).items() if not k.startswith("hnsw:")}
+    metadata.update({INGESTION_KEY: status, **extra})
+    collection.modify(metadata=metadata)
+
+
+def existing_ids(collection, ids: List[str], chunk_size: int = 1000) -> set:
+    """ids 中已写入 collection 的部分"""
+    found = set()
+    for i in range(0, len(ids), chunk_size):
+        found.update(collection.get(ids=ids[i:i + chunk_size], include=[])["ids"])
+    return found
+
+
+def all_ids(collection, page_size: int = 10000) -> set:
+    """collection 中的全部节点 ID"""
+    ids, offset = set(), 0
+    while True:
+        page = collection.get(include=[], limit=page_size, offset=offset)["ids"]
+        ids.update(page)
+        if len(page) < page_size:
+            return ids
+        offset += page_size
+
+
+class EmbeddingIngestor:
+    def __init__(self, embed_model, collection, max_batch_size: int = 10, max_workers: int = 8,
+                 max_retries: int = 8, upsert_batch_size: int = 500, backoff: float = 1.0):
+        """
+        embed_model: llama-index embedding（get_text_embedding_batch），其自身 batch_size 应不小于 max_batch_size
+        collection: chromadb collection
+        max_batch_size: 单次请求的文本数上限（服务商限制）
+        max_workers: 并发请求数
+        max_retries: 单个节点的最多重试次数
+        """
+        self.embed_model = embed_model
+        self.collection = collection
+        self.max_batch_size = max_batch_size
+        self.batch_size = max_batch_size
+        self.ceiling = max_batch_size
+        self.largest_ok = 0
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.upsert_batch_size = upsert_batch_size
+        self.backoff = backoff
+        self._successes = 0
+
+    def _embed(self, texts: List[str], attempt: int) -> List[list]:
+        if attempt:
+            time.sleep(min(self.backoff * 2 ** (attempt - 1), 30))
+        embeddings = self.embed_model.get_text_embedding_batch(texts)
+        # DashScopeEmbedding 请求失败时不抛异常，而是返回 None
+        if len(embeddings) != len(texts) or any(e is None for e in embeddings):
+            raise RuntimeError(f"embedding request failed for a batch of {len(texts)}")
+        return embeddings
+
+    def _on_success(self, batch: list):
+        # 连续成功后逐步调回（不超过已知会失败的大小）
+        self.largest_ok = max(self.largest_ok, len(batch))
+        self._successes += 1
+        if self.batch_size < self.ceiling and self._successes >= 2 * self.max_workers:
+            self.batch_size = min(self.ceiling, self.batch_size * 2)
+            self._successes = 0
+
+    def _on_failure(self, batch: list, attempt: int) -> list:
+        """
+        失败的批次先原样重试（限流等偶发错误）；比成功过的批次都大、且再次失败时视为超出服务限制，
+        对半拆分并调低批大小上限。拆分后的批次沿用尝试次数，服务一直不可用时节点最多尝试 max_retries 次。
+        返回要重新排队的 (批次, 尝试次数)，用完重试次数时返回空列表。
+        """
+        self._successes = 0
+        if attempt >= self.max_retries:
+            return []
+        if attempt == 0 or len(batch) <= max(self.largest_ok, 1):
+            return [(batch, attempt + 1)]
+        self.ceiling = max(1, min(self.ceiling, len(batch) - 1))
+        self.batch_size = max(1, min(self.batch_size, len(batch) // 2))
+        half = len(batch) // 2
+        return [(batch[:half], attempt + 1), (batch[half:], attempt + 1)]
+
+    def _upsert(self, nodes: list, embeddings: List[list]):
+        self.collection.upsert(
+            ids=[node.node_id for node in nodes],
+            embeddings=embeddings,
+            documents=[node.get_content(metadata_mode=MetadataMode.NONE) for node in nodes],
+            metadatas=[node_to_metadata_dict(node, remove_text=True, flat_metadata=True) for node in nodes],
+        )
+
+    def ingest(self, nodes: list, delete_ids: List[str] = ()) -> Dict[str, int]:
+        """
+        把 nodes 中 collection 还没有的节点 embedding 后写入，再删除 delete_ids，完成后标记 collection 为 complete。
+        有节点重试 max_retries 次仍失败时抛出 RuntimeError，collection 保持 building 状态，下次启动续传。
+        """
+        # 内容相同的节点 ID 相同，同一次 upsert 中不能重复
+        nodes = list({node.node_id: node for node in nodes}.values())
+        if ingestion_status(self.collection) != BUILDING:
+            set_ingestion_status(self.collection, BUILDING)
+        done = existing_ids(self.collection, [node.node_id for node in nodes])
+        pending = [node for node in nodes if node.node_id not in done]
+        print(f"🧮 Embedding {len(pending)} nodes ({len(done)} already in the collection)...")
+
+        # 批次按当前批大小现取现分；retries 为失败待重试的批次，优先发送
+        remaining, retries = list(reversed(pending)), []
+        buffer_nodes, buffer_embeddings, failed, num_requests, written = [], [], [], 0, 0
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = {}
+            while remaining or retries or running:
+                while (remaining or retries) and len(running) < self.max_workers:
+                    if retries:
+                        batch, attempt = retries.pop(0)
+                    else:
+                        batch = [remaining.pop() for _ in range(min(self.batch_size, len(remaining)))]
+                        attempt = 0
+                    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch]
+                    running[executor.submit(self._embed, texts, attempt)] = (batch, attempt)
+                    num_requests += 1
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    batch, attempt = running.pop(future)
+                    try:
+                        embeddings = future.result()
+                    except Exception as e:
+                        # 只重试失败的这批
+                        requeue = self._on_failure(batch, attempt)
+                        if not requeue:
+                            print(f"❌ Embedding failed for {batch[0].node_id}: {e}")
+                            failed.extend(batch)
+                        retries.extend(requeue)
+                        continue
+                    self._on_success(batch)
+                    buffer_nodes.extend(batch)
+                    buffer_embeddings.extend(embeddings)
+                    if len(buffer_nodes) >= self.upsert_batch_size:
+                        self._upsert(buffer_nodes, buffer_embeddings)
+                        written += len(buffer_nodes)
+                        buffer_nodes, buffer_embeddings = [], []
+                        print(f"   ... {len(done) + written}/{len(nodes)} nodes, {time.time() - start:.1f}s")
+        if buffer_nodes:
+            self._upsert(buffer_nodes, buffer_embeddings)
+
+        stats = {"nodes": len(nodes), "embedded": len(pending) - len(failed), "skipped": len(done),
+                 "failed": len(failed), "requests": num_requests, "deleted": 0}
+        if failed:
+            raise RuntimeError(f"{len(failed)} nodes failed to embed, run again to resume: {stats}")
+        # 先写入后删除：变化的 chunk 在任何时刻都至少有一个版本可检索
+        delete_ids = list(delete_ids)
+        for i in range(0, len(delete_ids), self.upsert_batch_size):
+            self.collection.delete(ids=delete_ids[i:i + self.upsert_batch_size])
+        stats["deleted"] = len(delete_ids)
+        set_ingestion_status(self.collection, COMPLETE, num_nodes=self.collection.count())
+        print(f"✅ Ingestion complete in {time.time() - start:.1f}s: {stats}")
+        return stats
+
@@ -2,8 +2,9 @@ import os
 from process_report import process_mds_to_json, load_items_from_json  # 修改为mds
 from retrievers import get_bm25_retriever, get_vector_retriever
 from query_engine import build_query_engine
+from manifest import IndexManifest
+from query_cache import QueryCache
 from pathlib import Path
-import pickle
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
@@ -22,7 +23,8 @@ except Exception:
     OfficalDocument = None
 
 CHROMA_PATH = "E:\\model\\RAG\\chroma_db"
-NODES_CACHE = "E:\\model\\RAG\\nodes.pkl"
+MANIFEST_PATH = "E:\\model\\RAG\\index_manifest.json"
+QUERY_CACHE_PATH = "E:\\model\\RAG\\query_cache.sqlite"
 
 def _convert_documents(docs):
     """
@@ -51,34 +53,39 @@ def main():
     print(f" -> {len(json_paths)} json files ready in {JSON_DIR}")
 
     # 2) 从 json 加载 items（每个 text chunk 与每个 table 都变成一个 Document）
-    has_nodes = os.path.exists(NODES_CACHE)
-    if has_nodes:
-        print("🔍 Loading documents cache from nodes.pkl...")
-        with open(NODES_CACHE, "rb") as f:
-            documents = pickle.load(f)
-    else:
-        print("2. Loading items from JSON into Documents...")
-        documents = load_items_from_json(JSON_DIR)
-        with open(NODES_CACHE, "wb") as f:
-            pickle.dump(documents, f)
-        print(f"✅ Cached documents to {NODES_CACHE} (total {len(documents)})")
+    print("2. Loading items from JSON into Documents...")
+    documents = load_items_from_json(JSON_DIR)
+
+    # 与索引清单比对：只对新增的 chunk 做 embedding / 分词，删除已移除的 chunk
+    manifest = IndexManifest(MANIFEST_PATH)
+    changes = manifest.diff(documents)
+    print(f" -> {len(documents)} chunks, changes since last start: {changes.summary()}")
 
     # 转换为官方 Document（如果可用）
     documents = _convert_documents(documents)
 
     print("3. Building retrievers...")
-    # 向量检索器：自动处理 Chroma 持久化（在 retrievers.py 中实现）
-    vector_retriever = get_vector_retriever(documents=documents, top_k=25)
+    # 向量检索器：自动处理 Chroma 持久化与增量更新（在 retrievers.py 中实现）
+    vector_retriever = get_vector_retriever(
+        documents=documents, top_k=25, changes=changes if manifest.exists() else None
+    )
 
-    # BM25 检索器：用 documents（每个 item 一个 Document）
+    # BM25 检索器：持久化索引，按内容哈希增量更新
     bm25_retriever = get_bm25_retriever(documents=documents, top_k=30)
 
+    # 两个索引都更新完后再保存清单
+    if changes.changed or not manifest.exists():
+        manifest.save(documents)
+
+    # 查询缓存：索引清单变化时自动清空检索结果缓存
+    query_cache = QueryCache(QUERY_CACHE_PATH, fingerprint=manifest.fingerprint)
+
     print("✅ RAG system ready!")
     while True:
         query = input("\nYour question (or 'quit'): ").strip()
         if query.lower() == 'quit':
             break
-        query_engine = build_query_engine(bm25_retriever, vector_retriever, query)
+        query_engine = build_query_engine(bm25_retriever, vector_retriever, query, cache=query_cache)
         response = query_engine.query(query)
         print("\nAnswer:", response.response)
         print("\nSources:")
@@ -0,0 +1,100 @@
+"""
+索引清单（manifest）：记录每个源文件（metadata["source"]）包含的 chunk 内容哈希（即稳定节点 ID）。
+
+启动时用 load_items_from_json 的结果与清单比对，只对新增的 chunk 做 embedding / 分词并写入索引，
+删除已不存在的 chunk；新增一份年报只需几秒，而不是整库重建。两个索引（Chroma、BM25）都更新完后
+才保存清单，中途崩溃时下次启动会重新得到同样的差异（写入与删除都是幂等的）。
+"""
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from bm25_index import stable_node_id
+
+
+def document_ids(documents: list) -> Dict[str, List[str]]:
+    """{source: [节点 ID]}，节点 ID 含内容哈希"""
+    sources: Dict[str, List[str]] = {}
+    for d in documents:
+        meta = getattr(d, "metadata", {}) or {}
+        sources.setdefault(meta.get("source", "unknown"), []).append(stable_node_id(getattr(d, "text", ""), meta))
+    return sources
+
+
+@dataclass
+class ManifestDiff:
+    added: list = field(default_factory=list)          # 需要写入的 Document
+    removed: List[str] = field(default_factory=list)   # 需要删除的节点 ID
+    sources_added: List[str] = field(default_factory=list)
+    sources_changed: List[str] = field(default_factory=list)
+    sources_removed: List[str] = field(default_factory=list)
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.added or self.removed)
+
+    def summary(self) -> str:
+        return (f"+{len(self.added)} / -{len(self.removed)} chunks; sources added {len(self.sources_added)}, "
+                f"changed {len(self.sources_changed)}, removed {len(self.sources_removed)}")
+
+
+def diff_ids(documents: list, known_ids: set) -> ManifestDiff:
+    """documents 相对已索引节点 ID 的差异（不含源文件统计）"""
+    diff, current = ManifestDiff(), set()
+    for d in documents:
+        node_id = stable_node_id(getattr(d, "text", ""), getattr(d, "metadata", {}) or {})
+        if node_id not in known_ids and node_id not in current:
+            diff.added.append(d)
+        current.add(node_id)
+    diff.removed = sorted(set(known_ids) - current)
+    return diff
+
+
+class IndexManifest:
+    def __init__(self, path: str):
+        self.path = path
+        self.sources: Dict[str, List[str]] = {}
+        self.fingerprint = None
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.sources = data.get("sources", {})
+            self.fingerprint = data.get("fingerprint")
+
+    def exists(self) -> bool:
+        return self.fingerprint is not None
+
+    def ids(self) -> set:
+        return {node_id for ids in self.sources.values() for node_id in ids}
+
+    def diff(self, documents: list) -> ManifestDiff:
+        diff = diff_ids(documents, self.ids())
+        current = document_ids(documents)
+        diff.sources_added = sorted(s for s in current if s not in self.sources)
+        diff.sources_changed = sorted(
+            s for s in current if s in self.sources and set(current[s]) != set(self.sources[s])
+        )
+        diff.sources_removed = sorted(s for s in self.sources if s not in current)
+        return diff
+
+    @staticmethod
+    def compute_fingerprint(sources: Dict[str, List[str]]) -> str:
+        h = hashlib.sha1()
+        for source in sorted(sources):
+            h.update(source.encode("utf-8"))
+            for node_id in sorted(sources[source]):
+                h.update(node_id.encode("utf-8"))
+        return h.hexdigest()
+
+    def save(self, documents: list):
+        """索引更新完成后保存清单（原子写入）"""
+        self.sources = document_ids(documents)
+        self.fingerprint = self.compute_fingerprint(self.sources)
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"fingerprint": self.fingerprint, "sources": self.sources}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
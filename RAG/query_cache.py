@@ -0,0 +1,154 @@
+"""
+交互式问答的两级缓存（持久化到 SQLite，跨会话有效）：
+
+L1: 问题文本 -> query embedding（内存 LRU + 磁盘），与索引内容无关，只按 embedding 模型区分；
+L2: 规范化问题 + 元数据过滤条件 + 检索配置 -> rerank 后的节点 ID 与分数。节点 ID 是内容哈希，
+    节点内容按 ID 单独存储，命中时无需再做向量检索、BM25 检索和 rerank。
+
+L2 绑定索引清单的 fingerprint（manifest.IndexManifest），清单变化（新增/删除 chunk）时自动清空。
+"""
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+
+def normalize_query(query: str) -> str:
+    """全角转半角、小写、合并空白、去掉末尾标点，使近似相同的问题命中同一条缓存"""
+    query = unicodedata.normalize("NFKC", query or "").lower()
+    query = re.sub(r"\s+", " ", query).strip()
+    return re.sub(r"[\s?？!！.。,，;；~]+$", "", query)
+
+
+class QueryCache:
+    def __init__(self, path: str, fingerprint: Optional[str] = None, max_embeddings: int = 1024,
+                 max_results: int = 10000):
+        """
+        path: SQLite 文件
+        fingerprint: 当前索引清单的 fingerprint，与缓存中记录的不同时清空 L2
+        max_embeddings: L1 容量（内存与磁盘）
+        max_results: L2 容量
+        """
+        self.path = path
+        self.max_embeddings = max_embeddings
+        self.max_results = max_results
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"embedding_hits": 0, "embedding_misses": 0, "result_hits": 0, "result_misses": 0}
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS nodes (id TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        if fingerprint is not None:
+            self.invalidate_if_changed(fingerprint)
+
+    def invalidate_if_changed(self, fingerprint: str) -> bool:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        if row is not None and row[0] == fingerprint:
+            return False
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM results")
+            self._conn.execute("DELETE FROM nodes")
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+            self._conn.execute("COMMIT")
+        if row is not None:
+            print("♻️ Index changed, query result cache cleared")
+        return True
+
+    # ---------- L1: query embedding ----------
+    def get_embedding(self, query: str, model: str = "") -> Optional[List[float]]:
+        key = f"{model}\n{query}"
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.stats["embedding_hits"] += 1
+                return self._memory[key]
+            row = self._conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["embedding_misses"] += 1
+                return None
+            embedding = np.frombuffer(row[0], dtype=np.float32).tolist()
+            self._conn.execute("UPDATE embeddings SET used = ? WHERE key = ?", (time.time(), key))
+            self._remember(key, embedding)
+            self.stats["embedding_hits"] += 1
+            return embedding
+
+    def put_embedding(self, query: str, embedding: List[float], model: str = ""):
+        key = f"{model}\n{query}"
+        with self._lock:
+            self._remember(key, embedding)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                (key, np.asarray(embedding, dtype=np.float32).tobytes(), time.time()),
+            )
+            self._prune("embeddings", self.max_embeddings)
+
+    def _remember(self, key: str, embedding: List[float]):
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_embeddings:
+            self._memory.popitem(last=False)
+
+    # ---------- L2: reranked node IDs ----------
+    @staticmethod
+    def result_key(query: str, filters: Optional[dict] = None, config: Optional[dict] = None) -> str:
+        return json.dumps([normalize_query(query), filters or {}, config or {}], sort_keys=True, ensure_ascii=False)
+
+    def get_results(self, key: str) -> Optional[List[dict]]:
+        """命中时返回 [{"id", "text", "metadata", "score"}]（按 rerank 顺序），否则 None"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["result_misses"] += 1
+                return None
+            ranked = json.loads(row[0])
+            ids = [node_id for node_id, _ in ranked]
+            placeholders = ",".join("?" * len(ids))
+            nodes = dict(self._conn.execute(f"SELECT id, value FROM nodes WHERE id IN ({placeholders})", ids)) if ids else {}
+            if len(nodes) < len(set(ids)):
+                self.stats["result_misses"] += 1
+                return None
+            self._conn.execute("UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+            self.stats["result_hits"] += 1
+        return [{**json.loads(nodes[node_id]), "id": node_id, "score": score} for node_id, score in ranked]
+
+    def put_results(self, key: str, results: List[dict]):
+        """results: [{"id", "text", "metadata", "score"}]"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO nodes VALUES (?, ?)",
+                [(r["id"], json.dumps({"text": r["text"], "metadata": r["metadata"]}, ensure_ascii=False))
+                 for r in results],
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                (key, json.dumps([[r["id"], r["score"]] for r in results]), time.time()),
+            )
+            self._conn.execute("COMMIT")
+            self._prune("results", self.max_results)
+
+    def _prune(self, table: str, capacity: int):
+        count = self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        if count > capacity:
+            # 超出容量时淘汰最久未用的 10%
+            self._conn.execute(
+                f"DELETE FROM {table} WHERE key IN (SELECT key FROM {table} ORDER BY used LIMIT ?)",
+                (count - capacity + capacity // 10,),
+            )
+
+    def close(self):
+        self._conn.close()
@@ -1,38 +1,146 @@
 from llama_index.core.query_engine import RetrieverQueryEngine
 from llama_index.core import get_response_synthesizer
 from llama_index.core.retrievers import BaseRetriever  
-from llama_index.core.schema import NodeWithScore
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
 from llama_index.postprocessor.dashscope_rerank import DashScopeRerank
 from llama_index.llms.dashscope import DashScope
-from config import LLM_MODEL, RERANK_MODEL, DASHSCOPE_API_KEY
+from config import LLM_MODEL, RERANK_MODEL, DASHSCOPE_API_KEY, RERANK_BUDGET
 from retrievers import filter_nodes_by_metadata
+from query_cache import QueryCache
 from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
 from llama_index.core.prompts import PromptTemplate
+import asyncio
+
+
+def reciprocal_rank_fusion(result_lists: List[List[NodeWithScore]], k: int = 60) -> List[NodeWithScore]:
+    """
+    倒数排名融合（RRF）：score = sum(1 / (k + rank))，只看各路结果的名次，
+    不需要把向量相似度与 BM25 分数校准到同一尺度；两路都靠前的节点排在最前。
+    """
+    scores, nodes = {}, {}
+    for results in result_lists:
+        for rank, n in enumerate(results, 1):
+            node_id = n.node.node_id
+            scores[node_id] = scores.get(node_id, 0.0) + 1.0 / (k + rank)
+            nodes.setdefault(node_id, n.node)
+    ranked = sorted(scores, key=lambda node_id: -scores[node_id])
+    return [NodeWithScore(node=nodes[node_id], score=scores[node_id]) for node_id in ranked]
+
 
 class HybridRetriever(BaseRetriever):
-    def __init__(self, bm25_retriever, vector_retriever, metadata_filters: Optional[dict] = None):
+    def __init__(self, bm25_retriever, vector_retriever, metadata_filters: Optional[dict] = None,
+                 reranker=None, cache: Optional[QueryCache] = None, rerank_budget: int = RERANK_BUDGET,
+                 rrf_k: int = 60):
+        """
+        reranker: 可选，对合并后的候选做 rerank（在检索器内完成，结果可被缓存）
+        cache: 可选的 QueryCache：复用 query embedding，并缓存 rerank 后的结果
+        rerank_budget: RRF 融合后最多送入 rerank 的候选数（rerank 按候选数计费、耗时）
+        rrf_k: RRF 平滑常数
+        """
         self.bm25 = bm25_retriever
         self.vector = vector_retriever
         self.metadata_filters = metadata_filters or {}
+        self.reranker = reranker
+        self.cache = cache
+        self.rerank_budget = rerank_budget
+        self.rrf_k = rrf_k
         super().__init__()
 
-    def _retrieve(self, query: str) -> List[NodeWithScore]:
-        # 1. 向量检索（支持 filters）
-        vector_nodes = self.vector.retrieve(query)
-        
-        # 2. BM25 检索 + 手动过滤
-        bm25_nodes = self.bm25.retrieve(query)
+    def _config(self) -> dict:
+        """影响检索结果的配置，作为结果缓存键的一部分"""
+        return {
+            "vector_top_k": getattr(self.vector, "_similarity_top_k", None),
+            "bm25_top_k": getattr(self.bm25, "similarity_top_k", None),
+            "rerank_model": getattr(self.reranker, "model", None),
+            "rerank_top_n": getattr(self.reranker, "top_n", None),
+            "rerank_budget": self.rerank_budget,
+            "fusion": f"rrf:{self.rrf_k}",
+        }
+
+    def _with_embedding(self, query_bundle: QueryBundle) -> QueryBundle:
+        embed_model = getattr(self.vector, "_embed_model", None)
+        if self.cache is not None and embed_model is not None and query_bundle.embedding is None:
+            model = getattr(embed_model, "model_name", "")
+            embedding = self.cache.get_embedding(query_bundle.query_str, model)
+            if embedding is None:
+                embedding = embed_model.get_query_embedding(query_bundle.query_str)
+                self.cache.put_embedding(query_bundle.query_str, embedding, model)
+            # 向量检索器发现 embedding 已存在时不再请求 embedding 接口
+            query_bundle.embedding = embedding
+        return query_bundle
+
+    async def _awith_embedding(self, query_bundle: QueryBundle) -> QueryBundle:
+        embed_model = getattr(self.vector, "_embed_model", None)
+        if self.cache is not None and embed_model is not None and query_bundle.embedding is None:
+            model = getattr(embed_model, "model_name", "")
+            embedding = self.cache.get_embedding(query_bundle.query_str, model)
+            if embedding is None:
+                embedding = await embed_model.aget_query_embedding(query_bundle.query_str)
+                self.cache.put_embedding(query_bundle.query_str, embedding, model)
+            query_bundle.embedding = embedding
+        return query_bundle
+
+    def _fuse(self, vector_nodes: List[NodeWithScore], bm25_nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        """BM25 结果按元数据过滤后与向量结果做 RRF 融合，截取前 rerank_budget 个候选"""
         bm25_nodes = filter_nodes_by_metadata(bm25_nodes, self.metadata_filters)
-        
-        # 3. 合并去重
-        seen_ids = set()
-        combined = []
-        for n in vector_nodes + bm25_nodes:
-            if n.node.node_id not in seen_ids:
-                # 可选：优先保留含表格的 chunk
-                combined.append(n)
-                seen_ids.add(n.node.node_id)
-        return combined
+        fused = reciprocal_rank_fusion([vector_nodes, bm25_nodes], k=self.rrf_k)
+        return fused[:self.rerank_budget] if self.rerank_budget else fused
+
+    def _cached(self, query_bundle: QueryBundle):
+        """返回 (缓存键, 命中的结果或 None)"""
+        if self.cache is None:
+            return None, None
+        key = QueryCache.result_key(query_bundle.query_str, self.metadata_filters, self._config())
+        cached = self.cache.get_results(key)
+        if cached is None:
+            return key, None
+        return key, [
+            NodeWithScore(node=TextNode(text=r["text"], metadata=r["metadata"], id_=r["id"]), score=r["score"])
+            for r in cached
+        ]
+
+    def _store(self, key, nodes: List[NodeWithScore]):
+        if key is not None:
+            self.cache.put_results(key, [
+                {"id": n.node.node_id, "text": n.node.get_content(), "metadata": n.node.metadata, "score": n.score}
+                for n in nodes
+            ])
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        key, cached = self._cached(query_bundle)
+        if cached is not None:
+            return cached
+
+        query_bundle = self._with_embedding(query_bundle)
+        # 向量检索与 BM25 检索并行
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            vector_future = executor.submit(self.vector.retrieve, query_bundle)
+            bm25_future = executor.submit(self.bm25.retrieve, query_bundle)
+            nodes = self._fuse(vector_future.result(), bm25_future.result())
+        if self.reranker is not None:
+            nodes = self.reranker.postprocess_nodes(nodes, query_bundle=query_bundle)
+
+        self._store(key, nodes)
+        return nodes
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        key, cached = self._cached(query_bundle)
+        if cached is not None:
+            return cached
+
+        query_bundle = await self._awith_embedding(query_bundle)
+        # 向量检索（异步）与 BM25 检索（本地 CPU，放到线程里）并发
+        vector_nodes, bm25_nodes = await asyncio.gather(
+            self.vector.aretrieve(query_bundle),
+            asyncio.to_thread(self.bm25.retrieve, query_bundle),
+        )
+        nodes = self._fuse(vector_nodes, bm25_nodes)
+        if self.reranker is not None:
+            nodes = await asyncio.to_thread(self.reranker.postprocess_nodes, nodes, query_bundle=query_bundle)
+
+        self._store(key, nodes)
+        return nodes
 
 def extract_filters_from_query(query: str) -> dict:
     """从 query 中提取年份等过滤条件（可扩展）"""
@@ -44,23 +152,28 @@ def extract_filters_from_query(query: str) -> dict:
         filters["fiscal_year"] = year_match.group(1)
     return filters
 
-def build_query_engine(bm25_retriever, vector_retriever, raw_query: str):
+def build_query_engine(bm25_retriever, vector_retriever, raw_query: str, cache: Optional[QueryCache] = None,
+                       rerank_budget: int = RERANK_BUDGET):
     # 动态提取元数据过滤条件
     metadata_filters = extract_filters_from_query(raw_query)
     
-    hybrid_retriever = HybridRetriever(
-        bm25_retriever, 
-        vector_retriever, 
-        metadata_filters=metadata_filters
-    )
     # print(f"DASHSCOPE_API_KEY:{DASHSCOPE_API_KEY}")
-    # Rerank
+    # Rerank（在 HybridRetriever 内完成，便于缓存 rerank 结果）
     reranker = DashScopeRerank(
         api_key=DASHSCOPE_API_KEY,
         model=RERANK_MODEL,
         top_n=20
     )
 
+    hybrid_retriever = HybridRetriever(
+        bm25_retriever, 
+        vector_retriever, 
+        metadata_filters=metadata_filters,
+        reranker=reranker,
+        cache=cache,
+        rerank_budget=rerank_budget
+    )
+
     # LLM
     llm = DashScope(
         model_name=LLM_MODEL, 
@@ -141,6 +254,5 @@ def build_query_engine(bm25_retriever, vector_retriever, raw_query: str):
 
     return RetrieverQueryEngine(
         retriever=hybrid_retriever,
-        response_synthesizer=response_synthesizer,
-        node_postprocessors=[reranker]
+        response_synthesizer=response_synthesizer
     )
\ No newline at end of file
@@ -12,11 +12,11 @@ for word in companies:
     jieba.add_word(word)
 
 
-# 尝试兼容不同版本的 llama-index 导入
-try:
-    from llama_index.retrievers.bm25 import BM25Retriever
-except Exception as e:
-    raise ImportError("需要安装兼容的 llama-index 包，或检查版本。详细错误: " + str(e))
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from bm25_index import BM25Index, stable_node_id
+from ingestion import EmbeddingIngestor, all_ids, ingestion_status, INGESTION_KEY, BUILDING, COMPLETE
+from manifest import ManifestDiff, diff_ids
 
 # 向量索引相关
 try:
@@ -115,33 +115,64 @@ except Exception:
             return nodes
 
 CHROMA_PATH = "E:\\model\\RAG\\chroma_db"
+BM25_PATH = "E:\\model\\RAG\\bm25_index"
+
+
+def tokenize(text: str):
+    return jieba.lcut(text)
+
+
+class PersistentBM25Retriever(BaseRetriever):
+    """基于磁盘 BM25 倒排索引（bm25_index.BM25Index）的检索器，返回结果与 BM25Retriever 相同"""
+
+    def __init__(self, index: BM25Index, similarity_top_k: int = 5, filters: dict = None):
+        self.index = index
+        self.similarity_top_k = similarity_top_k
+        self.filters = filters or {}
+        super().__init__()
+
+    def _accept(self, doc: dict) -> bool:
+        meta = doc.get("metadata") or {}
+        return all(meta.get(key) == value for key, value in self.filters.items())
+
+    def _retrieve(self, query_bundle: QueryBundle):
+        results = self.index.search(
+            query_bundle.query_str,
+            top_k=self.similarity_top_k,
+            accept=self._accept if self.filters else None,
+        )
+        return [
+            NodeWithScore(node=TextNode(text=doc["text"], metadata=doc["metadata"], id_=doc["node_id"]), score=score)
+            for doc, score in results
+        ]
 
-def get_bm25_retriever(documents: list, top_k=5, filters=None):
+
+def get_bm25_retriever(documents: list, top_k=5, filters=None, index_dir=BM25_PATH):
     """
-    使用 SimpleNodeParser 将 Document 列表转换为节点，再构建 BM25Retriever。
+    加载 index_dir 下的持久化 BM25 索引，并按 documents 增量更新（只对新增/变化的文档分词）。
     documents: list[llama_index.Document]
+    filters: 可选的元数据过滤 dict（同 filter_nodes_by_metadata）
     """
     if not documents:
         raise ValueError("documents required for BM25 retriever")
 
-    def tokenize(text: str):
-        return jieba.lcut(text)
-
-    parser = SimpleNodeParser()
-    nodes = parser.get_nodes_from_documents(documents)
-
-    return BM25Retriever.from_defaults(
-        nodes=nodes,
-        tokenizer=tokenize,
-        similarity_top_k=top_k,
-        filters=filters
-    )
+    index = BM25Index(index_dir, tokenizer=tokenize, tokenizer_id="jieba:" + ",".join(companies))
+    stats = index.update(documents)
+    if stats["tokenized"] or stats["removed"]:
+        print(f"✅ BM25 index updated in {index_dir}: {stats}")
+    else:
+        print(f"✅ Loaded BM25 index from {index_dir} ({index.num_docs} docs)")
+    return PersistentBM25Retriever(index, similarity_top_k=top_k, filters=filters)
 
-def get_vector_retriever(documents: list=None, top_k=5, filters=None, persist_dir=CHROMA_PATH):
+def get_vector_retriever(documents: list=None, top_k=5, filters=None, persist_dir=CHROMA_PATH,
+                         changes: ManifestDiff=None, max_batch_size=10, max_workers=8):
     """
-    如果 persist_dir 存在且含有 collection，则加载已有索引；
-    否则用 documents 构建新索引并持久化。
-    documents: list[llama_index.Document]
+    加载 persist_dir 下的 Chroma 索引，并与 documents 同步（只 embedding 新增的 chunk，删除已移除的 chunk）。
+    documents: list[llama_index.Document]；为 None 时只加载已完成导入的索引
+    changes: IndexManifest.diff(documents) 的结果；不给出时与 collection 中的全部 ID 比对
+    max_batch_size: 单次 embedding 请求的文本数上限（text-embedding-v3 为 10）
+    max_workers: 并发 embedding 请求数
+    中途崩溃后再次调用会续传（见 ingestion.py）。
     """
     if DashScopeEmbedding is None:
         raise ImportError("DashScopeEmbedding 不可用，请安装相应 llama-index embeddings 或修改为其它 embedding 实现。")
@@ -149,7 +180,7 @@ def get_vector_retriever(documents: list=None, top_k=5, filters=None, persist_di
     embed_model = DashScopeEmbedding(
         model_name=EMBEDDING_MODEL,
         api_key=DASHSCOPE_API_KEY,
-        batch_size=1  # 改为 1，给 API 更多余量
+        batch_size=max_batch_size  # 由 EmbeddingIngestor 控制每次请求的批大小
     )
 
     # 初始化 Chroma 客户端（持久化）
@@ -158,33 +189,37 @@ def get_vector_retriever(documents: list=None, top_k=5, filters=None, persist_di
 
     try:
         chroma_collection = db.get_collection(collection_name)
-        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-        index = VectorStoreIndex.from_vector_store(vector_store, embed_model=embed_model)
-        print(f"✅ Loaded existing index from {persist_dir}")
+        status = ingestion_status(chroma_collection)
     except NotFoundError:
-        if documents is None:
-            raise ValueError("No existing index found and no documents provided to build one.")
-        print(f"🆕 Building new index and saving to {persist_dir}...")
-        chroma_collection = db.create_collection(collection_name)
-        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
-
-        parser = SimpleNodeParser()
-        nodes = parser.get_nodes_from_documents(documents)
-        # 分批，每批最多 10 个 node
-        batch_size = 10
-        index = None
-        for i in range(0, len(nodes), batch_size):
-            batch = nodes[i:i + batch_size]
-            if i == 0:
-                index = VectorStoreIndex(
-                    nodes=batch,
-                    embed_model=embed_model,
-                    storage_context=storage_context,
-                    show_progress=True
-                )
-            else:
-                index.insert_nodes(batch)
+        chroma_collection, status = None, None
+
+    if documents is None:
+        # 没有标记的 collection 是旧版本一次性构建的，视为完整
+        if chroma_collection is None or status == BUILDING:
+            raise ValueError("No complete index found and no documents provided to build one.")
+        print(f"✅ Loaded existing index from {persist_dir}")
+    else:
+        if chroma_collection is None:
+            print(f"🆕 Building new index and saving to {persist_dir}...")
+            chroma_collection = db.create_collection(collection_name, metadata={INGESTION_KEY: BUILDING})
+            changes = None
+        if changes is None or status is None:
+            # 没有清单，或旧版本（随机节点 ID）的 collection：与 collection 中的全部 ID 比对
+            changes = diff_ids(documents, all_ids(chroma_collection))
+        if changes.changed or ingestion_status(chroma_collection) != COMPLETE:
+            print(f"🔄 Updating index in {persist_dir}: {changes.summary()}")
+            nodes = [
+                TextNode(text=d.text, metadata=d.metadata or {}, id_=stable_node_id(d.text, d.metadata))
+                for d in changes.added
+            ]
+            EmbeddingIngestor(
+                embed_model, chroma_collection, max_batch_size=max_batch_size, max_workers=max_workers
+            ).ingest(nodes, delete_ids=changes.removed)
+        else:
+            print(f"✅ Loaded existing index from {persist_dir} (up to date)")
+
+    vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
+    index = VectorStoreIndex.from_vector_store(vector_store, embed_model=embed_model)
     return index.as_retriever(similarity_top_k=top_k, filters=filters)
 
 def filter_nodes_by_metadata(nodes, filters_dict):
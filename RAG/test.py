@@ -1,8 +1,7 @@
 import jieba
-import pickle
 from pathlib import Path
-
-NODES_CACHE = "E:\\model\\RAG\\nodes.pkl"
+from process_report import load_items_from_json
+from config import JSON_DIR
 
 companies = ["高伟达", "京北方", "宇信科技", "财务指标"] # 整体检索，不要分开
 for word in companies:
@@ -27,8 +26,7 @@ for q in test_queries:
 print("=" * 60)
 print("📄 文档样本分词结果:")
 print("=" * 60)
-with open(NODES_CACHE, "rb") as f:
-    documents = pickle.load(f)
+documents = load_items_from_json(JSON_DIR)
 
 
 sources = set(getattr(doc, "metadata", {}).get("source") for doc in documents)
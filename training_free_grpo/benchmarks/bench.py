@@ -0,0 +1,220 @@
+"""Offline throughput benchmark of the orchestration layer (rollouts and experience updates) against a mock LLM.
+
+Starts `mock_llm_server` in a subprocess (so that its CPU time is not counted), points the `UTU_LLM_*` environment
+at it and runs `rollout_dataset` (prompt mode) and the math `ExperienceUpdater` on synthetic problems. Reports
+tasks/sec, p50/p99 latency and the CPU time of this process per component; `--output` saves the report, and
+`--baseline` compares against a saved one and exits with status 1 on a regression beyond `--tolerance`.
+
+Usage (from the repository root):
+    python -m training_free_grpo.benchmarks.bench --num_problems 64 --grpo_n 5 --output bench.json
+    python -m training_free_grpo.benchmarks.bench --num_problems 64 --grpo_n 5 --baseline bench.json --tolerance 0.2
+    python -m training_free_grpo.benchmarks.bench --rate_limit_rate 0.05 --timeout_rate 0.01 --adaptive_concurrency True
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from training_free_grpo.benchmarks.mock_llm_server import add_server_args
+from training_free_grpo.concurrency import AdaptiveConcurrencyController
+from training_free_grpo.evaluation import final_answer
+from training_free_grpo.llm import AsyncLLM
+from training_free_grpo.main import rollout_dataset
+from training_free_grpo.math.experience import ExperienceUpdater
+from training_free_grpo.metrics import METRICS, current_stage
+
+
+SERVER_ARGS = [
+    "rules", "latency_median", "latency_sigma", "rate_limit_rate", "retry_after",
+    "timeout_rate", "hang_seconds", "max_concurrency", "seed",
+]
+
+
+class TimedLLM:
+    """`AsyncLLM` wrapper recording the latency of every `chat` call (including retries) per stage."""
+
+    def __init__(self, llm: AsyncLLM):
+        self.llm = llm
+        self.latencies = {}
+
+    async def chat(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await self.llm.chat(*args, **kwargs)
+        finally:
+            self.latencies.setdefault(current_stage(), []).append(time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+
+def make_data(num_problems: int, grpo_n: int) -> list[dict]:
+    rng = random.Random(0)
+    data = []
+    for i in range(num_problems):
+        a, b = rng.randrange(1000), rng.randrange(1000)
+        # the mock server answers from the [answer=...] tag
+        problem = f"Problem {i}: compute {a} + {b}. [answer={a + b}]"
+        data.extend({"problem": problem, "prompt": problem, "groundtruth": str(a + b)} for _ in range(grpo_n))
+    return data
+
+
+def verify_func(sample: dict, ground_truth: str) -> float:
+    return float(final_answer(sample) == ground_truth)
+
+
+def percentiles(latencies: list[float]) -> dict:
+    if not latencies:
+        return {"latency_p50": 0.0, "latency_p99": 0.0}
+    p50, p99 = np.percentile(latencies, [50, 99])
+    return {"latency_p50": float(p50), "latency_p99": float(p99)}
+
+
+def component(tasks: int, wall: float, cpu: float, latencies: list[float]) -> dict:
+    return {
+        "tasks": tasks,
+        "wall_seconds": wall,
+        "tasks_per_sec": tasks / wall if wall else 0.0,
+        **percentiles(latencies),
+        "cpu_seconds": cpu,
+        # orchestration overhead: CPU of this process (the server runs in its own process) per task
+        "cpu_ms_per_task": 1000 * cpu / tasks if tasks else 0.0,
+    }
+
+
+def start_server(args) -> tuple[subprocess.Popen, str]:
+    command = [sys.executable, "-m", "training_free_grpo.benchmarks.mock_llm_server", "--port", "0"]
+    for name in SERVER_ARGS:
+        if getattr(args, name) is not None:
+            command.extend([f"--{name}", str(getattr(args, name))])
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = server.stdout.readline()
+    if not line.startswith("Listening on "):
+        server.kill()
+        raise RuntimeError(f"mock LLM server failed to start: {line!r}")
+    return server, line[len("Listening on "):].strip()
+
+
+async def run_bench(args) -> dict:
+    controller = None
+    if args.adaptive_concurrency == "True":
+        controller = AdaptiveConcurrencyController(max_concurrency=args.rollout_concurrency)
+    llm = TimedLLM(AsyncLLM(controller=controller))
+    data = make_data(args.num_problems, args.grpo_n)
+    report = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        metrics_before = METRICS.snapshot()
+        wall, cpu = time.perf_counter(), time.process_time()
+        rollouts, stats = await rollout_dataset(
+            worker_agent=None,
+            data=data,
+            rollouts=[],
+            rollout_filename=os.path.join(tmp_dir, "rollout.jsonl"),
+            verify_func=verify_func,
+            rollout_concurrency=args.rollout_concurrency,
+            task_timeout=args.task_timeout,
+            llm=llm,
+            controller=controller,
+        )
+        report["rollout"] = component(
+            len(rollouts), time.perf_counter() - wall, time.process_time() - cpu,
+            [each["rollout_time"] for each in rollouts if "rollout_time" in each],
+        )
+        report["rollout"]["avg_reward"] = stats["avg_reward"]
+
+        calls_before = {stage: len(latencies) for stage, latencies in llm.latencies.items()}
+        wall, cpu = time.perf_counter(), time.process_time()
+        save_dir = os.path.join(tmp_dir, "update")
+        os.makedirs(save_dir)
+        updater = ExperienceUpdater(llm=llm, controller=controller)
+        experiences = await updater.run(rollouts, {}, save_dir, max_workers=args.update_concurrency)
+        update_latencies = {
+            stage: latencies[calls_before.get(stage, 0):] for stage, latencies in llm.latencies.items() if stage != "rollout"
+        }
+        report["experience_update"] = component(
+            sum(len(each) for each in update_latencies.values()), time.perf_counter() - wall, time.process_time() - cpu,
+            [latency for each in update_latencies.values() for latency in each],
+        )
+        report["experience_update"]["num_experiences"] = len(experiences)
+        report["experience_update"]["stages"] = {
+            stage: {"calls": len(latencies), **percentiles(latencies)}
+            for stage, latencies in update_latencies.items() if latencies
+        }
+        total = METRICS.since(metrics_before).get("total", {})
+        report["llm"] = {name: total.get(name, 0) for name in ["calls", "errors", "retries", "timeouts"]}
+    await AsyncLLM.aclose()
+    return report
+
+
+def find_regressions(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, result in report.items():
+        if name not in baseline or "tasks_per_sec" not in result:
+            continue
+        before = baseline[name]
+        if result["tasks_per_sec"] < before["tasks_per_sec"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['tasks_per_sec']:.2f} tasks/sec (baseline {before['tasks_per_sec']:.2f})")
+        if result["cpu_ms_per_task"] > before["cpu_ms_per_task"] * (1 + tolerance):
+            regressions.append(f"{name}: {result['cpu_ms_per_task']:.2f} CPU ms/task (baseline {before['cpu_ms_per_task']:.2f})")
+    return regressions
+
+
+def main(args):
+    server, base_url = start_server(args)
+    os.environ.update({
+        "UTU_LLM_TYPE": "chat.completions",
+        "UTU_LLM_MODEL": "mock",
+        "UTU_LLM_API_KEY": "mock",
+        "UTU_LLM_BASE_URL": base_url,
+    })
+    try:
+        report = asyncio.run(run_bench(args))
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(f"Problems: {args.num_problems} x {args.grpo_n}, mock server at {base_url}")
+    for name in ["rollout", "experience_update"]:
+        result = report[name]
+        print(
+            f"- {name}: {result['tasks']} tasks, {result['tasks_per_sec']:.2f} tasks/sec, "
+            f"p50 {result['latency_p50']:.3f}s, p99 {result['latency_p99']:.3f}s, "
+            f"CPU {result['cpu_seconds']:.2f}s ({result['cpu_ms_per_task']:.2f} ms/task)"
+        )
+    for stage, result in report["experience_update"]["stages"].items():
+        print(f"  - {stage}: {result['calls']} calls, p50 {result['latency_p50']:.3f}s, p99 {result['latency_p99']:.3f}s")
+    print(f"- llm: {report['llm']}")
+    if args.output:
+        json.dump(report, open(args.output, "w"), indent=2)
+        print(f"Saved report to {args.output}")
+    if args.baseline:
+        regressions = find_regressions(report, json.load(open(args.baseline)), args.tolerance)
+        for each in regressions:
+            print(f"REGRESSION {each}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regression beyond {args.tolerance:.0%} of {args.baseline}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline orchestration benchmark against a mock LLM server")
+    parser.add_argument("--num_problems", type=int, default=64, help="number of synthetic problems")
+    parser.add_argument("--grpo_n", type=int, default=5, help="number of rollouts in a group of GRPO")
+    parser.add_argument("--rollout_concurrency", type=int, default=32, help="rollout concurrency")
+    parser.add_argument("--update_concurrency", type=int, default=16, help="max workers of the experience update")
+    parser.add_argument("--task_timeout", type=float, default=10, help="timeout of a rollout task in seconds")
+    parser.add_argument("--adaptive_concurrency", type=str, default="False", help="adapt the concurrency (AIMD) to throttling")
+    parser.add_argument("--output", type=str, default=None, help="save the report to this JSON file")
+    parser.add_argument("--baseline", type=str, default=None, help="compare against this saved report")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown tolerated by --baseline")
+    add_server_args(parser)
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,115 @@
+"""Compare in-loop `verify_func` (extractors rebuilt per call) against `VerifierPool` on DAPO-Math-17k answers.
+
+Besides throughput, the benchmark reports the longest event-loop stall seen by a ticker coroutine, i.e. how long
+every other rollout task is blocked while answers are verified.
+
+Usage (from the repository root):
+    python -m training_free_grpo.benchmarks.math_verifier --num_problems 500 --max_workers 8
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from math_verify.metric import math_metric
+from math_verify.parser import ExprExtractionConfig, LatexExtractionConfig
+
+from training_free_grpo.math.verify import VerifierPool, verify_func
+
+
+def legacy_verify_func(sample: dict, ground_truth: str) -> float:
+    """The previous behaviour: build the extractors on every call."""
+    metric = math_metric(
+        gold_extraction_target=(LatexExtractionConfig(),),
+        pred_extraction_target=(ExprExtractionConfig(), LatexExtractionConfig()),
+    )
+    try:
+        score, _ = metric(["\\boxed{" + str(ground_truth) + "}"], [sample["response"]])
+    except Exception:
+        score = 0.0
+    return float(score)
+
+
+def make_samples(data: list[dict], num_problems: int) -> list[tuple[dict, str]]:
+    samples = []
+    for each in data[:num_problems]:
+        gt = str(each["groundtruth"])
+        samples.append(({"response": f"Some reasoning.\n\nAnswer: \\boxed{{{gt}}}"}, gt))
+        samples.append(({"response": f"Some reasoning.\n\nAnswer: {gt}"}, gt))
+        samples.append(({"response": f"Some reasoning.\n\nAnswer: \\boxed{{{gt} + 1}}"}, gt))
+    random.shuffle(samples)
+    return samples
+
+
+async def measure(verify, samples: list[tuple[dict, str]], concurrency: int) -> tuple[list[float], float, float]:
+    """Run `verify` from `concurrency` tasks; returns the scores, wall time and the longest event-loop stall."""
+    max_stall = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal max_stall
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            max_stall = max(max_stall, time.perf_counter() - start - 0.001)
+
+    scores = [None] * len(samples)
+    queue = asyncio.Queue()
+    for i in range(len(samples)):
+        queue.put_nowait(i)
+
+    async def worker():
+        while not queue.empty():
+            i = queue.get_nowait()
+            sample, gt = samples[i]
+            score = verify(sample, gt)
+            scores[i] = await score if asyncio.iscoroutine(score) else score
+
+    ticker_task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    done = True
+    await ticker_task
+    return scores, elapsed, max_stall
+
+
+async def main(args):
+    random.seed(42)
+    if args.data_file:
+        data = json.load(open(args.data_file))
+    else:
+        from training_free_grpo.math.dataset import load_data
+        data = load_data("DAPO-Math-17k")
+    samples = make_samples(data, args.num_problems)
+    print(f"Samples: {len(samples)} ({args.num_problems} DAPO-Math-17k answers x 3 response formats)")
+
+    results = {}
+    for name, verify in [("legacy", legacy_verify_func), ("cached", verify_func)]:
+        results[name] = await measure(verify, samples, args.concurrency)
+
+    pool = VerifierPool(max_workers=args.max_workers, batch_size=args.batch_size)
+    # warm up the worker processes so the pool start-up is not counted
+    await pool.verify_many([sample for sample, _ in samples[: args.max_workers]], [gt for _, gt in samples[: args.max_workers]])
+    results["pool"] = await measure(pool, samples, args.concurrency)
+    pool.close()
+
+    for name, (scores, elapsed, max_stall) in results.items():
+        mismatches = sum(a != b for a, b in zip(scores, results["legacy"][0]))
+        print(
+            f"- {name}: {len(samples) / elapsed:.1f} samples/s, max event-loop stall {max_stall * 1000:.1f}ms, "
+            f"accuracy {sum(scores) / len(scores):.3f}, mismatches vs legacy {mismatches}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Math verifier benchmark")
+    parser.add_argument("--num_problems", type=int, default=500, help="number of DAPO-Math-17k problems")
+    parser.add_argument("--data_file", type=str, default=None, help="JSON list of {problem, groundtruth}; defaults to DAPO-Math-17k")
+    parser.add_argument("--concurrency", type=int, default=64, help="number of concurrent rollout tasks calling the verifier")
+    parser.add_argument("--max_workers", type=int, default=8, help="number of verifier processes")
+    parser.add_argument("--batch_size", type=int, default=16, help="max samples per worker submission")
+
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -0,0 +1,248 @@
+"""Local stand-in for an OpenAI-compatible chat completions endpoint, for offline benchmarks.
+
+Replies come from templated rules (first regex matching the prompt wins, one of its templates is picked at random)
+after a lognormal latency; a fraction of the requests can be answered with 429 (with Retry-After) or left
+hanging to exercise backoff, timeouts and the adaptive concurrency. The default rules answer the prompts of the
+math domain: rollouts of problems tagged with `[answer=...]` (correct half of the time), trajectory summaries,
+critiques and batch updates.
+
+Usage (from the repository root):
+    python -m training_free_grpo.benchmarks.mock_llm_server --port 8000 --latency_median 0.5 --rate_limit_rate 0.02
+    UTU_LLM_TYPE=chat.completions UTU_LLM_MODEL=mock UTU_LLM_API_KEY=x UTU_LLM_BASE_URL=http://127.0.0.1:8000/v1 ...
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_RULES = [
+    {
+        # batch update (math and web): no revision
+        "match": r"update options: \[modify, merge\]",
+        "responses": ["The experiences are already concise.\n```json\n[]\n```"],
+    },
+    {
+        "match": r"summarize the trajectory",
+        "responses": [
+            "1. The agent restated the problem and identified the quantities involved.\n"
+            "2. It computed the result step by step and checked it against the constraints.\n"
+            "3. It reported the final answer."
+        ],
+    },
+    {
+        # single query critiques: one new experience
+        "match": r'"option": "add"',
+        "responses": [
+            "The successful trajectories verified their intermediate results.\n```json\n"
+            '[{{"option": "add", "experience": "Check intermediate result {rand} against the constraints of the problem '
+            'before reporting the final answer."}}]\n```',
+            "```json\n[]\n```",
+        ],
+    },
+    {
+        "match": r"\[answer=(?P<answer>[^\]]+)\]",
+        "responses": [
+            "Adding the numbers step by step gives the result.\n\\boxed{{{answer}}}",
+            "Adding the numbers step by step gives the result.\n\\boxed{{{rand}}}",
+        ],
+    },
+    {"match": r"", "responses": ["OK."]},
+]
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default listen backlog of 5 drops connections of concurrent clients (seen as 1s+ latency spikes)
+    request_queue_size = 1024
+
+
+class MockLLMServer:
+    """Threaded HTTP server answering `POST /v1/chat/completions`; `start` runs it in a background thread."""
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        rules: list[dict] | None = None,
+        latency_median: float = 0.5,
+        latency_sigma: float = 0.5,
+        rate_limit_rate: float = 0.0,
+        retry_after: float = 1.0,
+        timeout_rate: float = 0.0,
+        hang_seconds: float = 60.0,
+        max_concurrency: int = 0,
+        seed: int = 0,
+    ):
+        self.rules = [(re.compile(rule["match"]), rule["responses"]) for rule in (rules or DEFAULT_RULES)]
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.timeout_rate = timeout_rate
+        self.hang_seconds = hang_seconds
+        # requests beyond `max_concurrency` in flight are throttled (0: unlimited)
+        self.max_concurrency = max_concurrency
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.counts = {"requests": 0, "completions": 0, "rate_limited": 0, "hung": 0}
+        self._thread = None
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._send(404, {"error": {"message": f"unknown path {self.path}", "type": "not_found"}})
+                    return
+                status, payload, headers = server.handle(json.loads(body or b"{}"))
+                self._send(status, payload, headers)
+
+            def _send(self, status: int, payload: dict, headers: dict | None = None):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up (e.g. a hung request that timed out)
+                    pass
+
+        self.httpd = _Server((host, port), Handler)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def reply(self, prompt: str) -> str:
+        for pattern, responses in self.rules:
+            match = pattern.search(prompt)
+            if match is not None:
+                with self._lock:
+                    template = self._rng.choice(responses)
+                    rand = self._rng.randrange(1000)
+                return template.format(rand=rand, **match.groupdict())
+        return ""
+
+    def handle(self, request: dict) -> tuple[int, dict, dict]:
+        with self._lock:
+            self.counts["requests"] += 1
+            throttled = (
+                self._rng.random() < self.rate_limit_rate
+                or (self.max_concurrency > 0 and self.in_flight >= self.max_concurrency)
+            )
+            hang = not throttled and self._rng.random() < self.timeout_rate
+            latency = self._rng.lognormvariate(0, self.latency_sigma) * self.latency_median
+            if throttled:
+                self.counts["rate_limited"] += 1
+            else:
+                self.in_flight += 1
+                self.counts["hung" if hang else "completions"] += 1
+        if throttled:
+            error = {"error": {"message": "Rate limit exceeded", "type": "rate_limit_error", "code": "rate_limit_exceeded"}}
+            return 429, error, {"Retry-After": str(self.retry_after)}
+        try:
+            time.sleep(self.hang_seconds if hang else latency)
+            prompt = "\n".join(str(message.get("content", "")) for message in request.get("messages", []))
+            content = self.reply(prompt)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        # ~4 characters per token
+        prompt_tokens, completion_tokens = len(prompt) // 4 + 1, len(content) // 4 + 1
+        return 200, {
+            "id": f"chatcmpl-mock-{self.counts['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": 0},
+            },
+        }, {}
+
+    def start(self) -> str:
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def add_server_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--rules", type=str, default=None, help="JSON file of [{match, responses}] reply rules (default: math domain)")
+    parser.add_argument("--latency_median", type=float, default=0.5, help="median latency of a completion in seconds")
+    parser.add_argument("--latency_sigma", type=float, default=0.5, help="sigma of the lognormal latency (0: constant)")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Retry-After of the 429 responses in seconds")
+    parser.add_argument("--timeout_rate", type=float, default=0.0, help="fraction of requests left hanging")
+    parser.add_argument("--hang_seconds", type=float, default=60.0, help="how long a hanging request hangs")
+    parser.add_argument("--max_concurrency", type=int, default=0, help="throttle requests beyond this many in flight (0: unlimited)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of latencies, injected errors and replies")
+
+
+def server_from_args(args, host: str = "127.0.0.1", port: int = 0) -> MockLLMServer:
+    return MockLLMServer(
+        host=host,
+        port=port,
+        rules=json.load(open(args.rules)) if args.rules else None,
+        latency_median=args.latency_median,
+        latency_sigma=args.latency_sigma,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        timeout_rate=args.timeout_rate,
+        hang_seconds=args.hang_seconds,
+        max_concurrency=args.max_concurrency,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible LLM server")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="host to bind")
+    parser.add_argument("--port", type=int, default=8000, help="port to bind (0: any free port)")
+    add_server_args(parser)
+
+    args = parser.parse_args()
+    server = server_from_args(args, args.host, args.port)
+    # the first line tells callers (e.g. the bench) where the server listens
+    print(f"Listening on {server.base_url}", flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print(json.dumps(server.counts))
@@ -0,0 +1,89 @@
+"""Compare the rewrite-everything rollout file against the append-only journal.
+
+Usage (from the repository root):
+    python -m training_free_grpo.benchmarks.rollout_journal --batchsize 64 --grpo_n 5 --trajectory_chars 64000
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from training_free_grpo.journal import RolloutJournal, load_rollouts
+
+
+def make_rollouts(num: int, trajectory_chars: int) -> tuple[list[dict], list[dict]]:
+    rollouts = [{"runid": i, "problem": f"problem {i % 64}", "groundtruth": "42"} for i in range(num)]
+    finished = []
+    for each in rollouts:
+        content = "x" * trajectory_chars
+        finished.append(
+            {
+                **each,
+                "response": content[-200:],
+                "trajectories": [{"trajectory": [{"role": "user", "content": each["problem"]}, {"role": "assistant", "content": content}]}],
+                "error": None,
+                "rollout_time": random.random(),
+                "reward": float(random.random() > 0.5),
+            }
+        )
+    return rollouts, finished
+
+
+def bench_rewrite(rollouts: list[dict], finished: list[dict], rollout_filename: str) -> tuple[int, float]:
+    """The previous behaviour: rewrite the whole JSONL file after every finished sample."""
+    rollouts = list(rollouts)
+    bytes_written = 0
+    start = time.perf_counter()
+    for sample in finished:
+        rollouts[sample["runid"]] = sample
+        with open(rollout_filename, "w", encoding="utf-8") as f:
+            for result in rollouts:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        bytes_written += os.path.getsize(rollout_filename)
+    return bytes_written, time.perf_counter() - start
+
+
+def bench_journal(rollouts: list[dict], finished: list[dict], rollout_filename: str) -> tuple[int, float]:
+    rollouts = list(rollouts)
+    start = time.perf_counter()
+    journal = RolloutJournal(rollout_filename)
+    journal.compact(rollouts)
+    for sample in finished:
+        rollouts[sample["runid"]] = sample
+        journal.append(sample)
+    journal.compact(rollouts)
+    return journal.bytes_written, time.perf_counter() - start
+
+
+def main(args):
+    random.seed(42)
+    num = args.batchsize * args.grpo_n
+    rollouts, finished = make_rollouts(num, args.trajectory_chars)
+    random.shuffle(finished)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rewrite_bytes, rewrite_time = bench_rewrite(rollouts, finished, os.path.join(tmp_dir, "rewrite.jsonl"))
+
+        journal_filename = os.path.join(tmp_dir, "journal.jsonl")
+        journal_bytes, journal_time = bench_journal(rollouts, finished, journal_filename)
+
+        # sanity check: replaying the compacted journal gives back every finished sample
+        replayed = load_rollouts(journal_filename)
+        assert all(each.get("trajectories") for each in replayed)
+
+    print(f"Samples: {num} ({args.batchsize} x {args.grpo_n}), trajectory size: {args.trajectory_chars} chars")
+    print(f"- rewrite: {rewrite_bytes / 2**20:.1f} MiB written in {rewrite_time:.2f}s")
+    print(f"- journal: {journal_bytes / 2**20:.1f} MiB written in {journal_time:.2f}s")
+    print(f"- speedup: {rewrite_time / max(journal_time, 1e-9):.1f}x, bytes ratio: {rewrite_bytes / max(journal_bytes, 1):.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rollout journal benchmark")
+    parser.add_argument("--batchsize", type=int, default=64, help="batchsize")
+    parser.add_argument("--grpo_n", type=int, default=5, help="number of rollouts in a group of GRPO")
+    parser.add_argument("--trajectory_chars", type=int, default=64000, help="characters per trajectory (~16k tokens)")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache:
+    """Persistent, size-capped LRU key-value cache backed by SQLite.
+
+    Keys are content addresses built with `make_key` (e.g. model + messages + sampling parameters), values are any
+    JSON-serializable object. When the stored values exceed `max_bytes`, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1 << 30):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    @staticmethod
+    def make_key(**fields) -> str:
+        payload = json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key: str, value):
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, data, size, time.time()),
+            )
+            self._total_bytes += size - (old[0] if old else 0)
+            self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes:
+            rows = self._conn.execute("SELECT key, size FROM cache ORDER BY last_access LIMIT 64").fetchall()
+            if not rows:
+                self._total_bytes = 0
+                break
+            evicted = []
+            for key, size in rows:
+                if self._total_bytes <= self.max_bytes:
+                    break
+                evicted.append((key,))
+                self._total_bytes -= size
+            self._conn.executemany("DELETE FROM cache WHERE key = ?", evicted)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self) -> dict:
+        return {"cache_hits": self.hits, "cache_misses": self.misses, "cache_bytes": self._total_bytes}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
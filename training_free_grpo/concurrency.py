@@ -0,0 +1,167 @@
+import asyncio
+import random
+import time
+
+from collections import deque
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+
+# jitter has its own generator so that retries do not advance the seeded global one (e.g. the data shuffle)
+_jitter = random.Random()
+
+
+def get_retry_after(error: Exception) -> float | None:
+    """Seconds the server asked us to wait (`retry-after-ms` / `retry-after` headers), if any."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def is_throttled(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+
+def is_timeout(error: Exception) -> bool:
+    return isinstance(error, (asyncio.TimeoutError, TimeoutError)) or "Timeout" in type(error).__name__
+
+
+def backoff_delay(attempt: int, retry_after: float | None = None, base: float = 1.0, cap: float = 60.0) -> float:
+    """Full-jitter exponential backoff; an explicit `Retry-After` from the server takes precedence."""
+    if retry_after is not None:
+        return min(retry_after, cap) + _jitter.uniform(0, base)
+    return _jitter.uniform(0, min(cap, base * 2**attempt))
+
+
+class AdaptiveConcurrencyController:
+    """AIMD limit on the number of in-flight requests.
+
+    The limit grows by `additive_increase` per window of successful requests and is multiplied by
+    `decrease_factor` on a 429, a timeout, or when the recent latency exceeds `latency_tolerance`
+    times the long-run latency. Decreases are rate-limited by `cooldown` seconds so that one burst of
+    throttled requests only halves the limit once.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        min_concurrency: int = 1,
+        initial_concurrency: int | None = None,
+        additive_increase: float = 1.0,
+        decrease_factor: float = 0.5,
+        latency_tolerance: float = 2.0,
+        latency_warmup: int = 20,
+        cooldown: float = 5.0,
+    ):
+        assert 1 <= min_concurrency <= max_concurrency
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(initial_concurrency or max_concurrency)
+        self.additive_increase = additive_increase
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.latency_warmup = latency_warmup
+        self.cooldown = cooldown
+
+        self.in_flight = 0
+        self._waiters = deque()
+        self._last_decrease = 0.0
+        self._fast_latency = None
+        self._slow_latency = None
+        self.num_successes = 0
+        self.num_throttles = 0
+        self.num_timeouts = 0
+        self.num_decreases = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        await self._acquire()
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self):
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over right before cancellation
+                self._release()
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+    def _release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_concurrency, self.limit * self.decrease_factor)
+        self.num_decreases += 1
+
+    def on_success(self, latency: float):
+        self.num_successes += 1
+        if self._fast_latency is None:
+            self._fast_latency = self._slow_latency = latency
+        else:
+            self._fast_latency += 0.3 * (latency - self._fast_latency)
+            self._slow_latency += 0.05 * (latency - self._slow_latency)
+        if (
+            self.num_successes >= self.latency_warmup
+            and self._fast_latency > self.latency_tolerance * self._slow_latency
+        ):
+            self._decrease()
+        else:
+            self.limit = min(self.max_concurrency, self.limit + self.additive_increase / max(self.limit, 1.0))
+            self._wake()
+
+    def on_throttle(self):
+        self.num_throttles += 1
+        self._decrease()
+
+    def on_timeout(self):
+        self.num_timeouts += 1
+        self._decrease()
+
+    def on_error(self, error: Exception):
+        if is_throttled(error):
+            self.on_throttle()
+        elif is_timeout(error):
+            self.on_timeout()
+
+    def stats(self) -> dict:
+        return {
+            "concurrency_limit": int(self.limit),
+            "num_throttles": self.num_throttles,
+            "num_timeouts": self.num_timeouts,
+            "num_concurrency_decreases": self.num_decreases,
+        }
@@ -0,0 +1,79 @@
+import os
+from typing import Callable, Iterator
+
+import pyarrow as pa
+
+
+class ColumnarDataset:
+    """Read-only list-like view of records stored in an Arrow table.
+
+    Opened from an Arrow IPC file through a memory map, so only the pages that are actually read are loaded and
+    opening costs the same for 100 or 100k problems. Integer indexing and iteration yield plain dicts, slicing
+    returns another zero-copy view, and `take` / `iter_batches` materialize only the requested rows, e.g. in the
+    order of a shuffled index permutation.
+    """
+
+    def __init__(self, table: pa.Table):
+        self.table = table
+
+    @classmethod
+    def open(cls, path: str) -> "ColumnarDataset":
+        source = pa.memory_map(path, "r")
+        return cls(pa.ipc.open_file(source).read_all())
+
+    @classmethod
+    def from_records(cls, records: list[dict]) -> "ColumnarDataset":
+        return cls(pa.Table.from_pylist(list(records)))
+
+    @property
+    def columns(self) -> list[str]:
+        return self.table.column_names
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self.take(range(start, stop, step))
+            return ColumnarDataset(self.table.slice(start, max(stop - start, 0)))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("dataset index out of range")
+        return self.table.slice(index, 1).to_pylist()[0]
+
+    def __iter__(self) -> Iterator[dict]:
+        for batch in self.table.to_batches():
+            yield from batch.to_pylist()
+
+    def take(self, indices) -> list[dict]:
+        return self.table.take(pa.array(list(indices), type=pa.int64())).to_pylist()
+
+    def iter_batches(self, batch_size: int, indices: list[int] | None = None, drop_last: bool = True) -> Iterator[list[dict]]:
+        """Lazily yield batches of records, in the order of `indices` if given."""
+        if indices is None:
+            indices = range(len(self))
+        stop = len(indices) - len(indices) % batch_size if drop_last else len(indices)
+        for start in range(0, stop, batch_size):
+            yield self.take(indices[start : start + batch_size])
+
+
+def write_table(path: str, table: pa.Table):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def load_cached(path: str, build: Callable[[], list[dict]]) -> ColumnarDataset:
+    """Memory-map the Arrow cache at `path`, building it from `build()` (a list of records) on first use."""
+    if not os.path.exists(path):
+        records = build()
+        write_table(path, pa.Table.from_pylist(list(records)))
+        print(f"- Cached {len(records)} records to {path}")
+    return ColumnarDataset.open(path)
@@ -0,0 +1,194 @@
+import re
+
+import numpy as np
+
+
+def final_answer(sample: dict) -> str:
+    """Answer used for majority voting: the last \\boxed{...} of the response, else the stripped response."""
+    response = str(sample.get("response") or "")
+    boxed = re.findall(r"\\boxed\{((?:[^{}]|\{[^{}]*\})*)\}", response)
+    return (boxed[-1] if boxed else response).strip()
+
+
+class RewardMatrix:
+    """Rewards of a rollout set as a problems x samples matrix, built once and evaluated with NumPy.
+
+    Rows are problems (in order of first appearance), columns their samples; problems with fewer samples (e.g.
+    early-stopped groups) are padded with NaN. Pass@k uses the unbiased estimator 1 - C(n-c, k) / C(n, k) of Chen
+    et al. (2021) per problem, with n samples of which c succeeded (reward > 0); for all k at once it is a
+    cumulative product over the matrix columns. Confidence intervals come from one set of Poisson bootstrap weights
+    over problems, shared by all metrics and applied to all of them in one matrix product. The average reward is
+    weighted by the number of samples of each problem, both as point estimate and in its bootstrap.
+    """
+
+    def __init__(self, rewards: np.ndarray, problems: list[str], answers: np.ndarray | None = None,
+                 tool_calls: np.ndarray | None = None, groups: dict[str, np.ndarray] | None = None):
+        self.rewards = rewards
+        self.problems = problems
+        self.answers = answers
+        self.tool_calls = tool_calls
+        self.groups = groups or {}
+        self._weights = None
+
+    @classmethod
+    def from_rollouts(cls, rollouts: list[dict], group_by: tuple[str, ...] = ("level",), answer_func=final_answer) -> "RewardMatrix":
+        rows, columns = {}, []
+        for rollout in rollouts:
+            if rollout.get("skipped"):
+                continue
+            row = rows.setdefault(rollout["problem"], len(rows))
+            if row == len(columns):
+                columns.append(0)
+            columns[row] += 1
+        shape = (len(rows), max(columns, default=0))
+        rewards = np.full(shape, np.nan)
+        answers = np.full(shape, -1, dtype=np.int64)
+        tool_calls = np.full(shape, np.nan)
+        labels = {key: [None] * len(rows) for key in group_by}
+        answer_ids = {}
+        filled = [0] * len(rows)
+        for rollout in rollouts:
+            if rollout.get("skipped"):
+                continue
+            row = rows[rollout["problem"]]
+            column = filled[row]
+            filled[row] += 1
+            rewards[row, column] = rollout.get("reward", 0)
+            if answer_func is not None and not rollout.get("error"):
+                answers[row, column] = answer_ids.setdefault((row, answer_func(rollout)), len(answer_ids))
+            if rollout.get("trajectories"):
+                trajectory = rollout["trajectories"][0]["trajectory"]
+                tool_calls[row, column] = sum(each["role"] == "tool" for each in trajectory)
+            for key in group_by:
+                if key in rollout:
+                    labels[key][row] = rollout[key]
+        groups = {key: np.array(values, dtype=object) for key, values in labels.items() if any(v is not None for v in values)}
+        return cls(rewards, list(rows), answers if answer_func is not None else None, tool_calls, groups)
+
+    @property
+    def num_samples(self) -> np.ndarray:
+        return (~np.isnan(self.rewards)).sum(axis=1)
+
+    @property
+    def num_correct(self) -> np.ndarray:
+        return (np.nan_to_num(self.rewards) > 0).sum(axis=1)
+
+    def subset(self, mask: np.ndarray) -> "RewardMatrix":
+        matrix = RewardMatrix(
+            self.rewards[mask],
+            [problem for problem, keep in zip(self.problems, mask) if keep],
+            self.answers[mask] if self.answers is not None else None,
+            self.tool_calls[mask] if self.tool_calls is not None else None,
+            {key: labels[mask] for key, labels in self.groups.items()},
+        )
+        if self._weights is not None:
+            matrix._weights = self._weights[:, mask]
+        return matrix
+
+    def pass_at_k_per_problem(self) -> np.ndarray:
+        """(problems, max_k) matrix of unbiased pass@k, k = 1..max_k; NaN where a problem has fewer than k samples."""
+        n, c = self.num_samples[:, None], self.num_correct[:, None]
+        i = np.arange(self.rewards.shape[1])[None, :]
+        # C(n-c, k) / C(n, k) = prod_{i<k} (n-c-i) / (n-i)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            all_fail = np.cumprod(np.clip(n - c - i, 0, None) / (n - i), axis=1)
+        return np.where(i < n, 1.0 - all_fail, np.nan)
+
+    def pass_at_k(self) -> dict[int, float]:
+        """Unbiased pass@k for every k, averaged over the problems with at least k samples."""
+        per_problem = self.pass_at_k_per_problem()
+        counts = (~np.isnan(per_problem)).sum(axis=0)
+        with np.errstate(invalid="ignore"):
+            means = np.nansum(per_problem, axis=0) / counts
+        return {k + 1: float(means[k]) for k in range(len(means)) if counts[k]}
+
+    def majority_correct(self) -> np.ndarray:
+        """Per problem, the reward of the most frequent answer (ties: the first sampled); NaN without answers."""
+        answers = self.answers
+        valid = answers >= 0
+        votes = ((answers[:, :, None] == answers[:, None, :]) & valid[:, None, :]).sum(axis=2)
+        votes[~valid] = -1
+        choice = votes.argmax(axis=1)
+        correct = np.nan_to_num(self.rewards[np.arange(len(choice)), choice]) > 0
+        return np.where(valid.any(axis=1), correct.astype(float), np.nan)
+
+    def bootstrap_weights(self, num_resamples: int = 1000, seed: int = 0) -> np.ndarray:
+        """(num_resamples, problems) Poisson(1) resampling weights, drawn once and shared by all metrics."""
+        if self._weights is None or self._weights.shape[0] != num_resamples:
+            rng = np.random.default_rng(seed)
+            self._weights = rng.poisson(1.0, size=(num_resamples, len(self.problems))).astype(np.float32)
+        return self._weights
+
+    def bootstrap(self, per_problem: np.ndarray, num_resamples: int = 1000, confidence: float = 0.95,
+                  problem_weights: np.ndarray | None = None) -> list[tuple[float, float]]:
+        """Percentile intervals of the (weighted) means of per-problem metrics (columns of `per_problem`, NaN = no
+        value) under a Poisson bootstrap over problems; all metrics are resampled in one matrix product.
+        `problem_weights` (same shape, default 1) weights each problem within a metric, e.g. by its sample count."""
+        if per_problem.ndim == 1:
+            per_problem = per_problem[:, None]
+        if num_resamples <= 0 or len(self.problems) == 0:
+            return [(float("nan"), float("nan"))] * per_problem.shape[1]
+        if problem_weights is None:
+            problem_weights = np.ones_like(per_problem)
+        elif problem_weights.ndim == 1:
+            problem_weights = problem_weights[:, None]
+        # problems without a value get zero weight
+        weights = np.where(np.isnan(per_problem), 0, problem_weights)
+        stacked = np.concatenate([np.where(weights > 0, per_problem, 0) * weights, weights], axis=1).astype(np.float32)
+        sums = self.bootstrap_weights(num_resamples) @ stacked
+        values, totals = np.split(sums, 2, axis=1)
+        alpha = (1 - confidence) / 2
+        intervals = []
+        for column in range(per_problem.shape[1]):
+            resampled = values[:, column][totals[:, column] > 0] / totals[:, column][totals[:, column] > 0]
+            if len(resampled) == 0:
+                intervals.append((float("nan"), float("nan")))
+                continue
+            low, high = np.quantile(resampled, [alpha, 1 - alpha])
+            intervals.append((float(low), float(high)))
+        return intervals
+
+    def summary(self, ks: list[int] | None = None, num_resamples: int = 1000, confidence: float = 0.95) -> dict:
+        """avg reward, pass@k (all k, or `ks`), majority-vote accuracy and tool calls, with bootstrap intervals.
+
+        `maj` votes over all samples of each problem, which may be fewer than the widest row (early stopping)."""
+        max_k = self.rewards.shape[1]
+        if ks is None:
+            ks = list(range(1, max_k + 1))
+        ks = [k for k in ks if k <= max_k]
+        pass_at_k = self.pass_at_k()
+        ks = [k for k in ks if k in pass_at_k]
+        with np.errstate(invalid="ignore"):
+            columns = {"avg_reward": np.nanmean(self.rewards, axis=1) if max_k else np.zeros(len(self.problems))}
+        pass_per_problem = self.pass_at_k_per_problem()
+        columns.update({f"pass@{k}": pass_per_problem[:, k - 1] for k in ks})
+        if self.answers is not None and max_k > 1:
+            columns["maj"] = self.majority_correct()
+
+        result = {"num_problems": len(self.problems), "num_samples": int(self.num_samples.sum())}
+        # the average reward is per sample: weight each problem by its number of samples
+        problem_weights = np.ones((len(self.problems), len(columns)))
+        problem_weights[:, 0] = self.num_samples
+        intervals = self.bootstrap(np.stack(list(columns.values()), axis=1), num_resamples, confidence, problem_weights)
+        for (name, per_problem), interval in zip(columns.items(), intervals):
+            if name == "avg_reward":
+                value = float(np.nanmean(self.rewards)) if result["num_samples"] else 0.0
+            elif name.startswith("pass@"):
+                value = pass_at_k[int(name[len("pass@"):])]
+            else:
+                value = float(np.nanmean(per_problem)) if (~np.isnan(per_problem)).any() else 0.0
+            result[name] = value
+            result[f"{name}_ci"] = interval
+        if self.tool_calls is not None and (~np.isnan(self.tool_calls)).any():
+            result["avg_tool_call"] = float(np.nanmean(self.tool_calls))
+        return result
+
+    def breakdown(self, key: str, **kwargs) -> dict:
+        """`summary` per value of a problem field (e.g. WebWalkerQA `level`)."""
+        if key not in self.groups:
+            return {}
+        labels = self.groups[key]
+        return {
+            str(label): self.subset(labels == label).summary(**kwargs)
+            for label in sorted({each for each in labels if each is not None}, key=str)
+        }
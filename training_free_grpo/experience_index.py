@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from utu.utils import EnvUtils
+from training_free_grpo.llm import AsyncLLM
+
+
+class AsyncEmbedder:
+    """Embeddings from an OpenAI-compatible endpoint, L2-normalized.
+
+    Configured by `UTU_EMBEDDING_MODEL` and optionally `UTU_EMBEDDING_BASE_URL` / `UTU_EMBEDDING_API_KEY`
+    (default: the LLM endpoint). Shares the keep-alive pool of `AsyncLLM` for the same endpoint.
+    """
+
+    def __init__(self, batch_size: int = 64, max_connections: int | None = None):
+        EnvUtils.assert_env(["UTU_EMBEDDING_MODEL"])
+        self.model_name = EnvUtils.get_env("UTU_EMBEDDING_MODEL")
+        self.batch_size = batch_size
+        if max_connections is None:
+            max_connections = int(os.getenv("UTU_LLM_MAX_CONNECTIONS", "100"))
+        self.client = AsyncLLM.get_client(
+            api_key=os.getenv("UTU_EMBEDDING_API_KEY") or EnvUtils.get_env("UTU_LLM_API_KEY"),
+            base_url=os.getenv("UTU_EMBEDDING_BASE_URL") or EnvUtils.get_env("UTU_LLM_BASE_URL"),
+            max_connections=max_connections,
+        )
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            response = await self.client.embeddings.create(model=self.model_name, input=texts[i : i + self.batch_size])
+            vectors.extend(each.embedding for each in sorted(response.data, key=lambda each: each.index))
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+        return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ExperienceIndex:
+    """Flat inner-product index over experience embeddings for top-k experience selection.
+
+    Embeddings are stored per experience text (content hash) in `{path}.npy` / `{path}.json`, so `update` only
+    embeds experiences that are new or were rewritten since the last step; the rows for the current experience
+    ids are gathered into one normalized matrix and searched with a single matrix product.
+    """
+
+    def __init__(self, path: str, embedder: AsyncEmbedder | None = None):
+        self.path = path
+        self.embedder = embedder or AsyncEmbedder()
+        self.ids = []
+        self.matrix = None
+        self._keys = []
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        if os.path.exists(path + ".json") and os.path.exists(path + ".npy"):
+            meta = json.load(open(path + ".json"))
+            if meta["model"] == self.embedder.model_name:
+                self._keys = meta["keys"]
+                self._vectors = np.load(path + ".npy")
+        self._key_to_row = {key: row for row, key in enumerate(self._keys)}
+
+    def _save(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        np.save(self.path + ".tmp.npy", self._vectors)
+        with open(self.path + ".json.tmp", "w") as f:
+            json.dump({"model": self.embedder.model_name, "keys": self._keys}, f)
+        os.replace(self.path + ".tmp.npy", self.path + ".npy")
+        os.replace(self.path + ".json.tmp", self.path + ".json")
+
+    async def update(self, experiences: dict) -> int:
+        """Point the index at `experiences`, embedding only unseen texts; returns the number of new embeddings."""
+        new_texts = {}
+        for text in experiences.values():
+            if text_key(text) not in self._key_to_row:
+                new_texts[text_key(text)] = text
+        new_texts = list(new_texts.items())
+        if new_texts:
+            vectors = await self.embedder.embed([text for _, text in new_texts])
+            self._vectors = vectors if len(self._keys) == 0 else np.concatenate([self._vectors, vectors])
+            for key, _ in new_texts:
+                self._key_to_row[key] = len(self._keys)
+                self._keys.append(key)
+            self._save()
+        self.ids = list(experiences.keys())
+        rows = [self._key_to_row[text_key(text)] for text in experiences.values()]
+        self.matrix = self._vectors[rows] if rows else None
+        return len(new_texts)
+
+    async def search(self, queries: list[str], k: int) -> list[list[str]]:
+        """Ids of the `k` most similar experiences for every query, most similar first."""
+        if self.matrix is None or k <= 0:
+            return [[] for _ in queries]
+        if k >= len(self.ids):
+            k = len(self.ids)
+        scores = (await self.embedder.embed(queries)) @ self.matrix.T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.take_along_axis(scores, top, axis=1).argsort(axis=1)[:, ::-1]
+        top = np.take_along_axis(top, order, axis=1)
+        return [[self.ids[i] for i in row] for row in top]
+
+    async def select(self, problems: list[str], experiences: dict, k: int) -> list[dict]:
+        """The top-k subset of `experiences` for every problem."""
+        await self.update(experiences)
+        return [{i: experiences[i] for i in ids} for ids in await self.search(problems, k)]
@@ -0,0 +1,169 @@
+"""Versioned experience library: one operation log plus periodic snapshots in a single SQLite file.
+
+Version `step` is the library injected at that step (step 0 is empty). Each committed version is stored as its
+add / modify / merge / delete operations against the previous version, and every `snapshot_every` steps as a full
+snapshot, so materializing any step reads one snapshot and at most `snapshot_every - 1` steps of operations.
+
+Export a version (e.g. for main.py --experience_file) or show what changed between two steps:
+    python -m training_free_grpo.experience_store --store data/math/train/exp/experiences.sqlite --step 3 --output exp.json
+    python -m training_free_grpo.experience_store --store data/math/train/exp/experiences.sqlite --step 3 --diff_from 1
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import time
+
+
+def assign_ids(experiences: dict, new_experiences: dict, merges: dict | None = None) -> tuple[dict, dict]:
+    """Give experiences that are not in `experiences` fresh IDs (G<n>, never reused); kept experiences keep theirs.
+
+    Stable IDs make consecutive versions differ only by what the batch update actually changed. `merges` maps
+    candidate IDs to the IDs they were merged from and is returned with the new IDs.
+    """
+    numbers = [int(m.group(1)) for m in (re.fullmatch(r"G(\d+)", str(k)) for k in experiences) if m]
+    next_id = max(numbers, default=-1) + 1
+    renamed, mapping = {}, {}
+    for key, experience in new_experiences.items():
+        if key not in experiences:
+            mapping[key] = f"G{next_id}"
+            next_id += 1
+        renamed[mapping.get(key, key)] = experience
+    merges = {
+        mapping[key]: [each for each in merged_from if each in experiences]
+        for key, merged_from in (merges or {}).items()
+        if key in mapping and mapping[key] in renamed
+    }
+    return renamed, merges
+
+
+def diff_operations(old: dict, new: dict, merges: dict | None = None) -> list[dict]:
+    """Operations turning `old` into `new`: deletes, then in-place modifies, then appended adds / merges."""
+    merges = merges or {}
+    merged_away = {each for merged_from in merges.values() for each in merged_from}
+    operations = [{"op": "delete", "id": key} for key in old if key not in new and key not in merged_away]
+    operations.extend(
+        {"op": "modify", "id": key, "experience": new[key]} for key in old if key in new and old[key] != new[key]
+    )
+    for key, experience in new.items():
+        if key in old:
+            continue
+        if key in merges:
+            operations.append({"op": "merge", "id": key, "experience": experience, "merged_from": merges[key]})
+        else:
+            operations.append({"op": "add", "id": key, "experience": experience})
+    return operations
+
+
+def apply_operations(experiences: dict, operations: list[dict]) -> dict:
+    for operation in operations:
+        if operation["op"] == "delete":
+            experiences.pop(operation["id"], None)
+        elif operation["op"] == "modify":
+            experiences[operation["id"]] = operation["experience"]
+        elif operation["op"] == "merge":
+            for key in operation["merged_from"]:
+                experiences.pop(key, None)
+            experiences[operation["id"]] = operation["experience"]
+        elif operation["op"] == "add":
+            experiences[operation["id"]] = operation["experience"]
+    return experiences
+
+
+class ExperienceStore:
+    def __init__(self, path: str, snapshot_every: int = 10):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS versions (step INTEGER PRIMARY KEY, size INTEGER NOT NULL, created REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS operations (step INTEGER NOT NULL, seq INTEGER NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (step, seq))"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS snapshots (step INTEGER PRIMARY KEY, state TEXT NOT NULL)")
+
+    def steps(self) -> list[int]:
+        return [row[0] for row in self._conn.execute("SELECT step FROM versions ORDER BY step")]
+
+    def has(self, step: int) -> bool:
+        return self._conn.execute("SELECT 1 FROM versions WHERE step = ?", (step,)).fetchone() is not None
+
+    def latest_step(self) -> int | None:
+        return self._conn.execute("SELECT MAX(step) FROM versions").fetchone()[0]
+
+    def operations(self, start: int, end: int) -> list[dict]:
+        """Logged operations of the versions after `start` up to and including `end`."""
+        rows = self._conn.execute(
+            "SELECT value FROM operations WHERE step > ? AND step <= ? ORDER BY step, seq", (start, end)
+        ).fetchall()
+        return [json.loads(value) for value, in rows]
+
+    def get(self, step: int) -> dict:
+        if step == 0 and not self.has(0):
+            return {}
+        if not self.has(step):
+            raise KeyError(f"No experiences stored for step {step} in {self.path}")
+        row = self._conn.execute(
+            "SELECT step, state FROM snapshots WHERE step <= ? ORDER BY step DESC LIMIT 1", (step,)
+        ).fetchone()
+        start, experiences = (row[0], json.loads(row[1])) if row is not None else (-1, {})
+        return apply_operations(experiences, self.operations(start, step))
+
+    def commit(self, step: int, experiences: dict, merges: dict | None = None) -> list[dict]:
+        """Store `experiences` as version `step` (replacing it if it exists); returns the logged operations."""
+        previous = self._conn.execute("SELECT MAX(step) FROM versions WHERE step < ?", (step,)).fetchone()[0]
+        base = self.get(previous) if previous is not None else {}
+        operations = diff_operations(base, experiences, merges)
+        # replaying appends new IDs at the end; snapshot a version whose order the log cannot reproduce
+        snapshot = (
+            step % self.snapshot_every == 0
+            or list(apply_operations(dict(base), operations).items()) != list(experiences.items())
+        )
+        self._conn.execute("BEGIN")
+        for table in ["versions", "operations", "snapshots"]:
+            self._conn.execute(f"DELETE FROM {table} WHERE step = ?", (step,))
+        self._conn.execute("INSERT INTO versions VALUES (?, ?, ?)", (step, len(experiences), time.time()))
+        self._conn.executemany(
+            "INSERT INTO operations VALUES (?, ?, ?)",
+            [(step, i, json.dumps(operation, ensure_ascii=False)) for i, operation in enumerate(operations)],
+        )
+        if snapshot:
+            self._conn.execute("INSERT INTO snapshots VALUES (?, ?)", (step, json.dumps(experiences, ensure_ascii=False)))
+        self._conn.execute("COMMIT")
+        return operations
+
+    def diff(self, start: int, end: int) -> dict:
+        """Experiences added, removed and modified (old, new) from version `start` to version `end`."""
+        old, new = self.get(start), self.get(end)
+        return {
+            "added": {key: value for key, value in new.items() if key not in old},
+            "removed": {key: value for key, value in old.items() if key not in new},
+            "modified": {key: [old[key], new[key]] for key in new if key in old and old[key] != new[key]},
+        }
+
+    def close(self):
+        self._conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export or diff versions of an experience store")
+    parser.add_argument("--store", type=str, required=True, help="Path of the experience store (experiences.sqlite)")
+    parser.add_argument("--step", type=int, default=None, help="Version to export (default: latest)")
+    parser.add_argument("--diff_from", type=int, default=None, help="Print the changes from this version to --step instead")
+    parser.add_argument("--output", type=str, default=None, help="Write the version to this JSON file (default: stdout)")
+
+    args = parser.parse_args()
+    store = ExperienceStore(args.store)
+    step = args.step if args.step is not None else store.latest_step()
+    result = store.diff(args.diff_from, step) if args.diff_from is not None else store.get(step)
+    if args.output:
+        json.dump(result, open(args.output, "w"), indent=2, ensure_ascii=False)
+        print(f"Saved step {step} of {args.store} to {args.output}")
+    else:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
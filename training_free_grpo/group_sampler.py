@@ -0,0 +1,114 @@
+from collections import defaultdict, deque
+
+
+def estimate_tokens(sample: dict) -> float:
+    """Rough token count (~4 characters per token) of a finished rollout's trajectory."""
+    if not sample.get("trajectories"):
+        return 0.0
+    return sum(len(str(message.get("content") or "")) for message in sample["trajectories"][0]["trajectory"]) / 4
+
+
+class AdaptiveGroupSampler:
+    """Roll out GRPO groups in waves and stop groups that will almost surely stay uniformly solved or failed.
+
+    With `only_partial_correct`, a group whose rewards are all 0 or all 1 is discarded by `ExperienceUpdater`, so
+    the rollouts spent on it are wasted. Each problem starts with `first_wave` rollouts; while its results are
+    uniform, the next wave of `wave_size` is only launched if the posterior probability that all remaining
+    rollouts give the same result, under a Beta(`prior_alpha`, `prior_beta`) prior on the problem's success
+    rate, is below `confidence`. Otherwise the remaining rollouts are skipped. As soon as a group is mixed, it is
+    already useful and all of its remaining rollouts are launched.
+
+    The default U-shaped prior encodes that most problems are either reliably solved or reliably failed by a given
+    model; with it and `confidence=0.8`, two agreeing rollouts are enough to stop a group of five.
+    """
+
+    def __init__(
+        self,
+        first_wave: int = 2,
+        wave_size: int = 1,
+        prior_alpha: float = 0.2,
+        prior_beta: float = 0.2,
+        confidence: float = 0.8,
+        usd_per_million_tokens: float = 0.0,
+    ):
+        self.first_wave = first_wave
+        self.wave_size = wave_size
+        self.prior_alpha = prior_alpha
+        self.prior_beta = prior_beta
+        self.confidence = confidence
+        self.usd_per_million_tokens = usd_per_million_tokens
+
+        self._rewards = defaultdict(list)
+        self._held = defaultdict(deque)
+        self._inflight = defaultdict(int)
+        self.num_stopped_groups = 0
+        self.num_skipped = 0
+        self.num_rollouts = 0
+        self.rollout_tokens = 0.0
+        self.expected_lost_partial_groups = 0.0
+
+    def p_uniform(self, rewards: list[float], num_remaining: int) -> float:
+        """Posterior probability that `num_remaining` more rollouts all repeat the (uniform) `rewards`."""
+        n = len(rewards)
+        # successes keep the group uniform with probability E[p^m], failures with E[(1-p)^m]
+        a, b = (self.prior_alpha, self.prior_beta) if rewards[0] >= 1 else (self.prior_beta, self.prior_alpha)
+        p = 1.0
+        for i in range(num_remaining):
+            p *= (a + n + i) / (a + b + n + i)
+        return p
+
+    def start(self, rollouts: list[dict], pending: list[dict]) -> tuple[list[dict], list[dict]]:
+        """Register finished `rollouts` and hold `pending` samples back; returns the samples to launch and to skip."""
+        for each in rollouts:
+            if each.get("trajectories"):
+                self._rewards[each["problem"]].append(each["reward"])
+        for sample in pending:
+            self._held[sample["problem"]].append(sample)
+        to_launch, to_skip = [], []
+        for problem in list(self._held):
+            launch, skip = self._next(problem, wave=self.first_wave - len(self._rewards[problem]))
+            to_launch.extend(launch)
+            to_skip.extend(skip)
+        return to_launch, to_skip
+
+    def on_result(self, sample: dict) -> tuple[list[dict], list[dict]]:
+        """Record a finished sample; returns the samples to launch and the samples to skip."""
+        problem = sample["problem"]
+        self._inflight[problem] -= 1
+        self._rewards[problem].append(sample.get("reward", 0))
+        self.num_rollouts += 1
+        self.rollout_tokens += estimate_tokens(sample)
+        return self._next(problem, wave=self.wave_size)
+
+    def _next(self, problem: str, wave: int) -> tuple[list[dict], list[dict]]:
+        held = self._held[problem]
+        rewards = self._rewards[problem]
+        if not held or self._inflight[problem] > 0:
+            # wait until the current wave is finished
+            return [], []
+        if rewards and min(rewards) != max(rewards):
+            # already partially correct: finish the group
+            wave = len(held)
+        elif rewards:
+            p_uniform = self.p_uniform(rewards, len(held))
+            if p_uniform >= self.confidence:
+                skipped = list(held)
+                held.clear()
+                self.num_stopped_groups += 1
+                self.num_skipped += len(skipped)
+                self.expected_lost_partial_groups += 1 - p_uniform
+                return [], skipped
+        launch = [held.popleft() for _ in range(min(max(wave, 1), len(held)))]
+        self._inflight[problem] += len(launch)
+        return launch, []
+
+    def stats(self) -> dict:
+        avg_tokens = self.rollout_tokens / self.num_rollouts if self.num_rollouts else 0.0
+        return {
+            "early_stopped_groups": self.num_stopped_groups,
+            "skipped_rollouts": self.num_skipped,
+            "est_tokens_saved": avg_tokens * self.num_skipped,
+            "est_usd_saved": avg_tokens * self.num_skipped * self.usd_per_million_tokens / 1e6,
+            # expected number of stopped groups that would have turned out partially correct (accuracy parity)
+            "expected_lost_partial_groups": self.expected_lost_partial_groups,
+        }
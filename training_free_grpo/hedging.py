@@ -0,0 +1,114 @@
+import asyncio
+import bisect
+import math
+import time
+
+from contextlib import nullcontext
+from typing import Awaitable, Callable
+
+
+class HedgePolicy:
+    """Speculative duplicate requests for long-tail rollouts.
+
+    A task still running after the `percentile` of the latencies observed so far (once `min_samples` are known)
+    gets a duplicate request; the first one to complete wins and the other is cancelled. At most `budget` (a
+    fraction of the tasks of a step, see `begin`) are hedged, which caps the extra cost. With a `controller`, the
+    duplicate holds a slot of its own, so hedging never pushes the in-flight requests past the AIMD limit.
+    Latencies are kept across steps; an original cancelled because its hedge won is recorded with the time it had
+    run so far (a censored lower bound), so the tail stays in the history instead of the percentile drifting down.
+    The time saved by a winning hedge is estimated from the observed latencies as E[L | L > t] - t, with t the time
+    the hedge finished after the start of the original request; as the tail is censored, rather a lower bound.
+    """
+
+    def __init__(self, percentile: float = 0.95, budget: float = 0.05, min_samples: int = 20, min_delay: float = 1.0):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self._latencies = []
+        self.begin(0)
+
+    def begin(self, num_tasks: int):
+        """Start a step of `num_tasks` tasks: reset the hedging budget and the per-step stats."""
+        self.max_hedges = math.ceil(self.budget * num_tasks)
+        self.num_hedged = 0
+        self.num_hedge_wins = 0
+        self.hedged_seconds = 0.0
+        self.saved_seconds = 0.0
+        self.abandoned_seconds = 0.0
+
+    def observe(self, latency: float):
+        bisect.insort(self._latencies, latency)
+
+    def delay(self) -> float | None:
+        """Seconds after which a running task is hedged; None until enough latencies are observed."""
+        if len(self._latencies) < self.min_samples:
+            return None
+        index = min(int(self.percentile * len(self._latencies)), len(self._latencies) - 1)
+        return max(self._latencies[index], self.min_delay)
+
+    def _expected_saving(self, elapsed: float) -> float:
+        tail = self._latencies[bisect.bisect_right(self._latencies, elapsed):]
+        return sum(tail) / len(tail) - elapsed if tail else 0.0
+
+    async def run(self, factory: Callable[[], Awaitable], controller=None):
+        """Await `factory()`, hedged with a second `factory()` call if it runs past `delay()`.
+
+        The caller holds the `controller` slot of the original; the duplicate waits for a slot of its own."""
+        start = time.time()
+        primary = asyncio.ensure_future(factory())
+        tasks = [primary]
+        try:
+            delay = self.delay()
+            if delay is not None and self.num_hedged < self.max_hedges:
+                done, _ = await asyncio.wait([primary], timeout=delay)
+                if not done and self.num_hedged < self.max_hedges:
+                    self.num_hedged += 1
+                    hedge_start = time.time()
+                    tasks.append(asyncio.ensure_future(self._in_slot(factory, controller)))
+                    result, winner = await self._first_success(tasks)
+                    self.hedged_seconds += time.time() - hedge_start
+                    if winner is tasks[1]:
+                        elapsed = time.time() - start
+                        self.num_hedge_wins += 1
+                        self.saved_seconds += self._expected_saving(elapsed)
+                        self.abandoned_seconds += elapsed
+                        # censored: the original would have taken at least this long
+                        self.observe(elapsed)
+                    else:
+                        self.observe(time.time() - start)
+                    return result
+            result = await primary
+            self.observe(time.time() - start)
+            return result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    async def _in_slot(factory: Callable[[], Awaitable], controller=None):
+        async with controller.slot() if controller is not None else nullcontext():
+            return await factory()
+
+    @staticmethod
+    async def _first_success(tasks: list[asyncio.Future]):
+        pending, error = set(tasks), None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), task
+                error = error or task.exception()
+        raise error
+
+    def stats(self) -> dict:
+        return {
+            "hedged_tasks": self.num_hedged,
+            "hedge_wins": self.num_hedge_wins,
+            # duplicate request time (the extra cost) vs. the estimated latency saved by winning hedges
+            "hedged_seconds": self.hedged_seconds,
+            "hedge_saved_seconds": self.saved_seconds,
+            # how long the cancelled original requests had been running, i.e. at least how long they would have taken
+            "hedge_abandoned_seconds": self.abandoned_seconds,
+            "hedge_delay": self.delay(),
+        }
@@ -0,0 +1,85 @@
+import json
+import os
+
+
+def load_rollouts(rollout_filename: str) -> list[dict]:
+    """Load the compacted rollout file and replay any journal records written after it."""
+    results = []
+    if os.path.exists(rollout_filename):
+        with open(rollout_filename, encoding="utf-8") as f:
+            for line in f:
+                results.append(json.loads(line))
+    return RolloutJournal(rollout_filename).replay(results)
+
+
+def save_rollouts(results: list[dict], rollout_filename: str):
+    """Atomically rewrite the whole rollout file."""
+    tmp_filename = rollout_filename + ".tmp"
+    with open(tmp_filename, "w", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, rollout_filename)
+
+
+class RolloutJournal:
+    """Append-only journal of finished rollouts.
+
+    `{rollout_filename}` keeps the last compacted snapshot, and every finished sample is appended as
+    one line to `{rollout_filename}.journal`. Replaying the journal on top of the snapshot rebuilds the
+    rollouts after a crash; `compact` folds the journal back into the snapshot.
+    """
+
+    def __init__(self, rollout_filename: str, fsync: bool = False):
+        self.rollout_filename = rollout_filename
+        self.journal_filename = rollout_filename + ".journal"
+        self.fsync = fsync
+        self.bytes_written = 0
+        self._file = None
+
+    def append(self, sample: dict):
+        if self._file is None:
+            self._file = open(self.journal_filename, "ab")
+        record = (json.dumps(sample, ensure_ascii=False) + "\n").encode("utf-8")
+        self._file.write(record)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.bytes_written += len(record)
+
+    def replay(self, rollouts: list[dict]) -> list[dict]:
+        """Apply journal records to `rollouts` (indexed by runid) and drop a torn trailing record."""
+        if not os.path.exists(self.journal_filename):
+            return rollouts
+        valid_size = 0
+        with open(self.journal_filename, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                valid_size += len(line)
+                runid = record.get("runid")
+                if runid is not None and 0 <= runid < len(rollouts):
+                    rollouts[runid] = record
+        # a crash in the middle of `append` leaves a partial line; cut it so new records start clean
+        if valid_size < os.path.getsize(self.journal_filename):
+            with open(self.journal_filename, "r+b") as f:
+                f.truncate(valid_size)
+        return rollouts
+
+    def compact(self, rollouts: list[dict]):
+        """Write `rollouts` as the new snapshot and drop the journal."""
+        self.close()
+        save_rollouts(rollouts, self.rollout_filename)
+        self.bytes_written += os.path.getsize(self.rollout_filename)
+        if os.path.exists(self.journal_filename):
+            os.remove(self.journal_filename)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -1,25 +1,58 @@
+import asyncio
+import os
 import time
+import httpx
 import openai
 from utu.utils import EnvUtils
+from training_free_grpo.cache import ResponseCache
+from training_free_grpo.concurrency import AdaptiveConcurrencyController, backoff_delay, get_retry_after, is_timeout
+from training_free_grpo.metrics import METRICS
+
+
+def to_messages(messages_or_prompt) -> list[dict]:
+    if isinstance(messages_or_prompt, str):
+        return [{"role": "user", "content": messages_or_prompt}]
+    elif isinstance(messages_or_prompt, list):
+        return messages_or_prompt
+    raise ValueError("messages_or_prompt must be a string or a list of messages.")
+
+
+def cache_key(model_name, messages_or_prompt, max_tokens, temperature, return_reasoning) -> str:
+    return ResponseCache.make_key(
+        model=model_name,
+        messages=to_messages(messages_or_prompt),
+        max_tokens=max_tokens,
+        temperature=temperature,
+        return_reasoning=return_reasoning,
+    )
+
 
 class LLM:
-    def __init__(self):
+    def __init__(self, cache: ResponseCache | None = None):
         EnvUtils.assert_env(["UTU_LLM_TYPE", "UTU_LLM_MODEL", "UTU_LLM_BASE_URL", "UTU_LLM_API_KEY"])
         self.model_name = EnvUtils.get_env("UTU_LLM_MODEL")
+        self.cache = cache
         self.client = openai.OpenAI(
             api_key=EnvUtils.get_env("UTU_LLM_API_KEY"),
             base_url=EnvUtils.get_env("UTU_LLM_BASE_URL"),
         )
 
-    def chat(self, messages_or_prompt, max_tokens=16384, temperature=0, max_retries=3, return_reasoning=False):
-        for _ in range(max_retries):
+    def chat(
+        self, messages_or_prompt, max_tokens=16384, temperature=0, max_retries=3, return_reasoning=False, refresh_cache=False
+    ):
+        # only deterministic (temperature=0) calls are cached; `refresh_cache` skips the lookup but stores the result
+        key = None
+        if self.cache is not None and temperature == 0:
+            key = cache_key(self.model_name, messages_or_prompt, max_tokens, temperature, return_reasoning)
+            cached = None if refresh_cache else self.cache.get(key)
+            if cached is not None:
+                METRICS.record(cache_hits=1)
+                return tuple(cached) if return_reasoning else cached
+
+        for attempt in range(max_retries):
+            start = time.perf_counter()
             try:
-                if isinstance(messages_or_prompt, str):
-                    messages = [{"role": "user", "content": messages_or_prompt}]
-                elif isinstance(messages_or_prompt, list):
-                    messages = messages_or_prompt
-                else:
-                    raise ValueError("messages_or_prompt must be a string or a list of messages.")
+                messages = to_messages(messages_or_prompt)
 
                 response = self.client.chat.completions.create(
                     model=self.model_name,
@@ -27,14 +60,152 @@ class LLM:
                     max_tokens=max_tokens,
                     temperature=temperature,
                 )
+                METRICS.record(calls=1, service_seconds=time.perf_counter() - start)
+                METRICS.record_usage(getattr(response, "usage", None))
                 response_text = response.choices[0].message.content.strip()
 
                 if return_reasoning:
                     reasoning = response.choices[0].message.reasoning_content
+                    if key is not None:
+                        self.cache.put(key, [response_text, reasoning])
                     return response_text, reasoning
+                if key is not None:
+                    self.cache.put(key, response_text)
                 return response_text
 
             except Exception as e:
                 error = f"An unexpected error occurred: {e}"
                 print(error)
-            time.sleep(10)
\ No newline at end of file
+                METRICS.record(
+                    calls=1,
+                    errors=1,
+                    timeouts=int(is_timeout(e)),
+                    retries=int(attempt < max_retries - 1),
+                    service_seconds=time.perf_counter() - start,
+                )
+                if attempt < max_retries - 1:
+                    time.sleep(backoff_delay(attempt, retry_after=get_retry_after(e)))
+
+
+class AsyncLLM:
+    """Async counterpart of `LLM` built on `openai.AsyncOpenAI`.
+
+    All instances pointing at the same endpoint share one client, i.e. one keep-alive connection pool
+    bounded by `max_connections` (default: `UTU_LLM_MAX_CONNECTIONS` or 100), so creating an `AsyncLLM`
+    per task is cheap and in-flight requests do not pin threads. If a `controller` is given, throttled and
+    timed-out attempts are reported to it so the shared concurrency limit backs off. Deterministic calls are served
+    from `cache` when one is given. Unlike `LLM.chat`, `chat` raises the last error once `max_retries` attempts
+    failed instead of returning None; callers that want a soft failure catch it.
+    """
+
+    _clients: dict[tuple, openai.AsyncOpenAI] = {}
+
+    def __init__(
+        self,
+        max_connections: int | None = None,
+        controller: AdaptiveConcurrencyController | None = None,
+        cache: ResponseCache | None = None,
+    ):
+        EnvUtils.assert_env(["UTU_LLM_TYPE", "UTU_LLM_MODEL", "UTU_LLM_BASE_URL", "UTU_LLM_API_KEY"])
+        self.model_name = EnvUtils.get_env("UTU_LLM_MODEL")
+        self.controller = controller
+        self.cache = cache
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        if max_connections is None:
+            max_connections = int(os.getenv("UTU_LLM_MAX_CONNECTIONS", "100"))
+        self.client = self.get_client(
+            api_key=EnvUtils.get_env("UTU_LLM_API_KEY"),
+            base_url=EnvUtils.get_env("UTU_LLM_BASE_URL"),
+            max_connections=max_connections,
+        )
+
+    @classmethod
+    def get_client(cls, api_key: str, base_url: str, max_connections: int) -> openai.AsyncOpenAI:
+        key = (base_url, api_key, max_connections)
+        if key not in cls._clients:
+            cls._clients[key] = openai.AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                # retries are handled in `chat` so that 429s reach the backoff and the controller
+                max_retries=0,
+                http_client=openai.DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                ),
+            )
+        return cls._clients[key]
+
+    @classmethod
+    async def aclose(cls):
+        """Close all shared clients, e.g. before the event loop shuts down."""
+        clients, cls._clients = list(cls._clients.values()), {}
+        for client in clients:
+            await client.close()
+
+    def _record_usage(self, response):
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        METRICS.record_usage(usage)
+        self.prompt_tokens += usage.prompt_tokens or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.cached_prompt_tokens += (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+
+    def usage_stats(self) -> dict:
+        """Prompt tokens sent so far and how many of them the server reported as served from its prefix cache."""
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "cached_prompt_tokens": self.cached_prompt_tokens,
+        }
+
+    async def chat(
+        self, messages_or_prompt, max_tokens=16384, temperature=0, max_retries=3, return_reasoning=False, refresh_cache=False
+    ):
+        key = None
+        if self.cache is not None and temperature == 0:
+            key = cache_key(self.model_name, messages_or_prompt, max_tokens, temperature, return_reasoning)
+            cached = None if refresh_cache else self.cache.get(key)
+            if cached is not None:
+                METRICS.record(cache_hits=1)
+                return tuple(cached) if return_reasoning else cached
+
+        for attempt in range(max_retries):
+            start = time.perf_counter()
+            try:
+                messages = to_messages(messages_or_prompt)
+
+                response = await self.client.chat.completions.create(
+                    model=self.model_name,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                )
+                METRICS.record(calls=1, service_seconds=time.perf_counter() - start)
+                self._record_usage(response)
+                response_text = response.choices[0].message.content.strip()
+
+                if return_reasoning:
+                    reasoning = response.choices[0].message.reasoning_content
+                    if key is not None:
+                        self.cache.put(key, [response_text, reasoning])
+                    return response_text, reasoning
+                if key is not None:
+                    self.cache.put(key, response_text)
+                return response_text
+
+            except Exception as e:
+                error = f"An unexpected error occurred: {e}"
+                print(error)
+                METRICS.record(
+                    calls=1,
+                    errors=1,
+                    timeouts=int(is_timeout(e)),
+                    retries=int(attempt < max_retries - 1),
+                    service_seconds=time.perf_counter() - start,
+                )
+                if self.controller is not None:
+                    self.controller.on_error(e)
+                if attempt < max_retries - 1:
+                    await asyncio.sleep(backoff_delay(attempt, retry_after=get_retry_after(e)))
+                else:
+                    raise
@@ -3,32 +3,44 @@ import json
 import argparse
 import asyncio
 import copy
+import inspect
 import time
 import traceback
 
+import numpy as np
 from tqdm import tqdm
-from collections import defaultdict
 
 from utu.agents import SimpleAgent
 from utu.config import ConfigLoader
 from utu.utils import AgentsUtils
 from utu.agents.common import TaskRecorder
-from training_free_grpo.llm import LLM
+from training_free_grpo.llm import AsyncLLM
+from training_free_grpo.cache import ResponseCache
+from training_free_grpo.concurrency import AdaptiveConcurrencyController, is_timeout
+from training_free_grpo.metrics import METRICS, stage_slot
+from training_free_grpo.journal import RolloutJournal, load_rollouts, save_rollouts
+from training_free_grpo.prompting import PromptBuilder, messages_to_prompt
+from training_free_grpo.experience_index import ExperienceIndex
+from training_free_grpo.group_sampler import AdaptiveGroupSampler
+from training_free_grpo.evaluation import RewardMatrix
+from training_free_grpo.scheduler import RolloutScheduler
+from training_free_grpo.hedging import HedgePolicy
 
 
-def load_rollouts(rollout_filename: str) -> list[dict]:
-    results = []
-    if os.path.exists(rollout_filename):
-        with open(rollout_filename, encoding="utf-8") as f:
-            for line in f:
-                results.append(json.loads(line))
-    return results
-
-
-def save_rollouts(results: list[dict], rollout_filename: str):
-    with open(rollout_filename, "w", encoding="utf-8") as f:
-        for result in results:
-            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+def compute_rollout_stats(rollouts: list[dict]) -> dict:
+    matrix = RewardMatrix.from_rollouts(rollouts, group_by=(), answer_func=None)
+    num_samples = matrix.num_samples
+    max_K = int(num_samples.max()) if len(num_samples) else 0
+    has_tool_calls = (~np.isnan(matrix.tool_calls)).any()
+    stats = {
+        "avg_reward": float(np.nanmean(matrix.rewards)) if num_samples.sum() else 0,
+        # naive Pass@k: any success among all samples of a problem
+        f"Pass@{max_K}": float((matrix.num_correct > 0).mean()) if len(num_samples) else 0,
+        "avg_tool_call": float(np.nanmean(matrix.tool_calls)) if has_tool_calls else 0,
+    }
+    # unbiased estimates for every k
+    stats.update({f"pass@{k}": v for k, v in matrix.pass_at_k().items()})
+    return stats
 
 
 async def rollout_dataset(
@@ -42,8 +54,25 @@ async def rollout_dataset(
     max_retries: int = 3,
     temperature: float = 0.3,
     max_tokens: int = 16384,
+    llm: AsyncLLM | None = None,
+    controller: AdaptiveConcurrencyController | None = None,
+    on_sample_done: callable = None,
+    group_sampler: AdaptiveGroupSampler | None = None,
+    hedge_policy: HedgePolicy | None = None,
 ) -> list[dict]:
-    """Rollout the dataset using the worker agent with concurrency control, timeout, error handling, and retries."""
+    """Rollout the dataset using the worker agent with concurrency control, timeout, error handling, and retries.
+
+    `rollout_concurrency` is the number of workers; if a `controller` is given, each task additionally holds one of
+    its slots, so the effective concurrency adapts (AIMD) to throttling, timeouts and latency below that ceiling.
+    `on_sample_done` is awaited with every finished sample, e.g. to stream groups into experience extraction.
+    `verify_func` may also be async (e.g. a `VerifierPool`), in which case its result is awaited.
+    With a `group_sampler`, the rollouts of each problem are launched in waves and groups that stay uniformly
+    solved/failed are stopped early; their remaining samples are recorded with `skipped=True` and no trajectories.
+    Retries and samples of already started groups are scheduled first (`RolloutScheduler`); on Ctrl+C the in-flight
+    samples are finished and journaled before `KeyboardInterrupt` is raised. With a `hedge_policy`, tasks running
+    past its latency percentile get a duplicate request (within its per-step budget, holding its own `controller`
+    slot) and the first to finish wins.
+    """
 
     # examine data and existing rollouts
     if len(rollouts) > 0:
@@ -58,124 +87,202 @@ async def rollout_dataset(
         for sample in data:
             assert "problem" in sample and "groundtruth" in sample
         rollouts = [{"runid": i, **sample} for i, sample in enumerate(data)]
-    save_rollouts(rollouts, rollout_filename)
+    journal = RolloutJournal(rollout_filename)
+    journal.compact(rollouts)
 
     # create task queue
-    task_queue = asyncio.Queue()
-    pending_tasks_count = 0
+    scheduler = RolloutScheduler()
+    pending = []
     for sample in rollouts:
-        if "trajectories" not in sample or len(sample["trajectories"]) == 0:
+        if ("trajectories" not in sample or len(sample["trajectories"]) == 0) and not sample.get("skipped"):
             sample_with_retry = copy.deepcopy(sample)
             sample_with_retry["retry_count"] = 0
-            await task_queue.put(sample_with_retry)
-            pending_tasks_count += 1
-    pbar = tqdm(total=pending_tasks_count, desc="Rolling out")
+            pending.append(sample_with_retry)
+    pbar = tqdm(total=len(pending), desc="Rolling out")
+
+    async def skip(samples: list[dict]):
+        for sample in samples:
+            sample.pop("retry_count", None)
+            sample.update({"trajectories": [], "skipped": True, "error": None})
+            rollouts[sample["runid"]] = sample
+            journal.append(sample)
+            pbar.update(1)
+            if on_sample_done is not None:
+                await on_sample_done(sample)
+
+    async def finish(sample: dict):
+        rollouts[sample["runid"]] = sample
+        journal.append(sample)
+        pbar.update(1)
+        if on_sample_done is not None:
+            await on_sample_done(sample)
+        if group_sampler is not None:
+            # queue the next wave before this task is marked done, so the queue cannot drain in between
+            launch, skipped = group_sampler.on_result(sample)
+            for each in launch:
+                await scheduler.put(each, RolloutScheduler.CONTINUATION)
+            await skip(skipped)
+
+    # the hedging budget is a fraction of all tasks of the step, not of the first wave of the group sampler
+    if hedge_policy is not None:
+        hedge_policy.begin(len(pending))
+    if group_sampler is not None:
+        pending, skipped = group_sampler.start(rollouts, pending)
+        await skip(skipped)
+    # samples of groups that are already partially finished (e.g. after a resume) go first
+    started = {each["problem"] for each in rollouts if each.get("trajectories") or each.get("skipped")}
+    for sample in pending:
+        await scheduler.put(
+            sample, RolloutScheduler.CONTINUATION if sample["problem"] in started else RolloutScheduler.FRESH
+        )
+
+    # one shared client (and connection pool) for all prompt-mode workers
+    if worker_agent is None and llm is None:
+        llm = AsyncLLM(controller=controller)
+    usage_start = llm.usage_stats() if llm is not None else None
+    # prompt-mode requests report each failed attempt to the controller themselves (`AsyncLLM.chat`)
+    llm_reports_errors = worker_agent is None and controller is not None and getattr(llm, "controller", None) is controller
+
+    def hedged(factory):
+        return hedge_policy.run(factory, controller) if hedge_policy is not None else factory()
 
     async def worker(name: str):
-        while not task_queue.empty():
-            sample = await task_queue.get()
-            task_start_time = time.time()
-            try:
-                if worker_agent is None:
-                    llm = LLM()
-                    coro = asyncio.to_thread(llm.chat, sample["prompt"], temperature=temperature, max_tokens=max_tokens)
-                    res = await asyncio.wait_for(coro, timeout=task_timeout)                    
-                    res = TaskRecorder(
-                            final_output=res,
-                            trajectories=[{
-                                "trajectory": [
-                                    {"role": "user", "content": sample["prompt"]},
-                                    {"role": "assistant", "content": res}
-                                ]
-                            }],
-                        )
-                else:
-                    async with worker_agent as agent:
-                        async def rollout_streamed(sample) -> TaskRecorder:
-                            prompt = sample.get("prompt", sample["problem"])
-                            res = agent.run_streamed(prompt)
-                            async for _ in res.stream_events(): pass
-                            traj = AgentsUtils.get_trajectory_from_agent_result(res)
-                            return TaskRecorder(
-                                final_output=res.final_output,
-                                trajectories=[traj],
+        # workers idle on an empty queue (retries and later waves are queued by running tasks) until cancelled
+        while True:
+            sample = await scheduler.get()
+            async with stage_slot("rollout", controller):
+                task_start_time = time.time()
+                try:
+                    if worker_agent is None:
+                        # prompts built by `PromptBuilder` carry `messages` with the shared prefix first
+                        messages = sample.get("messages", [{"role": "user", "content": sample["prompt"]}])
+                        request = lambda: llm.chat(messages, temperature=temperature, max_tokens=max_tokens)
+                        res = await asyncio.wait_for(hedged(request), timeout=task_timeout)
+                        res = TaskRecorder(
+                                final_output=res,
+                                trajectories=[{
+                                    "trajectory": messages + [
+                                        {"role": "assistant", "content": res}
+                                    ]
+                                }],
                             )
-                        res = await asyncio.wait_for(rollout_streamed(sample), timeout=task_timeout)
+                    else:
+                        async with worker_agent as agent:
+                            async def rollout_streamed(sample) -> TaskRecorder:
+                                if "messages" in sample:
+                                    prompt = messages_to_prompt(sample["messages"])
+                                else:
+                                    prompt = sample.get("prompt", sample["problem"])
+                                res = agent.run_streamed(prompt)
+                                try:
+                                    async for _ in res.stream_events(): pass
+                                except BaseException:
+                                    # on timeout/cancellation also stop the agent's background run and its requests
+                                    res.cancel()
+                                    raise
+                                # agent LLM calls bypass `AsyncLLM`; account for them from the run's raw responses
+                                for response in getattr(res, "raw_responses", None) or []:
+                                    METRICS.record(calls=1)
+                                    METRICS.record_usage(getattr(response, "usage", None))
+                                traj = AgentsUtils.get_trajectory_from_agent_result(res)
+                                return TaskRecorder(
+                                    final_output=res.final_output,
+                                    trajectories=[traj],
+                                )
+                            res = await asyncio.wait_for(hedged(lambda: rollout_streamed(sample)), timeout=task_timeout)
                 
-                task_end_time = time.time()
-                sample.update(
-                    {
-                        "response": res.final_output,
-                        "trajectories": res.trajectories,
-                        "error": None,
-                        "rollout_time": task_end_time - task_start_time,
-                    }
-                )
-                sample["reward"] = verify_func(sample, sample["groundtruth"])
-                
-                # Task succeeded
-                rollouts[sample["runid"]] = sample
-                save_rollouts(rollouts, rollout_filename)
-                pbar.update(1)
-
-            except Exception as e:
-                task_end_time = time.time()
-                sample["retry_count"] += 1
-                error_info = traceback.format_exc()
-                print(f"> error: {error_info}")
-                
-                if sample["retry_count"] <= max_retries:
-                    tqdm.write(f"Worker {name}: Task runid={sample['runid']} failed with {type(e).__name__}. Retrying ({sample['retry_count']}/{max_retries})...")
-                    await task_queue.put(sample) # Re-queue the task
-                else:
-                    tqdm.write(f"Worker {name}: Task runid={sample['runid']} failed after {max_retries} retries. Error: {e}. Traceback: {error_info}")
+                    task_end_time = time.time()
+                    if controller is not None:
+                        controller.on_success(task_end_time - task_start_time)
+                    if worker_agent is not None:
+                        METRICS.record(service_seconds=task_end_time - task_start_time)
                     sample.update(
                         {
-                            "response": f"Error: {str(e)} after {max_retries} retries.",
-                            "trajectories": [],
-                            "error": error_info,
-                            "reward": 0,
+                            "response": res.final_output,
+                            "trajectories": res.trajectories,
+                            "error": None,
                             "rollout_time": task_end_time - task_start_time,
                         }
                     )
+                    reward = verify_func(sample, sample["groundtruth"])
+                    if inspect.isawaitable(reward):
+                        reward = await reward
+                    sample["reward"] = reward
+                
+                    # Task succeeded
+                    await finish(sample)
+
+                except Exception as e:
+                    task_end_time = time.time()
+                    # report each failure once: here only the task timeout and errors the LLM did not see
+                    if controller is not None and not (llm_reports_errors and not isinstance(e, asyncio.TimeoutError)):
+                        controller.on_error(e)
+                    sample["retry_count"] += 1
+                    METRICS.record(timeouts=int(is_timeout(e)), retries=int(sample["retry_count"] <= max_retries))
+                    error_info = traceback.format_exc()
+                    print(f"> error: {error_info}")
+                
+                    if sample["retry_count"] <= max_retries:
+                        tqdm.write(f"Worker {name}: Task runid={sample['runid']} failed with {type(e).__name__}. Retrying ({sample['retry_count']}/{max_retries})...")
+                        await scheduler.put(sample, RolloutScheduler.RETRY) # Re-queue the task ahead of fresh ones
+                    else:
+                        tqdm.write(f"Worker {name}: Task runid={sample['runid']} failed after {max_retries} retries. Error: {e}. Traceback: {error_info}")
+                        sample.update(
+                            {
+                                "response": f"Error: {str(e)} after {max_retries} retries.",
+                                "trajectories": [],
+                                "error": error_info,
+                                "reward": 0,
+                                "rollout_time": task_end_time - task_start_time,
+                            }
+                        )
                     
-                    # Task failed permanently
-                    rollouts[sample["runid"]] = sample
-                    save_rollouts(rollouts, rollout_filename)
-                    pbar.update(1)
-            finally:
-                task_queue.task_done()
+                        # Task failed permanently
+                        await finish(sample)
+                finally:
+                    scheduler.task_done()
 
-    # run all tasks
+    # run all tasks; Ctrl+C drains the in-flight tasks and keeps the progress in the journal
     workers = [asyncio.create_task(worker(f"worker-{i}")) for i in range(rollout_concurrency)]
-    await task_queue.join()
-
-    # clean up
-    for w in workers:
-        w.cancel()
-    await asyncio.gather(*workers, return_exceptions=True)
-    pbar.close()
+    compact = True
+    try:
+        with scheduler.handle_sigint():
+            await scheduler.join()
+    except asyncio.CancelledError:
+        # e.g. a lost shard lease: another worker may be writing the journal now, so only close it
+        # (the journal alone is enough to resume)
+        compact = False
+        raise
+    finally:
+        # clean up, also when cancelled or interrupted: no worker outlives the rollout
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        pbar.close()
+        if compact:
+            journal.compact(rollouts)
+        else:
+            journal.close()
+    if scheduler.interrupted:
+        raise KeyboardInterrupt(f"Rollout interrupted, progress saved to {rollout_filename}")
     print(f"Successfully processed {len(rollouts)} samples.")
 
     # stats
-    all_rewards = []
-    problem_to_scores = defaultdict(list)
-    num_tool_calls = []
-    for rollout in rollouts:
-        all_rewards.append(rollout.get("reward", 0))
-        problem_to_scores[rollout["problem"]].append(rollout.get("reward", 0))
-        if "trajectories" in rollout and rollout["trajectories"]:
-            num_tool_calls.append(
-                len([each for each in rollout["trajectories"][0]["trajectory"] if each["role"] == "tool"])
-            )
-    problem_to_max_score = {problem: max(scores) for problem, scores in problem_to_scores.items()}
-    max_K = max((len(scores) for scores in problem_to_scores.values()), default=0)
-    stats = {
-        "avg_reward": sum(all_rewards) / len(all_rewards) if all_rewards else 0,
-        f"Pass@{max_K}": sum(max_reward > 0 for max_reward in problem_to_max_score.values()) / len(problem_to_max_score)
-        if problem_to_max_score else 0,
-        "avg_tool_call": sum(num_tool_calls) / len(num_tool_calls) if num_tool_calls else 0,
-    }
+    stats = compute_rollout_stats(rollouts)
+    if controller is not None:
+        stats.update(controller.stats())
+    if hasattr(verify_func, "stats"):
+        stats.update(verify_func.stats())
+    if group_sampler is not None:
+        stats.update(group_sampler.stats())
+    if hedge_policy is not None:
+        stats.update(hedge_policy.stats())
+    if usage_start is not None:
+        usage = {k: v - usage_start[k] for k, v in llm.usage_stats().items()}
+        stats.update(usage)
+        stats["prompt_cache_hit_ratio"] = (
+            usage["cached_prompt_tokens"] / usage["prompt_tokens"] if usage["prompt_tokens"] else 0
+        )
     for k, v in stats.items():
         print(f"- {k}: {v}")
     return rollouts, stats
@@ -185,13 +292,16 @@ async def main(args):
     # Set up domain-specific variables
     if args.domain == "math":
         from training_free_grpo.math.dataset import load_data
-        from training_free_grpo.math.verify import verify_func
-        from training_free_grpo.math.prompts import PROBLEM_WITH_EXPERIENCE_TEMPLATE
+        from training_free_grpo.math.verify import VerifierPool
+        from training_free_grpo.math.prompts import EXPERIENCE_PREFIX_TEMPLATE, PROBLEM_SUFFIX_TEMPLATE
+        verify_func = VerifierPool()
         config_name = "simple/math_agent.yaml"
     elif args.domain == "web":
         from training_free_grpo.web.dataset import load_data
-        from training_free_grpo.web.verify import verify_func
-        from training_free_grpo.web.prompts import PROBLEM_WITH_EXPERIENCE_TEMPLATE
+        from training_free_grpo.web.verify import JudgeService
+        from training_free_grpo.web.prompts import EXPERIENCE_PREFIX_TEMPLATE, PROBLEM_SUFFIX_TEMPLATE
+        # verdicts are shared across experiments: the same (problem, answer, response) always gets the same grade
+        verify_func = JudgeService(cache=ResponseCache("data/web/judge_cache.sqlite"))
         config_name = "simple/search_agent.yaml"
     else:
         raise ValueError(f"Unsupported domain: {args.domain}")
@@ -213,25 +323,24 @@ async def main(args):
         print(f"- truncated to {args.dataset_truncate}")
         test_data = test_data[: args.dataset_truncate]
     
-    # Insert experiences
+    # Insert experiences (as a shared prompt prefix) and duplicate for Pass@k evaluation
     if args.experience_file:
         experiences = json.load(open(args.experience_file))
-        formatted_experiences = "\n".join([ f"[{i}]. {e}" for i, e in experiences.items() ])
-        formatted_test_data = [{
-            "prompt": PROBLEM_WITH_EXPERIENCE_TEMPLATE.format(
-                experiences=formatted_experiences if formatted_experiences else "None",
-                problem=each["problem"],
-            ),
-            **each
-        } for each in test_data]
+        if args.experience_top_k is not None:
+            # inject only the most relevant experiences per problem instead of the whole library
+            experience_index = ExperienceIndex(os.path.splitext(args.experience_file)[0] + "_index")
+            experiences = await experience_index.select(
+                [each["problem"] for each in test_data], experiences, args.experience_top_k
+            )
+        prompt_builder = PromptBuilder(EXPERIENCE_PREFIX_TEMPLATE, PROBLEM_SUFFIX_TEMPLATE)
+        formatted_test_data = prompt_builder.format_data(test_data, experiences, num_repeats=args.pass_k)
+        print(f"Prompt prefix stats: {prompt_builder.stats()}")
     else:
         formatted_test_data = [{
             "prompt": each["problem"],
             **each
         } for each in test_data]
-    
-    # Duplicate for Pass@k evaluation
-    formatted_test_data = formatted_test_data * args.pass_k
+        formatted_test_data = formatted_test_data * args.pass_k
     print(f"Duplicated to {len(formatted_test_data)} records for Pass@{args.pass_k} evaluation")
 
     # Load existing rollouts
@@ -240,7 +349,7 @@ async def main(args):
     rollouts = load_rollouts(rollout_filename)
 
     # Rollout the dataset
-    await rollout_dataset(
+    rollouts, _ = await rollout_dataset(
         worker_agent=worker_agent,
         data=formatted_test_data,
         rollouts=rollouts,
@@ -249,8 +358,22 @@ async def main(args):
         rollout_concurrency=args.rollout_concurrency,
         task_timeout=args.task_timeout,
         max_tokens=args.rollout_max_tokens,
+        controller=AdaptiveConcurrencyController(max_concurrency=args.rollout_concurrency)
+        if args.adaptive_concurrency == "True" else None,
     )
 
+    # Unbiased Pass@k for all k, majority vote and per-level breakdown, with bootstrap confidence intervals
+    matrix = RewardMatrix.from_rollouts(rollouts)
+    metrics = {"overall": matrix.summary(), "by_level": matrix.breakdown("level")}
+    metrics_filename = f"data/{args.domain}/eval/{args.experiment_name}_metrics.json"
+    json.dump(metrics, open(metrics_filename, "w"), indent=2)
+    for k, v in metrics["overall"].items():
+        print(f"- {k}: {v}")
+    print(f"Saved evaluation metrics to {metrics_filename}")
+
+    if hasattr(verify_func, "close"):
+        verify_func.close()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Training-Free GRPO Evaluation")
@@ -260,7 +383,9 @@ if __name__ == "__main__":
     parser.add_argument("--dataset", type=str, required=True, help="Name of dataset")
     parser.add_argument("--dataset_truncate", type=int, default=None, help="Truncate dataset to first N samples")
     parser.add_argument("--experience_file", type=str, default=None)
+    parser.add_argument("--experience_top_k", type=int, default=None, help="Inject only the top-k most relevant experiences per problem (default: all)")
     parser.add_argument("--rollout_concurrency", type=int, default=5, help="Concurrency level for rollouts")
+    parser.add_argument("--adaptive_concurrency", type=str, default="True", help="Adapt concurrency below --rollout_concurrency on 429s/timeouts/latency (AIMD)")
     parser.add_argument("--rollout_max_tokens", type=int, default=16384, help="Max tokens for each rollout")
     parser.add_argument("--pass_k", type=int, default=1, help="Pass@k metric")
     parser.add_argument("--task_timeout", type=float, default=3600, help="Timeout for each individual task in seconds")
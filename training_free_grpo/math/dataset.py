@@ -2,10 +2,17 @@ import os
 import json
 import random
 from typing import List, Dict, Any
-from datasets import load_dataset
+from training_free_grpo.dataset_cache import ColumnarDataset, load_cached
 
 
-def load_data(name: str) -> List[Dict[str, Any]]:
+def load_data(name: str) -> ColumnarDataset:
+    """Problems of dataset `name`, memory-mapped from the Arrow cache in data/math/dataset (built on first use)."""
+    return load_cached(os.path.join("data/math/dataset", f"{name}.arrow"), lambda: build_data(name))
+
+
+def build_data(name: str) -> List[Dict[str, Any]]:
+    # imported here so that loading an already cached dataset does not pay for importing `datasets`
+    from datasets import load_dataset
 
     if name == "AIME24":    
         dataset = load_dataset("HuggingFaceH4/aime_2024", split="train")
@@ -1,11 +1,14 @@
+import asyncio
 import json
-import copy
 import os
 
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
-from training_free_grpo.llm import LLM
+from training_free_grpo.llm import AsyncLLM
+from training_free_grpo.concurrency import AdaptiveConcurrencyController
+from training_free_grpo.metrics import stage_slot
+from training_free_grpo.experience_store import assign_ids
+from training_free_grpo.revision_shards import shard_revision, cross_shard_clusters, revise_chain
 from training_free_grpo.math.prompts import (
     SINGLE_QUERY_CRITIQUE_TEMPLATE, 
     SINGLE_QUERY_CRITIQUE_NO_GT_TEMPLATE,
@@ -16,12 +19,26 @@ from training_free_grpo.math.prompts import (
 
 
 class ExperienceUpdater:
-    def __init__(self):
-        self.llm = LLM()
+    def __init__(
+        self,
+        llm: AsyncLLM | None = None,
+        controller: AdaptiveConcurrencyController | None = None,
+        batch_shard_size: int = 40,
+    ):
+        self.llm = llm or AsyncLLM()
+        # optional concurrency budget shared with the rollout workers
+        self.controller = controller
+        # max experiences + suggested updates revised in one batch-update call
+        self.batch_shard_size = batch_shard_size
+        # new experience ID -> IDs it was merged from, of the last `run`
+        self.merges = {}
+
+    def _slot(self, stage: str):
+        return stage_slot(stage, self.controller)
 
-    def run(self, rollouts, experiences, save_dir, max_workers=16, given_ground_truth=True, only_partial_correct=True):
+    async def run(self, rollouts, experiences, save_dir, max_workers=16, given_ground_truth=True, only_partial_correct=True):
         # 1. Summarize trajectory for each rollout
-        problem_to_summarized_rollouts = self._single_rollout_summary(
+        problem_to_summarized_rollouts = await self._single_rollout_summary(
             rollouts=rollouts, 
             save_dir=save_dir, 
             max_workers=max_workers,
@@ -30,7 +47,7 @@ class ExperienceUpdater:
         )
 
         # 2. Generate critique for each query
-        critiques = self._single_query_critique(
+        critiques = await self._single_query_critique(
             problem_to_summarized_rollouts=problem_to_summarized_rollouts, 
             experiences=experiences,
             save_dir=save_dir, 
@@ -40,20 +57,115 @@ class ExperienceUpdater:
         )
 
         # 3. batch update experiences
-        new_experiences = self._batch_update(
+        new_experiences = await self._batch_update(
             experiences=experiences, 
             critiques=critiques, 
             save_dir=save_dir
         )
 
-        # 4. assign new experience IDs
-        new_experiences = {
-            f"G{i}": exp for i, exp in enumerate(new_experiences.values())
-        }
+        # 4. assign IDs to new experiences; kept ones keep theirs, so consecutive versions differ only by the update
+        new_experiences, self.merges = assign_ids(experiences, new_experiences, self.merges)
         return new_experiences
 
+    async def process_group(self, rollouts_per_problem, experiences, given_ground_truth=True, only_partial_correct=True):
+        """Summarize and critique the finished rollouts of a single problem (streaming counterpart of steps 1-2)."""
+        rollouts_per_problem = [each for each in rollouts_per_problem if each.get("trajectories")]
+        if not rollouts_per_problem or not self._is_selected(rollouts_per_problem, given_ground_truth, only_partial_correct):
+            return {"summaries": [], "critique": None}
+        summaries = await asyncio.gather(*[
+            self._summarize_rollout(cur, given_ground_truth) for cur in rollouts_per_problem
+        ])
+        summaries = [each for each in summaries if each is not None]
+        critique = None
+        if summaries and self._is_selected(summaries, given_ground_truth, only_partial_correct):
+            critique = await self._critique_problem(summaries, experiences, given_ground_truth=given_ground_truth)
+        return {"summaries": summaries, "critique": critique}
+
+    def save_group_results(self, group_results, save_dir):
+        """Write `process_group` outputs in the format of the step 1-2 stage files, so `run` resumes from them."""
+        summaries = defaultdict(list)
+        critiques = []
+        for each in group_results:
+            for summary in each["summaries"]:
+                summaries[summary["problem"]].append(summary)
+            if each["critique"] is not None:
+                critiques.append(each["critique"])
+        with open(os.path.join(save_dir, "single_rollout_summary.json"), "w") as f:
+            json.dump(summaries, f, indent=2)
+        with open(os.path.join(save_dir, "single_query_critique.json"), "w") as f:
+            json.dump(critiques, f, indent=2)
+
+    @staticmethod
+    def _is_selected(rollouts_per_problem, given_ground_truth=True, only_partial_correct=True):
+        if given_ground_truth and only_partial_correct:
+            # only for those partially correct
+            scores = [each["reward"] for each in rollouts_per_problem]
+            avg_score = sum(scores) / len(scores)
+            return avg_score > 0 and avg_score < 1
+        return True
+
+    async def _summarize_rollout(self, cur, given_ground_truth=True, max_retries=3):
+        for attempt in range(max_retries):
+            try:
+                async with self._slot("summary"):
+                    response = await self.llm.chat(
+                        SINGLE_ROLLOUT_SUMMARY_TEMPLATE.format(
+                            trajectory=cur["trajectories"][0]["trajectory"], 
+                            grade="This trajectory delivers **" + ("correct" if cur["reward"] else "wrong") + "** answer", 
+                            answer=cur["groundtruth"]
+                        ) if given_ground_truth else
+                        SINGLE_ROLLOUT_SUMMARY_NO_GT_TEMPLATE.format(
+                            trajectory=cur["trajectories"][0]["trajectory"]
+                        ),
+                        # a cached empty reply would be replayed on every resume
+                        refresh_cache=attempt > 0,
+                    )
+                if not response:
+                    raise ValueError("empty summary")
+                return {"trajectory_summary": response, **cur}
+            except Exception as e:
+                print(f"Warning: failed in single rollout summary, {e}")
+        return None
+
+    async def _critique_problem(self, rollouts_per_problem, experiences, max_operations=1, given_ground_truth=True, max_retries=3):
+        for attempt in range(max_retries):
+            try:
+                problem = rollouts_per_problem[0]["problem"]
+                answer = rollouts_per_problem[0]["groundtruth"]
+                formatted_trajectories = "\n\n".join([
+                    f"Trajectory {i+1} (Answer {'correct' if each["reward"] else 'wrong'}):\n{each['trajectory_summary']}"
+                    for i, each in enumerate(rollouts_per_problem)
+                ])
+                formatted_experiences = "\n".join([ f"[{i}]. {e}" for i, e in experiences.items() ]) if experiences else "None"
+                async with self._slot("critique"):
+                    response = await self.llm.chat(
+                        SINGLE_QUERY_CRITIQUE_TEMPLATE.format(
+                            max_operations=max_operations,
+                            problem=problem,
+                            trajectories=formatted_trajectories,
+                            answer=answer,
+                            experiences=formatted_experiences,
+                        ) if given_ground_truth else
+                        SINGLE_QUERY_CRITIQUE_NO_GT_TEMPLATE.format(
+                            max_operations=max_operations,
+                            problem=problem,
+                            trajectories="\n\n".join([
+                                f"Trajectory {i+1}:\n{each['trajectory_summary']}" for i, each in enumerate(rollouts_per_problem)
+                            ]),
+                            experiences=formatted_experiences
+                        ),
+                        # a cached reply that failed to decode would fail again
+                        refresh_cache=attempt > 0,
+                    )
+                response = response.split("```json")[-1].split("```")[0]
+                operations = json.loads(response)
+                return {"rollouts": rollouts_per_problem, "critique": response, "operations": operations[:max_operations]}
+            except Exception as e:
+                print(f"Warning: failed in single query critique, {e}")
+        return None
+
 
-    def _single_rollout_summary(
+    async def _single_rollout_summary(
         self,
         rollouts, 
         save_dir, 
@@ -80,42 +192,22 @@ class ExperienceUpdater:
 
         all_rollouts_to_process = []
         for rollouts in problems_to_rollouts.values():
-            if given_ground_truth and only_partial_correct:
-                # only for those partially correct
-                scores = [each["reward"] for each in rollouts]
-                avg_score = sum(scores) / len(scores)
-                if avg_score > 0 and avg_score < 1:
-                    all_rollouts_to_process.extend(rollouts)
-            else:
+            if self._is_selected(rollouts, given_ground_truth, only_partial_correct):
                 all_rollouts_to_process.extend(rollouts)
 
-        def process(cur):
-            try:
-                response = self.llm.chat(
-                    SINGLE_ROLLOUT_SUMMARY_TEMPLATE.format(
-                        trajectory=cur["trajectories"][0]["trajectory"], 
-                        grade="This trajectory delivers **" + ("correct" if cur["reward"] else "wrong") + "** answer", 
-                        answer=cur["groundtruth"]
-                    ) if given_ground_truth else
-                    SINGLE_ROLLOUT_SUMMARY_NO_GT_TEMPLATE.format(
-                        trajectory=cur["trajectories"][0]["trajectory"]
-                    )
-                )
-                return {"trajectory_summary": response, **cur}
-            except Exception as e:
-                print(f"Warning: failed in single query critique, {e}")
-                return None
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def process(cur):
+            async with semaphore:
+                return await self._summarize_rollout(cur, given_ground_truth)
 
         # parallel running
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_rollout = {executor.submit(process, cur): cur for cur in all_rollouts_to_process}
-            for future in tqdm(
-                as_completed(future_to_rollout), total=len(all_rollouts_to_process), desc="Single rollout summary"
-            ):
-                result = future.result()
-                if result is not None:
-                    problem = result["problem"]
-                    results[problem].append(result)
+        tasks = [process(cur) for cur in all_rollouts_to_process]
+        for future in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Single rollout summary"):
+            result = await future
+            if result is not None:
+                problem = result["problem"]
+                results[problem].append(result)
 
         # write to file
         with open(filename, "w") as f:
@@ -123,7 +215,7 @@ class ExperienceUpdater:
         return results
 
 
-    def _single_query_critique(
+    async def _single_query_critique(
         self,
         problem_to_summarized_rollouts, 
         experiences, 
@@ -145,59 +237,24 @@ class ExperienceUpdater:
 
         all_rollouts = []
         for rollouts in problem_to_summarized_rollouts.values():
-            if given_ground_truth and only_partial_correct:
-                # only for those partially correct
-                scores = [each["reward"] for each in rollouts]
-                avg_score = sum(scores) / len(scores)
-                if avg_score > 0 and avg_score < 1:
-                    all_rollouts.append(rollouts)
-            else:
+            if self._is_selected(rollouts, given_ground_truth, only_partial_correct):
                 all_rollouts.append(rollouts)
 
-        def process(rollouts_per_problem):
-            try:
-                problem = rollouts_per_problem[0]["problem"]
-                answer = rollouts_per_problem[0]["groundtruth"]
-                formatted_trajectories = "\n\n".join([
-                    f"Trajectory {i+1} (Answer {'correct' if each["reward"] else 'wrong'}):\n{each['trajectory_summary']}"
-                    for i, each in enumerate(rollouts_per_problem)
-                ])
-                formatted_experiences = "\n".join([ f"[{i}]. {e}" for i, e in experiences.items() ]) if experiences else "None"
-                response = self.llm.chat(
-                    SINGLE_QUERY_CRITIQUE_TEMPLATE.format(
-                        max_operations=max_operations,
-                        problem=problem,
-                        trajectories=formatted_trajectories,
-                        answer=answer,
-                        experiences=formatted_experiences,
-                    ) if given_ground_truth else
-                    SINGLE_QUERY_CRITIQUE_NO_GT_TEMPLATE.format(
-                        max_operations=max_operations,
-                        problem=problem,
-                        trajectories="\n\n".join([
-                            f"Trajectory {i+1}:\n{each['trajectory_summary']}" for i, each in enumerate(rollouts_per_problem)
-                        ]),
-                        experiences=formatted_experiences
-                    )
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def process(rollouts_per_problem):
+            async with semaphore:
+                return await self._critique_problem(
+                    rollouts_per_problem, experiences, max_operations=max_operations, given_ground_truth=given_ground_truth
                 )
-                response = response.split("```json")[-1].split("```")[0]
-                operations = json.loads(response)
-                return {"rollouts": rollouts_per_problem, "critique": response, "operations": operations[:max_operations]}
-            except Exception as e:
-                print(f"Warning: failed in single query critique, {e}")
-                return None
 
         # parallel running
         results = []
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_case = {
-                executor.submit(process, rollouts_per_problem): rollouts_per_problem
-                for rollouts_per_problem in all_rollouts
-            }
-            for future in tqdm(as_completed(future_to_case), total=len(all_rollouts), desc="Single query critique"):
-                result = future.result()
-                if result is not None:
-                    results.append(result)
+        tasks = [process(rollouts_per_problem) for rollouts_per_problem in all_rollouts]
+        for future in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Single query critique"):
+            result = await future
+            if result is not None:
+                results.append(result)
 
         # write results
         with open(filename, "w") as f:
@@ -205,19 +262,72 @@ class ExperienceUpdater:
         return results
 
 
-    def _batch_update(
+    async def _revise(self, experiences, updates, max_retries=3):
+        """Revision plan (modify/merge) for one shard; operations referring to IDs outside the shard are dropped."""
+        response, revision_plan = None, []
+        for attempt in range(max_retries):
+            try:
+                async with self._slot("batch_update"):
+                    response = await self.llm.chat(
+                        BATCH_EXPERIENCE_UPDATE_TEMPLATE.format(
+                            experiences=experiences, 
+                            updates=updates
+                        ),
+                        # a cached reply that failed to decode would fail again
+                        refresh_cache=attempt > 0,
+                    )
+                revision_plan = json.loads(response.split("```json")[-1].split("```")[0])
+                break
+            except Exception:
+                print("Warning: failed to decode in updating general experiences")
+        valid_plan = []
+        for operation in revision_plan:
+            try:
+                ids = [operation["modified_from"]] if operation["option"] == "modify" else operation["merged_from"]
+                if operation["option"] in ["modify", "merge"] and all(ID in experiences for ID in ids):
+                    valid_plan.append(operation)
+                else:
+                    raise Exception("unknown option or ID outside of the shard")
+            except Exception as e:
+                print("Error: failed to complete experience update:", operation, "|", e)
+        return {"experience_ids": list(experiences), "response": response, "revision_plan": valid_plan}
+
+    def _apply_revision(self, new_experiences, revision_plan, merges, next_id):
+        """Apply a modify/merge plan in place; returns the IDs it wrote and the next free candidate number."""
+        written = []
+        for operation in revision_plan:
+            if operation["option"] == "modify":
+                if operation["modified_from"] in new_experiences:
+                    new_experiences[operation["modified_from"]] = operation["experience"]
+                    written.append(operation["modified_from"])
+            elif operation["option"] == "merge":
+                merged_from = [ID for ID in operation["merged_from"] if ID in new_experiences]
+                if len(merged_from) < 2:
+                    continue
+                for ID in merged_from:
+                    del new_experiences[ID]
+                new_experiences[f"C{next_id}"] = operation["experience"]
+                # merging an experience merged earlier in this update merges its sources
+                merges[f"C{next_id}"] = [source for ID in merged_from for source in merges.pop(ID, [ID])]
+                written.append(f"C{next_id}")
+                next_id += 1
+        return written, next_id
+
+    async def _batch_update(
         self,
         experiences, 
         critiques, 
         save_dir,
         max_retries=3
     ):
+        """Hierarchical batch update: shard revisions resolved in parallel, then a merge pass across shards."""
         print("Batch update")
         filename = os.path.join(save_dir, "batch_update.json")
         if os.path.exists(filename):
             results = json.load(open(filename))
             print("- File exists, loaded from:", filename)
-            return results
+            self.merges = results.get("merges", {})
+            return results["new_experiences"]
         
         # collect operations
         all_operations = []
@@ -226,7 +336,8 @@ class ExperienceUpdater:
         print("- Num of operations to process:", len(all_operations))
 
         # split experiences
-        candidate_experiences = copy.deepcopy(experiences)
+        # experiences are strings: a shallow copy is enough
+        candidate_experiences = dict(experiences)
         to_modify = []
         max_ID = 0
         for operation in all_operations:
@@ -241,38 +352,44 @@ class ExperienceUpdater:
         print("- Num of experiences to be modified:", len(to_modify))
         print("- Num of candidate experiences:", len(candidate_experiences))
 
-        # use LLM to get the revision plan
-        revision_plan = []
-        for _ in range(max_retries):
-            try:
-                response = self.llm.chat(
-                    BATCH_EXPERIENCE_UPDATE_TEMPLATE.format(
-                        experiences=candidate_experiences, 
-                        updates=to_modify
-                    )
-                )
-                revision_plan = json.loads(response.split("```json")[-1].split("```")[0])
-                break
-            except Exception:
-                print("Warning: failed to decode in updating general experiences")
+        # shard by target ID / similarity and get the revision plans of all shards in parallel
+        shards = shard_revision(
+            candidate_experiences,
+            to_modify,
+            active_ids={ID for ID in candidate_experiences if ID not in experiences},
+            target=lambda op: op["modified_from"],
+            content=lambda op: op["experience"],
+            max_shard_size=self.batch_shard_size,
+        )
+        print("- Num of shards:", sum(len(chain) for chain in shards))
+        shard_results = await asyncio.gather(*[
+            revise_chain(
+                chain,
+                lambda shard_experiences, shard_updates: self._revise(shard_experiences, shard_updates, max_retries),
+                # math revisions never delete: a merge needs two experiences, a chain shard holds one
+                lambda result: {
+                    op["modified_from"]: op["experience"] for op in result["revision_plan"] if op["option"] == "modify"
+                },
+            )
+            for chain in shards
+        ])
 
         # modify candidate experiences
-        new_experiences = copy.deepcopy(candidate_experiences)
-        for operation in revision_plan:
-            try:
-                if operation["option"] == "modify":
-                    new_experiences[operation["modified_from"]] = operation["experience"]
-                elif operation["option"] == "merge":
-                    for ID in operation["merged_from"]:
-                        if ID not in new_experiences:
-                            raise Exception(f"ID {ID} not found for merging")
-                    for ID in operation["merged_from"]:
-                        if ID in new_experiences:
-                            del new_experiences[ID]
-                    new_experiences[f"C{max_ID}"] = operation["experience"]
-                    max_ID += 1
-            except Exception as e:
-                print("Error: failed to complete experience update:", operation, "|", e)
+        new_experiences = dict(candidate_experiences)
+        merges = {}
+        changed = []
+        for i, result in enumerate(shard_results):
+            written, max_ID = self._apply_revision(new_experiences, result["revision_plan"], merges, max_ID)
+            changed.extend((i, ID) for ID in written + [ID for ID in result["experience_ids"] if ID not in experiences])
+
+        # merge pass: similar experiences revised in different shards could not see each other
+        changed = [(i, ID, new_experiences[ID]) for i, ID in dict.fromkeys(changed) if ID in new_experiences]
+        clusters = cross_shard_clusters(changed) if len(shards) > 1 else []
+        merge_results = await asyncio.gather(*[
+            self._revise({changed[j][1]: changed[j][2] for j in cluster}, [], max_retries) for cluster in clusters
+        ])
+        for result in merge_results:
+            _, max_ID = self._apply_revision(new_experiences, result["revision_plan"], merges, max_ID)
         print("- Num of revised candidate experiences:", len(new_experiences))
 
         # write to file
@@ -280,11 +397,13 @@ class ExperienceUpdater:
             json.dump(
                 {
                     "operations": all_operations,
-                    "response": response,
-                    "revision_plan": revision_plan,
+                    "shards": shard_results,
+                    "merge_pass": merge_results,
                     "new_experiences": new_experiences,
+                    "merges": merges,
                 },
                 f,
                 indent=2,
             )
-        return new_experiences
\ No newline at end of file
+        self.merges = merges
+        return new_experiences
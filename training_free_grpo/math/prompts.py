@@ -4,6 +4,14 @@ PROBLEM_WITH_EXPERIENCE_TEMPLATE = """Please solve the problem:
 When solving problems, you MUST first carefully read and understand the helpful instructions and experiences:
 {experiences}"""
 
+# Same content as PROBLEM_WITH_EXPERIENCE_TEMPLATE, split into a prefix shared by the whole batch and a per-problem
+# suffix, see training_free_grpo.prompting.PromptBuilder
+EXPERIENCE_PREFIX_TEMPLATE = """When solving problems, you MUST first carefully read and understand the helpful instructions and experiences:
+{experiences}"""
+
+PROBLEM_SUFFIX_TEMPLATE = """Please solve the problem:
+{problem}"""
+
 
 SINGLE_ROLLOUT_SUMMARY_TEMPLATE = """An agent system may be provided with some experiences, and then it produces the following trajectory to solve the given problem. Please summarize the trajectory step-by-step:
 
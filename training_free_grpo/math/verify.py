@@ -1,23 +1,235 @@
+import asyncio
+import multiprocessing
+import os
+
 from math_verify.errors import TimeoutException
 from math_verify.metric import math_metric
 from math_verify.parser import ExprExtractionConfig, LatexExtractionConfig
 
 
-def verify_func(sample: dict, ground_truth: str, timeout_score: float = 0) -> float:
-    model_output = sample["response"]
-    verify_func = math_metric(
-        gold_extraction_target=(LatexExtractionConfig(),),
-        pred_extraction_target=(ExprExtractionConfig(), LatexExtractionConfig()),
-    )
+# built lazily once per process (the main process or a `VerifierPool` worker)
+_metric = None
+
+
+def _get_metric():
+    global _metric
+    if _metric is None:
+        _metric = math_metric(
+            gold_extraction_target=(LatexExtractionConfig(),),
+            pred_extraction_target=(ExprExtractionConfig(), LatexExtractionConfig()),
+        )
+    return _metric
+
+
+def _score(model_output: str, ground_truth: str, timeout_score: float = 0) -> float:
     ret_score = 0.0
 
     # Wrap the ground truth in \boxed{} format for verification
     ground_truth_boxed = "\\boxed{" + str(ground_truth) + "}"
     try:
-        ret_score, _ = verify_func([ground_truth_boxed], [model_output])
-    except Exception:
-        pass
+        ret_score, _ = _get_metric()([ground_truth_boxed], [model_output])
     except TimeoutException:
         ret_score = timeout_score
+    except Exception:
+        pass
+
+    return float(ret_score)
+
+
+def _worker_loop(conn, timeout_score: float):
+    """Verifier process: score each received batch and send the scores back one item at a time."""
+    _get_metric()
+    conn.send(None)
+    while True:
+        try:
+            items = conn.recv()
+        except EOFError:
+            return
+        if items is None:
+            return
+        for model_output, ground_truth in items:
+            conn.send(_score(model_output, ground_truth, timeout_score))
+
+
+class _Worker:
+    def __init__(self, context, timeout_score: float):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_loop, args=(child_conn, timeout_score), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def wait_ready(self):
+        self.conn.recv()
+
+    def next_score(self, timeout: float) -> float | None:
+        """The score of the next item, or None if it does not arrive within `timeout` or the process died."""
+        try:
+            if self.conn.poll(timeout):
+                return self.conn.recv()
+        except (EOFError, OSError):
+            pass
+        return None
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self, timeout: float = 5.0):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+def verify_func(sample: dict, ground_truth: str, timeout_score: float = 0) -> float:
+    return _score(sample["response"], ground_truth, timeout_score)
+
+
+class VerifierPool:
+    """Verify math answers in worker processes so that sympy never blocks the event loop.
+
+    Drop-in async replacement for `verify_func`: `await pool(sample, ground_truth)`. Calls arriving within
+    `batch_wait` seconds are sent to a worker together (up to `batch_size`), and each worker builds the
+    extractors once. Workers send the score of every item as soon as it is computed, so each sample has its own
+    `timeout` deadline; a sample that misses it gets `timeout_score`. Since a worker stuck in sympy cannot be
+    interrupted, only that worker is killed and replaced, and the rest of its batch goes to another worker.
+    """
+
+    def __init__(
+        self,
+        max_workers: int | None = None,
+        timeout: float = 20.0,
+        timeout_score: float = 0.0,
+        batch_size: int = 16,
+        batch_wait: float = 0.005,
+    ):
+        self.max_workers = max_workers or min(8, os.cpu_count() or 1)
+        self.timeout = timeout
+        self.timeout_score = timeout_score
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+
+        # fork is unsafe with the event loop and client threads of the parent
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = set()
+        self._idle = asyncio.Queue()
+        self._pending = []
+        self._flush_handle = None
+        self._tasks = set()
+        self.num_timeouts = 0
+        self.num_restarts = 0
+
+    def _start(self) -> _Worker:
+        # registered right away, so the worker counts against `max_workers` while it starts up
+        worker = _Worker(self._context, self.timeout_score)
+        self._workers.add(worker)
+        return worker
+
+    async def _ready(self, worker: _Worker) -> _Worker:
+        try:
+            # keep the process start-up out of the per-sample deadline
+            await asyncio.to_thread(worker.wait_ready)
+        except BaseException:
+            self._workers.discard(worker)
+            worker.kill()
+            raise
+        return worker
+
+    async def _spawn(self) -> _Worker:
+        return await self._ready(self._start())
+
+    async def _replace(self, worker: _Worker):
+        self._idle.put_nowait(await self._ready(worker))
+
+    async def _acquire(self) -> _Worker:
+        if self._idle.empty() and len(self._workers) < self.max_workers:
+            return await self._spawn()
+        return await self._idle.get()
+
+    def _discard(self, worker: _Worker, restart: bool = True):
+        self._workers.discard(worker)
+        worker.kill()
+        if restart:
+            # start the replacement right away for the batches waiting for a worker
+            self.num_restarts += 1
+            task = asyncio.ensure_future(self._replace(self._start()))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def __call__(self, sample: dict, ground_truth: str) -> float:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((sample["response"], str(ground_truth), future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_wait, self._flush)
+        return await future
+
+    async def verify_many(self, samples: list[dict], ground_truths: list[str]) -> list[float]:
+        return list(await asyncio.gather(*[self(sample, gt) for sample, gt in zip(samples, ground_truths)]))
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: list[tuple]):
+        futures = [future for _, _, future in batch]
+        items = [(model_output, ground_truth) for model_output, ground_truth, _ in batch]
+        done, worker = 0, None
+        try:
+            while done < len(items):
+                # one batch per worker at a time, so the deadline does not include time queued behind other batches
+                worker = await self._acquire()
+                try:
+                    worker.conn.send(items[done:])
+                except (BrokenPipeError, OSError):
+                    self._discard(worker)
+                    worker = None
+                    continue
+                while done < len(items):
+                    score = await asyncio.to_thread(worker.next_score, self.timeout)
+                    if score is None:
+                        # hung (or crashed) on this item: give it the timeout score, replace the worker and
+                        # send the rest of the batch again
+                        self.num_timeouts += 1
+                        self._discard(worker)
+                        worker = None
+                        score = float(self.timeout_score)
+                    if not futures[done].done():
+                        futures[done].set_result(score)
+                    done += 1
+                    if worker is None:
+                        break
+                if worker is not None:
+                    self._idle.put_nowait(worker)
+                    worker = None
+        except BaseException as e:
+            if worker is not None:
+                # cancelled in the middle of a batch: the worker would still send its stale scores
+                self._discard(worker, restart=False)
+            for future in futures[done:]:
+                if not future.done():
+                    future.set_exception(e)
+            raise
+
+    def stats(self) -> dict:
+        return {"verify_timeouts": self.num_timeouts, "verify_pool_restarts": self.num_restarts}
 
-    return float(ret_score)
\ No newline at end of file
+    def close(self):
+        for worker in list(self._workers):
+            worker.stop()
+        self._workers.clear()
+        self._idle = asyncio.Queue()
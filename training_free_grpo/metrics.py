@@ -0,0 +1,124 @@
+import contextvars
+import os
+import time
+
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+
+
+# stage the current task is working for (rollout, summary, critique, group_update, batch_update, judge, ...);
+# asyncio tasks inherit it from the task that created them
+_STAGE = contextvars.ContextVar("stage", default="other")
+
+COUNTERS = {
+    "calls": "LLM requests, including failed attempts",
+    "errors": "LLM requests that raised",
+    "retries": "attempts repeated after an error",
+    "timeouts": "attempts that timed out",
+    "cache_hits": "calls served from the response cache",
+    "prompt_tokens": "prompt tokens sent",
+    "cached_prompt_tokens": "prompt tokens the server served from its prefix cache",
+    "completion_tokens": "completion tokens received",
+    "reasoning_tokens": "reasoning tokens received (part of completion tokens)",
+    "queue_wait_seconds": "seconds spent waiting for a concurrency slot",
+    "service_seconds": "seconds spent in LLM requests / agent runs",
+}
+
+
+def current_stage() -> str:
+    return _STAGE.get()
+
+
+@contextmanager
+def stage(name: str):
+    """Attribute the LLM calls made inside the block (and in tasks it creates) to `name`."""
+    token = _STAGE.set(name)
+    try:
+        yield
+    finally:
+        _STAGE.reset(token)
+
+
+def _get(obj, *names):
+    for name in names:
+        value = obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+        if value is not None:
+            return value
+    return None
+
+
+class MetricsRegistry:
+    """Process-wide counters of LLM usage and latency, aggregated per stage.
+
+    `snapshot` / `since` give the per-step deltas that train.py writes to stats.json; `to_prometheus` renders the
+    cumulative counters in the Prometheus text exposition format (e.g. for the node_exporter textfile collector).
+    """
+
+    def __init__(self):
+        self._stages = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+
+    def record(self, stage: str | None = None, **values):
+        counters = self._stages[stage or current_stage()]
+        for name, value in values.items():
+            counters[name] += value or 0
+
+    def record_usage(self, usage, stage: str | None = None):
+        """Record an OpenAI usage object (chat completions or responses API shape)."""
+        if usage is None:
+            return
+        prompt_details = _get(usage, "prompt_tokens_details", "input_tokens_details")
+        completion_details = _get(usage, "completion_tokens_details", "output_tokens_details")
+        self.record(
+            stage,
+            prompt_tokens=_get(usage, "prompt_tokens", "input_tokens"),
+            completion_tokens=_get(usage, "completion_tokens", "output_tokens"),
+            cached_prompt_tokens=_get(prompt_details, "cached_tokens") if prompt_details is not None else 0,
+            reasoning_tokens=_get(completion_details, "reasoning_tokens") if completion_details is not None else 0,
+        )
+
+    def snapshot(self) -> dict:
+        return {stage: dict(counters) for stage, counters in self._stages.items()}
+
+    def since(self, before: dict) -> dict:
+        """Per-stage counters accumulated after `before` (a `snapshot`), with derived averages and a total."""
+        delta = {}
+        for stage, counters in self._stages.items():
+            base = before.get(stage, {})
+            values = {name: value - base.get(name, 0) for name, value in counters.items()}
+            if any(values.values()):
+                delta[stage] = values
+        if delta:
+            delta["total"] = {name: sum(each[name] for each in delta.values()) for name in COUNTERS}
+        for values in delta.values():
+            values["avg_service_seconds"] = values["service_seconds"] / values["calls"] if values["calls"] else 0.0
+        return delta
+
+    def to_prometheus(self, prefix: str = "training_free_grpo") -> str:
+        lines = []
+        for name, help_text in COUNTERS.items():
+            metric = f"{prefix}_llm_{name}_total"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for stage, counters in sorted(self._stages.items()):
+                lines.append(f'{metric}{{stage="{stage}"}} {counters[name]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        # write-then-rename so that a scraper never reads a partial file
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+METRICS = MetricsRegistry()
+
+
+@asynccontextmanager
+async def stage_slot(name: str, controller=None):
+    """Enter stage `name` and hold a slot of `controller` (if any), recording the time spent waiting for it."""
+    with stage(name):
+        start = time.perf_counter()
+        async with controller.slot() if controller is not None else nullcontext():
+            METRICS.record(queue_wait_seconds=time.perf_counter() - start)
+            yield
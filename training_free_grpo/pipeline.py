@@ -0,0 +1,101 @@
+import asyncio
+import os
+import time
+
+from collections import Counter, defaultdict
+
+
+class StreamingExperiencePipeline:
+    """Overlap rollouts with experience extraction at problem-group granularity.
+
+    Pass `on_sample_done` to `rollout_dataset`: as soon as all rollouts of a problem are finished, the group is handed
+    to `ExperienceUpdater.process_group` (summaries + critique) while the remaining problems are still rolling out.
+    `finish` waits for the outstanding groups, writes the regular stage files and lets `ExperienceUpdater.run` do the
+    batch update from them. When the updater shares the rollout `controller`, all stages draw from one concurrency
+    budget.
+    """
+
+    def __init__(
+        self,
+        updater,
+        data: list[dict],
+        experiences: dict,
+        save_dir: str,
+        max_workers: int = 16,
+        given_ground_truth: bool = True,
+        only_partial_correct: bool = True,
+    ):
+        self.updater = updater
+        self.experiences = experiences
+        self.save_dir = save_dir
+        self.max_workers = max_workers
+        self.given_ground_truth = given_ground_truth
+        self.only_partial_correct = only_partial_correct
+        self.group_sizes = Counter(each["problem"] for each in data)
+        # a previous run already got past the summary stage; nothing left to stream
+        self.enabled = not os.path.exists(os.path.join(save_dir, "single_rollout_summary.json"))
+
+        self._finished = defaultdict(dict)
+        self._scheduled = set()
+        self._tasks = []
+        self._semaphore = asyncio.Semaphore(max_workers)
+        self.num_streamed_groups = 0
+        self.num_tail_groups = 0
+        self.tail_time = 0.0
+
+    async def on_sample_done(self, sample: dict):
+        if not self.enabled:
+            return
+        problem = sample["problem"]
+        self._finished[problem][sample["runid"]] = sample
+        if len(self._finished[problem]) == self.group_sizes[problem]:
+            self._schedule(problem, list(self._finished[problem].values()))
+            self.num_streamed_groups += 1
+
+    def _schedule(self, problem: str, rollouts_per_problem: list[dict]):
+        if problem in self._scheduled:
+            return
+        self._scheduled.add(problem)
+
+        async def process():
+            async with self._semaphore:
+                return await self.updater.process_group(
+                    rollouts_per_problem,
+                    self.experiences,
+                    given_ground_truth=self.given_ground_truth,
+                    only_partial_correct=self.only_partial_correct,
+                )
+
+        self._tasks.append(asyncio.create_task(process()))
+
+    async def finish(self, rollouts: list[dict]) -> dict:
+        """Process the remaining groups and run the batch update; returns the new experiences."""
+        start_time = time.time()
+        if self.enabled:
+            # groups finished in an earlier run of this step were never reported through `on_sample_done`
+            problem_to_rollouts = defaultdict(list)
+            for each in rollouts:
+                problem_to_rollouts[each["problem"]].append(each)
+            for problem, rollouts_per_problem in problem_to_rollouts.items():
+                if problem not in self._scheduled:
+                    self._schedule(problem, rollouts_per_problem)
+                    self.num_tail_groups += 1
+            group_results = await asyncio.gather(*self._tasks)
+            self.updater.save_group_results(group_results, self.save_dir)
+        self.tail_time = time.time() - start_time
+
+        return await self.updater.run(
+            rollouts=rollouts,
+            experiences=self.experiences,
+            save_dir=self.save_dir,
+            max_workers=self.max_workers,
+            given_ground_truth=self.given_ground_truth,
+            only_partial_correct=self.only_partial_correct,
+        )
+
+    def stats(self) -> dict:
+        return {
+            "streamed_groups": self.num_streamed_groups,
+            "tail_groups": self.num_tail_groups,
+            "tail_time": self.tail_time,
+        }
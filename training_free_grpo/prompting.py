@@ -0,0 +1,78 @@
+import hashlib
+
+
+def format_experiences(experiences: dict) -> str:
+    return "\n".join([f"[{i}]. {e}" for i, e in experiences.items()])
+
+
+def messages_to_prompt(messages: list[dict]) -> str:
+    """Flatten prefix/problem messages into one string (prefix first) for agents that take a single input."""
+    return "\n\n".join(message["content"] for message in messages)
+
+
+class PromptBuilder:
+    """Assemble experience-injected prompts as a stable prefix followed by the per-problem suffix.
+
+    The instructions and the experience block are identical for every sample of a step, so they are rendered
+    once per experience set and sent as the leading system message; only the user message with the problem
+    differs. Providers and servers with prefix caching (OpenAI prompt caching, vLLM/SGLang prefix caching) can
+    then reuse the prefix across the batch and its `grpo_n` / `pass_k` duplicates.
+
+    `stats` reports the share of prompt characters that repeat an already-sent prefix, i.e. the expected prefix
+    hit ratio; `AsyncLLM.usage_stats` reports what the server actually served from cache.
+    """
+
+    def __init__(self, prefix_template: str, problem_template: str):
+        self.prefix_template = prefix_template
+        self.problem_template = problem_template
+        self._prefixes = {}
+        self._sent_prefixes = set()
+        self.num_prompts = 0
+        self.prompt_chars = 0
+        self.prefix_hit_chars = 0
+
+    def get_prefix(self, experiences: dict) -> tuple[str, str]:
+        """Rendered prefix for `experiences` and its key, cached across calls."""
+        formatted_experiences = format_experiences(experiences)
+        key = hashlib.sha256(formatted_experiences.encode("utf-8")).hexdigest()
+        if key not in self._prefixes:
+            self._prefixes[key] = self.prefix_template.format(
+                experiences=formatted_experiences if formatted_experiences else "None"
+            )
+        return key, self._prefixes[key]
+
+    def build(self, problem: str, experiences: dict) -> list[dict]:
+        key, prefix = self.get_prefix(experiences)
+        suffix = self.problem_template.format(problem=problem)
+        self.num_prompts += 1
+        self.prompt_chars += len(prefix) + len(suffix)
+        if key in self._sent_prefixes:
+            self.prefix_hit_chars += len(prefix)
+        self._sent_prefixes.add(key)
+        return [
+            {"role": "system", "content": prefix},
+            {"role": "user", "content": suffix},
+        ]
+
+    def format_data(self, data: list[dict], experiences: dict | list[dict], num_repeats: int = 1) -> list[dict]:
+        """Attach `messages` to every sample and duplicate the data `num_repeats` times (GRPO / Pass@k).
+
+        `experiences` is either shared by all samples or one dict per sample (e.g. top-k selected experiences,
+        which only share a prefix between duplicates of the same problem).
+        """
+        if isinstance(experiences, dict):
+            experiences = [experiences] * len(data)
+        formatted_data = []
+        for _ in range(num_repeats):
+            formatted_data.extend(
+                {"messages": self.build(each["problem"], exps), **each} for each, exps in zip(data, experiences)
+            )
+        return formatted_data
+
+    def stats(self) -> dict:
+        return {
+            "num_prompts": self.num_prompts,
+            "num_prefixes": len(self._prefixes),
+            "avg_prompt_chars": self.prompt_chars / self.num_prompts if self.num_prompts else 0.0,
+            "prefix_hit_ratio": self.prefix_hit_chars / self.prompt_chars if self.prompt_chars else 0.0,
+        }
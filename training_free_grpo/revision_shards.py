@@ -0,0 +1,157 @@
+"""Sharding of the batch experience update into bounded, independent LLM calls.
+
+The batch update used to send every candidate experience and every suggested operation in one prompt. Here the
+experiences touched by the step (targets of operations, newly added candidates) and the operations without a
+target are clustered into shards by target ID and by similarity, and each shard gets at most `context_size` of
+the untouched experiences most similar to it, so that it can still merge with or deduplicate against the
+library. Every experience belongs to at most one chain of shards, so the revision plans never conflict and the
+chains can be resolved in parallel. An experience with more operations than fit in one shard is split into a chain:
+each shard of the chain holds a chunk of its operations and revises the text the previous shard produced. Similarity
+uses hashed bag-of-words vectors, which need no embedding service.
+"""
+import re
+import zlib
+
+from typing import Awaitable, Callable
+
+import numpy as np
+
+
+def text_vectors(texts: list[str], dim: int = 1024) -> np.ndarray:
+    """L2-normalized hashed bag-of-words vectors (a cheap lexical embedding)."""
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for i, text in enumerate(texts):
+        for token in re.findall(r"\w+", str(text).lower()):
+            vectors[i, zlib.crc32(token.encode("utf-8")) % dim] += 1
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def shard_revision(
+    experiences: dict,
+    operations: list[dict],
+    active_ids: set,
+    target: callable,
+    content: callable,
+    max_shard_size: int = 40,
+    context_size: int = 20,
+    min_similarity: float = 0.1,
+) -> list[list[tuple[dict, list[dict]]]]:
+    """Split a batch update into chains of (experiences, operations) shards of at most `max_shard_size` +
+    `context_size` items; the shards of a chain are revised one after the other (see `revise_chain`).
+
+    `active_ids` are the experiences that must be revised (e.g. new candidates); `target(op)` gives the experience
+    ID an operation refers to (or None) and `content(op)` its text. Small updates stay a single shard holding
+    everything, i.e. the unsharded prompt.
+    """
+    if len(experiences) + len(operations) <= max_shard_size + context_size:
+        return [[(dict(experiences), list(operations))]]
+
+    # units that must stay together: an experience with the operations targeting it, or an untargeted operation
+    by_target = {}
+    for operation in operations:
+        key = target(operation)
+        by_target.setdefault(key if key in experiences else None, []).append(operation)
+    units, chains = [], []
+    for key in experiences:
+        if key not in active_ids and key not in by_target:
+            continue
+        ops = by_target.get(key, [])
+        if 1 + len(ops) <= max_shard_size:
+            units.append(([key], ops))
+            continue
+        # too many operations on one experience for a single call: chain chunks of them
+        chunk_size = max(max_shard_size - 1, 1)
+        chains.append([({key: experiences[key]}, ops[i : i + chunk_size]) for i in range(0, len(ops), chunk_size)])
+    units.extend(([], [operation]) for operation in by_target.get(None, []))
+    if not units:
+        return chains
+    unit_vectors = text_vectors(
+        [" ".join([experiences[key] for key in ids] + [content(op) for op in ops]) for ids, ops in units]
+    )
+
+    # greedy clustering: seed a shard with the largest remaining unit, fill it with the most similar ones
+    remaining = sorted(range(len(units)), key=lambda i: -(len(units[i][0]) + len(units[i][1])))
+    shards, centroids = [], []
+    while remaining:
+        seed = remaining.pop(0)
+        members, size = [seed], len(units[seed][0]) + len(units[seed][1])
+        if remaining:
+            similarities = unit_vectors[remaining] @ unit_vectors[seed]
+            for j in np.argsort(-similarities, kind="stable"):
+                unit = units[remaining[j]]
+                if size + len(unit[0]) + len(unit[1]) > max_shard_size:
+                    continue
+                members.append(remaining[j])
+                size += len(unit[0]) + len(unit[1])
+            remaining = [i for i in remaining if i not in set(members)]
+        shards.append(([key for i in members for key in units[i][0]], [op for i in members for op in units[i][1]]))
+        centroid = unit_vectors[members].sum(axis=0)
+        centroids.append(centroid / max(np.linalg.norm(centroid), 1e-12))
+
+    # read-only-by-default context: each untouched experience goes to the shard it is most similar to, if any
+    untouched = [key for key in experiences if key not in active_ids and key not in by_target]
+    context = [[] for _ in shards]
+    if untouched:
+        similarities = text_vectors([experiences[key] for key in untouched]) @ np.stack(centroids).T
+        best = similarities.argmax(axis=1)
+        for i in np.argsort(-similarities.max(axis=1), kind="stable"):
+            if similarities[i, best[i]] >= min_similarity and len(context[best[i]]) < context_size:
+                context[best[i]].append(untouched[i])
+
+    return [
+        [({key: experiences[key] for key in ids + extra}, ops)]
+        for (ids, ops), extra in zip(shards, context)
+    ] + chains
+
+
+async def revise_chain(
+    chain: list[tuple[dict, list[dict]]],
+    revise: Callable[[dict, list[dict]], Awaitable[dict]],
+    revised: Callable[[dict], dict],
+) -> dict:
+    """Revise the shards of a chain in order and combine their results.
+
+    `revise(experiences, operations)` returns a result with a `revision_plan`; `revised(result)` maps the IDs it
+    rewrote to their new text (None when deleted), which the next shard of the chain revises instead of the original.
+    The combined plan is the concatenation of the shard plans, so applying it in order gives the final text.
+    """
+    if len(chain) == 1:
+        return await revise(*chain[0])
+    texts, results = {}, []
+    for experiences, operations in chain:
+        experiences = {key: texts.get(key, text) for key, text in experiences.items()}
+        if any(texts.get(key, "") is None for key in experiences):
+            # deleted by an earlier shard: the remaining operations are moot
+            break
+        result = await revise(experiences, operations)
+        results.append(result)
+        texts.update(revised(result))
+    return {
+        "experience_ids": list(dict.fromkeys(key for experiences, _ in chain for key in experiences)),
+        "response": [result["response"] for result in results],
+        "revision_plan": [plan for result in results for plan in result["revision_plan"]],
+    }
+
+
+def cross_shard_clusters(items: list[tuple[int, str, str]], threshold: float = 0.5, max_size: int = 20) -> list[list[int]]:
+    """Groups (indices into `items` = (shard, key, text)) of similar items coming from at least two shards.
+
+    These are the duplicates the shards could not see; the merge pass resolves each group in one small call.
+    """
+    if len(items) < 2:
+        return []
+    vectors = text_vectors([text for _, _, text in items])
+    similarities = vectors @ vectors.T
+    assigned, clusters = set(), []
+    for i in range(len(items)):
+        if i in assigned:
+            continue
+        members = [i] + [
+            j for j in np.argsort(-similarities[i], kind="stable")
+            if j != i and j not in assigned and similarities[i, j] >= threshold
+        ][: max_size - 1]
+        if len({items[j][0] for j in members}) >= 2:
+            clusters.append([int(j) for j in members])
+            assigned.update(members)
+    return clusters
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from collections import defaultdict
+
+
+# fields of a finished rollout that are reused; everything else (runid, prompt, ...) comes from the current step
+ROLLOUT_FIELDS = ["response", "trajectories", "error", "rollout_time", "reward"]
+
+
+def _hash(value) -> str:
+    payload = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RolloutStore:
+    """Finished rollouts of earlier steps, keyed by what determines their distribution.
+
+    The key hashes the problem, the exact prompt (i.e. the injected experience set) and the sampling config, so a
+    sample whose prompt did not change since an earlier step (e.g. the same problem in the next epoch with an
+    unchanged experience set) reuses a stored rollout instead of being rolled out again. Each stored rollout is
+    used at most once per group. With `off_policy_fraction > 0`, up to that fraction of each group may also be
+    filled with rollouts of the same problem made under a different prompt; they are marked `off_policy`.
+    """
+
+    def __init__(self, path: str, sampling_config: dict, off_policy_fraction: float = 0.0):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.sampling_config = sampling_config
+        self.off_policy_fraction = off_policy_fraction
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rollouts ("
+            "id INTEGER PRIMARY KEY, key TEXT NOT NULL, problem_key TEXT NOT NULL, step INTEGER NOT NULL, "
+            "value TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS rollouts_key ON rollouts (key)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS rollouts_problem_key ON rollouts (problem_key)")
+
+    def problem_key(self, sample: dict) -> str:
+        return _hash({"problem": sample["problem"], "sampling": self.sampling_config})
+
+    def key(self, sample: dict) -> str:
+        prompt = sample.get("messages", sample.get("prompt", sample["problem"]))
+        return _hash({"problem": sample["problem"], "prompt": prompt, "sampling": self.sampling_config})
+
+    def _lookup(self, column: str, value: str, exclude_step: int) -> list[tuple[int, dict]]:
+        rows = self._conn.execute(
+            f"SELECT id, value FROM rollouts WHERE {column} = ? AND step != ? ORDER BY step DESC, id",
+            (value, exclude_step),
+        ).fetchall()
+        return [(row_id, json.loads(stored)) for row_id, stored in rows]
+
+    def fill(self, rollouts: list[dict], step: int) -> dict:
+        """Fill unfinished samples of `rollouts` in place from stored rollouts of other steps; returns reuse stats."""
+        groups = defaultdict(list)
+        for sample in rollouts:
+            groups[sample["problem"]].append(sample)
+
+        num_pending = num_exact = num_off_policy = 0
+        for group in groups.values():
+            pending = [each for each in group if not each.get("trajectories") and not each.get("skipped")]
+            num_pending += len(pending)
+            if not pending:
+                continue
+            used = set()
+            # exact reuse: identical prompt and sampling config
+            for sample in pending:
+                for row_id, stored in self._lookup("key", self.key(sample), step):
+                    if row_id not in used:
+                        used.add(row_id)
+                        sample.update({field: stored.get(field) for field in ROLLOUT_FIELDS}, reused="exact")
+                        num_exact += 1
+                        break
+            # off-policy reuse: same problem under another experience set, up to a fraction of the group
+            budget = int(self.off_policy_fraction * len(group)) - sum(each.get("off_policy", False) for each in group)
+            candidates = [
+                (row_id, stored)
+                for row_id, stored in self._lookup("problem_key", self.problem_key(group[0]), step)
+                if row_id not in used
+            ]
+            for sample in pending:
+                if budget <= 0 or not candidates:
+                    break
+                if sample.get("reused"):
+                    continue
+                row_id, stored = candidates.pop(0)
+                used.add(row_id)
+                sample.update({field: stored.get(field) for field in ROLLOUT_FIELDS}, reused="off_policy", off_policy=True)
+                num_off_policy += 1
+                budget -= 1
+
+        return {
+            "pending": num_pending,
+            "reused_exact": num_exact,
+            "reused_off_policy": num_off_policy,
+            "reuse_rate": (num_exact + num_off_policy) / num_pending if num_pending else 0.0,
+        }
+
+    def add(self, rollouts: list[dict], step: int):
+        """Store the rollouts finished in `step` (reused, skipped and failed samples are not stored)."""
+        rows = []
+        for sample in rollouts:
+            if not sample.get("trajectories") or sample.get("reused") or sample.get("error"):
+                continue
+            rows.append(
+                (
+                    self.key(sample),
+                    self.problem_key(sample),
+                    step,
+                    json.dumps({field: sample.get(field) for field in ROLLOUT_FIELDS}, ensure_ascii=False),
+                    time.time(),
+                )
+            )
+        self._conn.execute("BEGIN")
+        # a resumed step stores its rollouts again; replace instead of duplicating them
+        self._conn.execute("DELETE FROM rollouts WHERE step = ?", (step,))
+        self._conn.executemany(
+            "INSERT INTO rollouts (key, problem_key, step, value, created) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        self._conn.execute("COMMIT")
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM rollouts").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
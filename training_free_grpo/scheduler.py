@@ -0,0 +1,78 @@
+import asyncio
+import itertools
+import signal
+
+from contextlib import contextmanager
+
+
+class RolloutScheduler:
+    """Priority task queue for the rollout workers, with a graceful drain on SIGINT.
+
+    Lower priorities run first: retries, then samples that complete a group already under way (later waves of
+    the group sampler, or groups partially finished before a resume), then fresh samples. Finishing started groups
+    first shortens the tail of a step and hands complete groups to the streaming pipeline sooner.
+
+    On the first SIGINT queued samples are dropped and only the in-flight ones are finished (and journaled); the
+    second SIGINT stops waiting for them as well. `interrupted` tells the caller to save progress and stop.
+    """
+
+    RETRY, CONTINUATION, FRESH = 0, 1, 2
+
+    def __init__(self):
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._stop = asyncio.Event()
+        self.interrupted = False
+
+    async def put(self, sample: dict, priority: int = FRESH):
+        if self.interrupted:
+            return
+        await self._queue.put((priority, next(self._seq), sample))
+
+    async def get(self) -> dict:
+        _, _, sample = await self._queue.get()
+        return sample
+
+    def task_done(self):
+        self._queue.task_done()
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    async def join(self):
+        """Wait until every queued sample is done, or until a second SIGINT."""
+        joined = asyncio.ensure_future(self._queue.join())
+        stopped = asyncio.ensure_future(self._stop.wait())
+        try:
+            await asyncio.wait([joined, stopped], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in [joined, stopped]:
+                task.cancel()
+
+    def interrupt(self):
+        if self.interrupted:
+            print("Interrupted again, abandoning in-flight samples")
+            self._stop.set()
+            return
+        self.interrupted = True
+        dropped = 0
+        while not self._queue.empty():
+            self._queue.get_nowait()
+            self._queue.task_done()
+            dropped += 1
+        print(f"Interrupted, finishing in-flight samples ({dropped} queued samples dropped; press Ctrl+C again to stop now)")
+
+    @contextmanager
+    def handle_sigint(self):
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGINT, self.interrupt)
+            installed = True
+        except (NotImplementedError, RuntimeError):
+            # no signal handlers outside the main thread / on Windows: keep the default KeyboardInterrupt
+            installed = False
+        try:
+            yield
+        finally:
+            if installed:
+                loop.remove_signal_handler(signal.SIGINT)
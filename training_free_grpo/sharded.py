@@ -0,0 +1,354 @@
+"""Sharded rollout execution over a SQLite work queue shared by several worker processes / hosts.
+
+The coordinator (`rollout_dataset_sharded`, used by train.py with `--shard_queue`) splits the unfinished samples
+of a step into shards. Workers claim shards as time-limited leases, renew them while rolling out, and write the
+results back. A shard whose lease expires (e.g. its worker crashed) is claimed again by another worker, which
+resumes from the shard's rollout journal. A shard that fails `max_attempts` times is marked failed instead of
+being retried forever; its samples are left unrolled. The coordinator merges finished shards into the step's
+rollout.jsonl.
+
+Start workers (any number, on any host that sees the queue file):
+    python -m training_free_grpo.sharded --queue data/math/train/shards.sqlite --worker_id host1-0
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+from training_free_grpo.journal import RolloutJournal, load_rollouts
+from training_free_grpo.main import compute_rollout_stats, rollout_dataset
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class ShardQueue:
+    """Jobs (one per rollout step) split into shards that workers lease; stored in one SQLite file."""
+
+    def __init__(self, path: str, max_attempts: int = 3):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_attempts = max_attempts
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, config TEXT NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS shards ("
+            "job_id TEXT NOT NULL, shard_id INTEGER NOT NULL, samples TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', owner TEXT, lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "result TEXT, PRIMARY KEY (job_id, shard_id))"
+        )
+
+    @property
+    def shard_dir(self) -> str:
+        """Per-shard rollout journals, next to the queue file, so a re-claimed shard resumes where it stopped."""
+        return os.path.splitext(self.path)[0] + "_shards"
+
+    def submit(self, job_id: str, config: dict, samples: list[dict], shard_size: int) -> bool:
+        """Create the job unless it exists (a resumed coordinator keeps the existing shards and retries the failed
+        ones); True if created."""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self._conn.execute("SELECT 1 FROM jobs WHERE job_id = ?", (job_id,)).fetchone():
+                self._conn.execute(
+                    "UPDATE shards SET status = 'pending', attempts = 0 WHERE job_id = ? AND status = 'failed'", (job_id,)
+                )
+                self._conn.execute("COMMIT")
+                return False
+            self._conn.execute("INSERT INTO jobs (job_id, config) VALUES (?, ?)", (job_id, json.dumps(config)))
+            self._conn.executemany(
+                "INSERT INTO shards (job_id, shard_id, samples) VALUES (?, ?, ?)",
+                [
+                    (job_id, i, json.dumps(samples[start : start + shard_size], ensure_ascii=False))
+                    for i, start in enumerate(range(0, len(samples), shard_size))
+                ],
+            )
+            self._conn.execute("COMMIT")
+            return True
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def claim(self, owner: str, lease_ttl: float) -> dict | None:
+        """Lease a pending shard, or one whose lease expired; None if there is nothing to do right now."""
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            # an expired lease that already used up its attempts (e.g. the shard crashes its workers) is given up
+            self._conn.execute(
+                "UPDATE shards SET status = 'failed', owner = NULL, lease_expires = NULL "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            row = self._conn.execute(
+                "SELECT job_id, shard_id, samples, attempts FROM shards "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY status = 'leased', job_id, shard_id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                self._conn.execute("COMMIT")
+                return None
+            job_id, shard_id, samples, attempts = row
+            self._conn.execute(
+                "UPDATE shards SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE job_id = ? AND shard_id = ?",
+                (owner, now + lease_ttl, job_id, shard_id),
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return {"job_id": job_id, "shard_id": shard_id, "samples": json.loads(samples), "attempts": attempts + 1}
+
+    def renew(self, job_id: str, shard_id: int, owner: str, lease_ttl: float):
+        cursor = self._conn.execute(
+            "UPDATE shards SET lease_expires = ? WHERE job_id = ? AND shard_id = ? AND owner = ? AND status = 'leased'",
+            (time.time() + lease_ttl, job_id, shard_id, owner),
+        )
+        if cursor.rowcount == 0:
+            raise LeaseLost(f"lease on shard {job_id}/{shard_id} was taken over")
+
+    def complete(self, job_id: str, shard_id: int, owner: str, results: list[dict]):
+        cursor = self._conn.execute(
+            "UPDATE shards SET status = 'done', result = ?, lease_expires = NULL "
+            "WHERE job_id = ? AND shard_id = ? AND owner = ? AND status = 'leased'",
+            (json.dumps(results, ensure_ascii=False), job_id, shard_id, owner),
+        )
+        if cursor.rowcount == 0:
+            raise LeaseLost(f"lease on shard {job_id}/{shard_id} was taken over")
+
+    def release(self, job_id: str, shard_id: int, owner: str) -> bool:
+        """Give a shard back after a failure so that another worker can pick it up immediately, or mark it failed
+        once it used up `max_attempts`; True if it was marked failed."""
+        self._conn.execute(
+            "UPDATE shards SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "owner = NULL, lease_expires = NULL "
+            "WHERE job_id = ? AND shard_id = ? AND owner = ? AND status = 'leased'",
+            (self.max_attempts, job_id, shard_id, owner),
+        )
+        row = self._conn.execute(
+            "SELECT status FROM shards WHERE job_id = ? AND shard_id = ?", (job_id, shard_id)
+        ).fetchone()
+        return row is not None and row[0] == "failed"
+
+    def job_config(self, job_id: str) -> dict:
+        return json.loads(self._conn.execute("SELECT config FROM jobs WHERE job_id = ?", (job_id,)).fetchone()[0])
+
+    def finished_shards(self, job_id: str, exclude: set) -> list[tuple[int, list[dict]]]:
+        rows = self._conn.execute(
+            "SELECT shard_id, result FROM shards WHERE job_id = ? AND status = 'done'", (job_id,)
+        ).fetchall()
+        return [(shard_id, json.loads(result)) for shard_id, result in rows if shard_id not in exclude]
+
+    def progress(self, job_id: str) -> dict:
+        rows = self._conn.execute(
+            "SELECT status, COUNT(*), SUM(attempts) FROM shards WHERE job_id = ? GROUP BY status", (job_id,)
+        ).fetchall()
+        progress = {"pending": 0, "leased": 0, "done": 0, "failed": 0, "attempts": 0}
+        for status, count, attempts in rows:
+            progress[status] = count
+            progress["attempts"] += attempts or 0
+        return progress
+
+    def close(self):
+        self._conn.close()
+
+
+async def rollout_dataset_sharded(
+    data: list[dict],
+    rollouts: list[dict],
+    rollout_filename: str,
+    queue_path: str,
+    job_id: str,
+    job_config: dict,
+    shard_size: int = 8,
+    poll_interval: float = 2.0,
+    num_local_workers: int = 0,
+    on_sample_done: callable = None,
+) -> tuple[list[dict], dict]:
+    """Coordinator counterpart of `rollout_dataset`: farm the unfinished samples out to shard workers.
+
+    `job_config` tells the workers how to roll out (domain, mode, config_name, rollout_concurrency, task_timeout,
+    temperature, max_tokens). With `num_local_workers`, that many worker processes are started on this machine.
+    """
+    if not rollouts:
+        rollouts = [{"runid": i, **sample} for i, sample in enumerate(data)]
+    journal = RolloutJournal(rollout_filename)
+    journal.compact(rollouts)
+
+    queue = ShardQueue(queue_path)
+    pending = [each for each in rollouts if not each.get("trajectories") and not each.get("skipped")]
+    if queue.submit(job_id, job_config, pending, shard_size):
+        print(f"Submitted {len(pending)} samples as job {job_id} to {queue_path}")
+
+    procs = [
+        subprocess.Popen(
+            [sys.executable, "-m", "training_free_grpo.sharded", "--queue", queue_path,
+             "--worker_id", f"{socket.gethostname()}-{os.getpid()}-local{i}", "--idle_exit", str(max(30.0, poll_interval * 5))]
+        )
+        for i in range(num_local_workers)
+    ]
+
+    merged = set()
+
+    async def merge_finished():
+        for shard_id, results in queue.finished_shards(job_id, exclude=merged):
+            for sample in results:
+                rollouts[sample["runid"]] = sample
+                journal.append(sample)
+                if on_sample_done is not None:
+                    await on_sample_done(sample)
+            merged.add(shard_id)
+
+    try:
+        while True:
+            await merge_finished()
+            progress = queue.progress(job_id)
+            if progress["pending"] == 0 and progress["leased"] == 0:
+                break
+            await asyncio.sleep(poll_interval)
+        # a shard may have finished between the merge and the progress query
+        await merge_finished()
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+    journal.compact(rollouts)
+    if progress["failed"]:
+        print(f"Warning: {progress['failed']} shards of job {job_id} failed {queue.max_attempts} times, "
+              f"their samples were not rolled out (rerun the step to retry them)")
+
+    stats = compute_rollout_stats(rollouts)
+    stats.update({"num_shards": progress["done"], "failed_shards": progress["failed"], "shard_attempts": progress["attempts"]})
+    queue.close()
+    return rollouts, stats
+
+
+async def build_worker_env(job_config: dict) -> tuple:
+    """(worker_agent, verify_func) for a job; mirrors the domain setup of main.py / train.py."""
+    if job_config["domain"] == "math":
+        from training_free_grpo.math.verify import VerifierPool
+        verify_func = VerifierPool()
+    elif job_config["domain"] == "web":
+        from training_free_grpo.cache import ResponseCache
+        from training_free_grpo.web.verify import JudgeService
+        verify_func = JudgeService(cache=ResponseCache("data/web/judge_cache.sqlite"))
+    else:
+        raise ValueError(f"Unsupported domain: {job_config['domain']}")
+
+    if job_config["mode"] == "prompt":
+        worker_agent = None
+    elif job_config["mode"] == "agent":
+        from utu.agents import SimpleAgent
+        from utu.config import ConfigLoader
+        config = ConfigLoader.load_agent_config(job_config["config_name"])
+        config.model.model_settings.temperature = job_config["temperature"]
+        worker_agent = SimpleAgent(config=config)
+        await worker_agent.build()
+    else:
+        raise ValueError(f"Unsupported inference mode: {job_config['mode']}")
+    return worker_agent, verify_func
+
+
+async def run_shard(queue: ShardQueue, shard: dict, owner: str, env: tuple, job_config: dict, lease_ttl: float) -> list[dict]:
+    worker_agent, verify_func = env
+    # runids are global; rollout_dataset numbers the shard locally
+    runids = [each["runid"] for each in shard["samples"]]
+    data = [{k: v for k, v in each.items() if k != "runid"} for each in shard["samples"]]
+    os.makedirs(queue.shard_dir, exist_ok=True)
+    # job ids look like "<experiment>/step_<n>": keep the journal directly in shard_dir
+    job_name = shard["job_id"].replace("/", "_").replace(os.sep, "_")
+    shard_filename = os.path.join(queue.shard_dir, f"{job_name}_{shard['shard_id']}.jsonl")
+    rollouts = load_rollouts(shard_filename)
+
+    async def renew():
+        while True:
+            await asyncio.sleep(lease_ttl / 3)
+            queue.renew(shard["job_id"], shard["shard_id"], owner, lease_ttl)
+
+    work = asyncio.ensure_future(
+        rollout_dataset(
+            worker_agent=worker_agent,
+            data=data,
+            rollouts=rollouts,
+            rollout_filename=shard_filename,
+            verify_func=verify_func,
+            rollout_concurrency=job_config.get("rollout_concurrency", 5),
+            task_timeout=job_config.get("task_timeout", 3600),
+            temperature=job_config.get("temperature", 0.3),
+            max_tokens=job_config.get("max_tokens", 16384),
+        )
+    )
+    renewer = asyncio.ensure_future(renew())
+    done, _ = await asyncio.wait([work, renewer], return_when=asyncio.FIRST_COMPLETED)
+    if work not in done:
+        # the renewer only finishes by raising, i.e. the lease was lost
+        work.cancel()
+        await asyncio.gather(work, return_exceptions=True)
+        renewer.result()
+    renewer.cancel()
+    await asyncio.gather(renewer, return_exceptions=True)
+    results, _ = work.result()
+    return [{**each, "runid": runid} for each, runid in zip(results, runids)]
+
+
+async def run_worker(
+    queue_path: str,
+    worker_id: str,
+    lease_ttl: float = 120.0,
+    poll_interval: float = 2.0,
+    idle_exit: float | None = None,
+    max_attempts: int = 3,
+):
+    queue = ShardQueue(queue_path, max_attempts=max_attempts)
+    envs = {}
+    idle_since = time.time()
+    while True:
+        shard = queue.claim(worker_id, lease_ttl)
+        if shard is None:
+            if idle_exit is not None and time.time() - idle_since > idle_exit:
+                break
+            await asyncio.sleep(poll_interval)
+            continue
+
+        print(f"Worker {worker_id}: shard {shard['job_id']}/{shard['shard_id']} (attempt {shard['attempts']})")
+        job_config = queue.job_config(shard["job_id"])
+        env_key = (job_config["domain"], job_config["mode"], job_config.get("config_name"), job_config.get("temperature"))
+        if env_key not in envs:
+            envs[env_key] = await build_worker_env(job_config)
+        try:
+            results = await run_shard(queue, shard, worker_id, envs[env_key], job_config, lease_ttl)
+            queue.complete(shard["job_id"], shard["shard_id"], worker_id, results)
+        except LeaseLost as e:
+            print(f"Worker {worker_id}: {e}")
+        except Exception as e:
+            print(f"Worker {worker_id}: shard {shard['job_id']}/{shard['shard_id']} failed, {e}")
+            if queue.release(shard["job_id"], shard["shard_id"], worker_id):
+                print(f"Worker {worker_id}: shard {shard['job_id']}/{shard['shard_id']} gave up after {shard['attempts']} attempts")
+        idle_since = time.time()
+    for _, verify_func in envs.values():
+        if hasattr(verify_func, "close"):
+            verify_func.close()
+    queue.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded rollout worker")
+    parser.add_argument("--queue", type=str, required=True, help="Path of the shared shard queue (SQLite)")
+    parser.add_argument("--worker_id", type=str, default=f"{socket.gethostname()}-{os.getpid()}", help="Unique worker name")
+    parser.add_argument("--lease_ttl", type=float, default=120, help="Seconds a lease stays valid without renewal")
+    parser.add_argument("--poll_interval", type=float, default=2, help="Seconds between polls for new shards")
+    parser.add_argument("--idle_exit", type=float, default=None, help="Exit after this many idle seconds (default: run forever)")
+    parser.add_argument("--max_attempts", type=int, default=3, help="Mark a shard failed after this many failed attempts")
+
+    args = parser.parse_args()
+    asyncio.run(run_worker(args.queue, args.worker_id, args.lease_ttl, args.poll_interval, args.idle_exit, args.max_attempts))
@@ -1,11 +1,23 @@
 import argparse
 import asyncio
-import copy
 import json
 import os
 import random
 
 from training_free_grpo.main import rollout_dataset, load_rollouts
+from training_free_grpo.llm import AsyncLLM
+from training_free_grpo.cache import ResponseCache
+from training_free_grpo.concurrency import AdaptiveConcurrencyController
+from training_free_grpo.pipeline import StreamingExperiencePipeline
+from training_free_grpo.prompting import PromptBuilder
+from training_free_grpo.experience_index import ExperienceIndex
+from training_free_grpo.dataset_cache import ColumnarDataset
+from training_free_grpo.group_sampler import AdaptiveGroupSampler
+from training_free_grpo.rollout_store import RolloutStore
+from training_free_grpo.sharded import rollout_dataset_sharded
+from training_free_grpo.metrics import METRICS
+from training_free_grpo.experience_store import ExperienceStore
+from training_free_grpo.hedging import HedgePolicy
 from utu.agents import SimpleAgent
 from utu.config import ConfigLoader
 
@@ -16,15 +28,18 @@ async def main(args):
     # Set up domain-specific variables
     if args.domain == "math":
         from training_free_grpo.math.dataset import load_data
-        from training_free_grpo.math.verify import verify_func
-        from training_free_grpo.math.prompts import PROBLEM_WITH_EXPERIENCE_TEMPLATE
+        from training_free_grpo.math.verify import VerifierPool
+        from training_free_grpo.math.prompts import EXPERIENCE_PREFIX_TEMPLATE, PROBLEM_SUFFIX_TEMPLATE
         from training_free_grpo.math.experience import ExperienceUpdater
+        verify_func = VerifierPool()
         config_name = "simple/math_agent.yaml"
     elif args.domain == "web":
         from training_free_grpo.web.dataset import load_data
-        from training_free_grpo.web.verify import verify_func
-        from training_free_grpo.web.prompts import PROBLEM_WITH_EXPERIENCE_TEMPLATE
+        from training_free_grpo.web.verify import JudgeService
+        from training_free_grpo.web.prompts import EXPERIENCE_PREFIX_TEMPLATE, PROBLEM_SUFFIX_TEMPLATE
         from training_free_grpo.web.experience import ExperienceUpdater
+        # verdicts are shared across experiments: the same (problem, answer, response) always gets the same grade
+        verify_func = JudgeService(cache=ResponseCache("data/web/judge_cache.sqlite"))
         config_name = "simple/base_search.yaml"
     else:
         raise ValueError(f"Unsupported domain: {args.domain}")
@@ -44,6 +59,40 @@ async def main(args):
     else:
         raise ValueError(f"Unsupported inference mode: {args.mode}")
 
+    # Shared async client and concurrency budget for rollouts and experience updates
+    # (a controller with min == max keeps the concurrency fixed)
+    controller = AdaptiveConcurrencyController(
+        max_concurrency=args.rollout_concurrency,
+        min_concurrency=1 if args.adaptive_concurrency == "True" else args.rollout_concurrency,
+    )
+    llm = AsyncLLM(controller=controller)
+    prompt_builder = PromptBuilder(EXPERIENCE_PREFIX_TEMPLATE, PROBLEM_SUFFIX_TEMPLATE)
+    experience_index = None
+    if args.experience_top_k is not None:
+        # embeddings of all experience texts seen so far; each step only embeds the new/rewritten ones
+        experience_index = ExperienceIndex(os.path.join(experiment_dir, "experience_index"))
+
+    # Deterministic experience-extraction calls are cached per experiment, so a crashed step resumes
+    # without re-summarizing and identical trajectories are not re-summarized across epochs
+    llm_cache = ResponseCache(os.path.join(experiment_dir, "llm_cache.sqlite"), max_bytes=args.llm_cache_size_mb << 20)
+    updater_llm = AsyncLLM(controller=controller, cache=llm_cache)
+
+    # Rollouts of earlier steps, reused when a sample's prompt and sampling config did not change
+    rollout_store = None
+    if args.reuse_rollouts == "True":
+        rollout_store = RolloutStore(
+            os.path.join(experiment_dir, "rollout_store.sqlite"),
+            sampling_config={
+                "domain": args.domain,
+                "mode": args.mode,
+                "config": config_name,
+                "model": os.getenv("UTU_LLM_MODEL"),
+                "temperature": args.rollout_temperature,
+                "max_tokens": args.rollout_max_tokens,
+            },
+            off_policy_fraction=args.off_policy_fraction,
+        )
+
     # Load the dataset
     train_data = load_data(args.dataset)
     print(f"Loaded {len(train_data)} records from dataset")
@@ -52,6 +101,24 @@ async def main(args):
         train_data = train_data[: args.dataset_truncate]
     assert len(train_data) % args.batchsize == 0
 
+    # Versioned experience library (runs started before the store wrote one experiences.json per step)
+    experience_store = ExperienceStore(os.path.join(experiment_dir, "experiences.sqlite"))
+    legacy_steps = sorted(
+        int(name.split("_")[1])
+        for name in os.listdir(experiment_dir)
+        if name.startswith("step_") and os.path.exists(os.path.join(experiment_dir, name, "experiences.json"))
+    )
+    for legacy_step in legacy_steps:
+        if not experience_store.has(legacy_step):
+            experience_store.commit(
+                legacy_step, json.load(open(os.path.join(experiment_dir, f"step_{legacy_step}", "experiences.json")))
+            )
+
+    # Long-tail rollouts get a duplicate request; latencies are shared across steps, the budget is per step
+    hedge_policy = None
+    if args.hedge_requests == "True":
+        hedge_policy = HedgePolicy(percentile=args.hedge_percentile, budget=args.hedge_budget)
+
     # Set up the stats
     stats_filename = os.path.join(experiment_dir, "stats.json")
     if os.path.exists(stats_filename):
@@ -66,25 +133,29 @@ async def main(args):
         cur_epoch_dir = os.path.join(experiment_dir, f"epoch_{epoch}")
         os.makedirs(cur_epoch_dir, exist_ok=True)
 
-        # Check if shuffled data already exists for this epoch
-        shuffled_filename = os.path.join(cur_epoch_dir, "shuffled_data.jsonl")
-        if os.path.exists(shuffled_filename):
-            shuffled_data = []
-            with open(shuffled_filename) as f:
-                for line in f:
-                    shuffled_data.append(json.loads(line))
-            print(f"Loaded {len(shuffled_data)} records from shuffled data")
+        # Check if the shuffled order already exists for this epoch; only the index permutation is stored
+        # (runs started before the columnar cache stored the shuffled records themselves)
+        epoch_data = train_data
+        legacy_shuffled_filename = os.path.join(cur_epoch_dir, "shuffled_data.jsonl")
+        shuffled_filename = os.path.join(cur_epoch_dir, "shuffled_index.json")
+        if os.path.exists(legacy_shuffled_filename):
+            with open(legacy_shuffled_filename) as f:
+                epoch_data = ColumnarDataset.from_records(json.loads(line) for line in f)
+            shuffled_index = list(range(len(epoch_data)))
+            print(f"Loaded {len(epoch_data)} records from shuffled data")
+        elif os.path.exists(shuffled_filename):
+            shuffled_index = json.load(open(shuffled_filename))
+            print(f"Loaded shuffled order of {len(shuffled_index)} records")
         else:
             print(f"Shuffling data ...")
-            shuffled_data = copy.deepcopy(train_data)
-            random.shuffle(shuffled_data)
-            with open(shuffled_filename, "w") as f:
-                for each in shuffled_data:
-                    f.write(json.dumps(each) + "\n")
-
-        # for each batch
-        num_batches = len(shuffled_data) // args.batchsize
-        for batch_idx in range(num_batches):
+            # same order as shuffling the records themselves with the same random state
+            shuffled_index = list(range(len(train_data)))
+            random.shuffle(shuffled_index)
+            json.dump(shuffled_index, open(shuffled_filename, "w"))
+
+        # for each batch (materialized lazily from the memory-mapped dataset)
+        num_batches = len(shuffled_index) // args.batchsize
+        for batch_idx, batch_data in enumerate(epoch_data.iter_batches(args.batchsize, shuffled_index)):
             step = epoch * num_batches + batch_idx
             if f"step_{step}" not in stats:
                 stats[f"step_{step}"] = {"epoch": epoch, "batch": batch_idx, "complete": False}
@@ -93,73 +164,151 @@ async def main(args):
 
             # Init
             print(f"Step {step} (Epoch {epoch}, Batch {batch_idx})")
+            metrics_start = METRICS.snapshot()
+            cache_start = llm_cache.stats()
             cur_step_dir = os.path.join(experiment_dir, f"step_{step}")
             os.makedirs(cur_step_dir, exist_ok=True)
-            
-            # Get current batch data
-            batch_data = copy.deepcopy(shuffled_data[batch_idx * args.batchsize : (batch_idx + 1) * args.batchsize])
 
             # Load existing rollouts
             rollout_filename = os.path.join(cur_step_dir, "rollout.jsonl")
             rollouts = load_rollouts(rollout_filename)
             
             # Retrieve experiences for this batch (except first step)
-            if step > 0:
-                experience_filename = os.path.join("data", args.domain, "train", args.experiment_name, f"step_{step}/experiences.json")
-                experiences = json.load(open(experience_filename))
-            else:
-                experiences = {}
-            
-            # Format the batch data with experiences
-            formatted_experiences = "\n".join([ f"[{i}]. {e}" for i, e in experiences.items() ])
-            formatted_batch_data = [{
-                "prompt": PROBLEM_WITH_EXPERIENCE_TEMPLATE.format(
-                    experiences=formatted_experiences if formatted_experiences else "None",
-                    problem=each["problem"],
-                ) if experiences else each["problem"],
-                **each
-            } for each in batch_data]
+            experiences = experience_store.get(step) if step > 0 else {}
             
-            # Duplicate for GRPO
+            # Format the batch data with experiences (as a shared prompt prefix) and duplicate for GRPO
             print(f"GRPO rollout number={args.grpo_n}")
-            formatted_batch_data = formatted_batch_data * args.grpo_n
-
-            # Rollout the dataset
-            rollouts, rollout_stats = await rollout_dataset(
-                worker_agent=worker_agent,
-                data=formatted_batch_data,
-                rollouts=rollouts,
-                verify_func=verify_func,
-                rollout_filename=rollout_filename,
-                rollout_concurrency=args.rollout_concurrency,
-                task_timeout=args.task_timeout,
-                temperature=args.rollout_temperature,
-                max_tokens=args.rollout_max_tokens,
-            )
-            stats[f"step_{step}"]["rollout"] = rollout_stats
-
-            # Generate critiques and update experiences
-            next_step_dir = os.path.join(experiment_dir, f"step_{step+1}")
-            os.makedirs(next_step_dir, exist_ok=True)
-            next_experience_filename = os.path.join(next_step_dir, "experiences.json")
-            if os.path.exists(next_experience_filename):
-                print(f"Experiences already exist for step {step}, skipping experience update")
+            if experiences:
+                prompt_experiences = experiences
+                if experience_index is not None:
+                    prompt_experiences = await experience_index.select(
+                        [each["problem"] for each in batch_data], experiences, args.experience_top_k
+                    )
+                formatted_batch_data = prompt_builder.format_data(batch_data, prompt_experiences, num_repeats=args.grpo_n)
+                stats[f"step_{step}"]["prompt_prefix"] = prompt_builder.stats()
             else:
-                new_experiences = ExperienceUpdater().run(
-                    rollouts=rollouts, 
+                formatted_batch_data = [{"prompt": each["problem"], **each} for each in batch_data] * args.grpo_n
+
+            # Reuse stored rollouts of earlier steps
+            if rollout_store is not None:
+                if not rollouts:
+                    rollouts = [{"runid": i, **sample} for i, sample in enumerate(formatted_batch_data)]
+                stats[f"step_{step}"]["rollout_store"] = rollout_store.fill(rollouts, step)
+                print(f"Rollout reuse: {stats[f'step_{step}']['rollout_store']}")
+
+            # Stream finished problem groups into summary/critique while the rest of the batch rolls out
+            updater = ExperienceUpdater(llm=updater_llm, controller=controller, batch_shard_size=args.batch_update_shard_size)
+            pipeline = None
+            if args.streaming == "True" and not experience_store.has(step + 1):
+                pipeline = StreamingExperiencePipeline(
+                    updater,
+                    data=formatted_batch_data,
                     experiences=experiences,
                     save_dir=cur_step_dir,
                     max_workers=args.rollout_concurrency,
                     given_ground_truth=True if args.given_ground_truth=="True" else False,
                     only_partial_correct=True if args.grpo_n > 1 else False,
                 )
-                json.dump(new_experiences, open(next_experience_filename, "w"), indent=2)
-                print(f"Saved {len(new_experiences)} experiences to {next_experience_filename}")
+                for each in rollouts:
+                    if "trajectories" in each:
+                        await pipeline.on_sample_done(each)
+
+            # Groups that stay uniformly solved/failed are discarded by the updater; stop rolling them out early
+            group_sampler = None
+            if args.early_stop_groups == "True" and args.grpo_n > 1 and args.given_ground_truth == "True" and not args.shard_queue:
+                group_sampler = AdaptiveGroupSampler(
+                    confidence=args.early_stop_confidence,
+                    usd_per_million_tokens=args.usd_per_million_tokens,
+                )
+
+            # Rollout the dataset, locally or by the shard workers sharing the queue
+            if args.shard_queue:
+                rollouts, rollout_stats = await rollout_dataset_sharded(
+                    data=formatted_batch_data,
+                    rollouts=rollouts,
+                    rollout_filename=rollout_filename,
+                    queue_path=args.shard_queue,
+                    job_id=f"{args.experiment_name}/step_{step}",
+                    job_config={
+                        "domain": args.domain,
+                        "mode": args.mode,
+                        "config_name": config_name,
+                        "rollout_concurrency": args.rollout_concurrency,
+                        "task_timeout": args.task_timeout,
+                        "temperature": args.rollout_temperature,
+                        "max_tokens": args.rollout_max_tokens,
+                    },
+                    shard_size=args.shard_size,
+                    num_local_workers=args.local_shard_workers,
+                    on_sample_done=pipeline.on_sample_done if pipeline is not None else None,
+                )
+            else:
+                rollouts, rollout_stats = await rollout_dataset(
+                    worker_agent=worker_agent,
+                    data=formatted_batch_data,
+                    rollouts=rollouts,
+                    verify_func=verify_func,
+                    rollout_filename=rollout_filename,
+                    rollout_concurrency=args.rollout_concurrency,
+                    task_timeout=args.task_timeout,
+                    temperature=args.rollout_temperature,
+                    max_tokens=args.rollout_max_tokens,
+                    llm=llm,
+                    controller=controller,
+                    on_sample_done=pipeline.on_sample_done if pipeline is not None else None,
+                    group_sampler=group_sampler,
+                    hedge_policy=hedge_policy,
+                )
+            stats[f"step_{step}"]["rollout"] = rollout_stats
+            if rollout_store is not None:
+                rollout_store.add(rollouts, step)
 
-            # Save stats
+            # Generate critiques and update experiences
+            if experience_store.has(step + 1):
+                print(f"Experiences already exist for step {step}, skipping experience update")
+            else:
+                if pipeline is not None:
+                    new_experiences = await pipeline.finish(rollouts)
+                    stats[f"step_{step}"]["pipeline"] = pipeline.stats()
+                else:
+                    new_experiences = await updater.run(
+                        rollouts=rollouts, 
+                        experiences=experiences,
+                        save_dir=cur_step_dir,
+                        max_workers=args.rollout_concurrency,
+                        given_ground_truth=True if args.given_ground_truth=="True" else False,
+                        only_partial_correct=True if args.grpo_n > 1 else False,
+                    )
+                operations = experience_store.commit(step + 1, new_experiences, merges=updater.merges)
+                stats[f"step_{step}"]["experience_operations"] = {
+                    op: sum(each["op"] == op for each in operations) for op in ["add", "modify", "merge", "delete"]
+                }
+                print(f"Saved {len(new_experiences)} experiences ({len(operations)} operations) as step {step + 1}")
+                if experience_index is not None:
+                    stats[f"step_{step}"]["new_experience_embeddings"] = await experience_index.update(new_experiences)
+                # hits/misses of this step; cache_bytes is the size after it
+                cache_stats = llm_cache.stats()
+                stats[f"step_{step}"]["llm_cache"] = {
+                    "cache_hits": cache_stats["cache_hits"] - cache_start["cache_hits"],
+                    "cache_misses": cache_stats["cache_misses"] - cache_start["cache_misses"],
+                    "cache_bytes": cache_stats["cache_bytes"],
+                }
+
+            # Save stats, with LLM tokens/latency per stage of this step
+            stats[f"step_{step}"]["llm_metrics"] = METRICS.since(metrics_start)
             stats[f"step_{step}"]["complete"] = True
             json.dump(stats, open(stats_filename, "w"), indent=2)
+            METRICS.write_prometheus(os.path.join(experiment_dir, "metrics.prom"))
+
+    # Export the final library, e.g. for main.py --experience_file
+    final_step = experience_store.latest_step()
+    if final_step is not None:
+        final_experience_filename = os.path.join(experiment_dir, "experiences.json")
+        json.dump(experience_store.get(final_step), open(final_experience_filename, "w"), indent=2)
+        print(f"Saved the experiences of step {final_step} to {final_experience_filename}")
 
+    if hasattr(verify_func, "close"):
+        verify_func.close()
 
 
 if __name__ == "__main__":
@@ -174,8 +323,24 @@ if __name__ == "__main__":
     parser.add_argument("--batchsize", type=int, default=64, help="batchsize")
     parser.add_argument("--grpo_n", type=int, default=5, help="number of rollouts in a group of GRPO")
     parser.add_argument("--rollout_concurrency", type=int, default=5, help="Concurrency level for rollouts")
+    parser.add_argument("--adaptive_concurrency", type=str, default="True", help="Adapt concurrency below --rollout_concurrency on 429s/timeouts/latency (AIMD)")
     parser.add_argument("--rollout_temperature", type=float, default=0.7, help="Temperature for the LLM")
     parser.add_argument("--rollout_max_tokens", type=int, default=16384, help="Max tokens for each rollout batch")
+    parser.add_argument("--experience_top_k", type=int, default=None, help="Inject only the top-k most relevant experiences per problem (default: all)")
+    parser.add_argument("--early_stop_groups", type=str, default="False", help="Roll out GRPO groups in waves and stop groups that stay uniformly solved/failed")
+    parser.add_argument("--early_stop_confidence", type=float, default=0.8, help="Posterior probability of staying uniform required to stop a group")
+    parser.add_argument("--usd_per_million_tokens", type=float, default=0.0, help="Token price used to report the cost saved by early stopping")
+    parser.add_argument("--reuse_rollouts", type=str, default="False", help="Reuse rollouts of earlier steps whose prompt and sampling config are unchanged")
+    parser.add_argument("--off_policy_fraction", type=float, default=0.0, help="Max fraction of each group filled with stored rollouts made under other experiences")
+    parser.add_argument("--hedge_requests", type=str, default="False", help="Duplicate rollouts that run past the observed latency percentile; first completion wins")
+    parser.add_argument("--hedge_percentile", type=float, default=0.95, help="Latency percentile after which a rollout is hedged")
+    parser.add_argument("--hedge_budget", type=float, default=0.05, help="Max fraction of the rollouts of a step that may be hedged")
+    parser.add_argument("--shard_queue", type=str, default=None, help="Roll out through shard workers sharing this SQLite queue (python -m training_free_grpo.sharded)")
+    parser.add_argument("--shard_size", type=int, default=8, help="Number of samples per shard")
+    parser.add_argument("--local_shard_workers", type=int, default=0, help="Number of shard workers to start on this machine")
+    parser.add_argument("--batch_update_shard_size", type=int, default=40, help="Max experiences + suggested updates revised in one batch-update call")
+    parser.add_argument("--streaming", type=str, default="True", help="Overlap rollout, summary and critique per problem group")
+    parser.add_argument("--llm_cache_size_mb", type=int, default=1024, help="Size cap of the experience-extraction LLM cache")
     parser.add_argument("--task_timeout", type=float, default=3600, help="Timeout for each individual task in seconds")
 
     args = parser.parse_args()
@@ -1,10 +1,15 @@
 import os
 import json
 import pandas as pd
-from datasets import load_dataset
+from training_free_grpo.dataset_cache import ColumnarDataset, load_cached
 
 
-def load_data(dataset_name):
+def load_data(dataset_name) -> ColumnarDataset:
+    """ dataset_name: {dataset}_{sample_number}; memory-mapped from the Arrow cache in data/web/dataset """
+    return load_cached(os.path.join("data/web/dataset", f"{dataset_name}.arrow"), lambda: build_data(dataset_name))
+
+
+def build_data(dataset_name):
     """ dataset_name: {dataset}_{sample_number} """
     if dataset_name.startswith("AFM_web_RL"):
         data = load_AFM_web_RL()
@@ -27,6 +32,7 @@ def load_data(dataset_name):
 
 
 def load_AFM_web_RL(split="train"):
+    from datasets import load_dataset
     dataset = load_dataset("PersonalAILab/AFM-WebAgent-RL-Dataset", split=split)
     data = []
     for i, row in enumerate(dataset.to_list()):
@@ -58,6 +64,7 @@ def sampling_AFM_web_RL(data, n, random_seed=42):
 
 
 def load_WebWalkerQA(split="main"):
+    from datasets import load_dataset
     dataset = load_dataset("callanwu/WebWalkerQA", split=split)
     data = []
     for i, row in enumerate(dataset.to_list()):
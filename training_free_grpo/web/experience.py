@@ -1,12 +1,15 @@
+import asyncio
 import json
-import copy
 import os
 import re
 
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
-from training_free_grpo.llm import LLM
+from training_free_grpo.llm import AsyncLLM
+from training_free_grpo.concurrency import AdaptiveConcurrencyController
+from training_free_grpo.metrics import stage_slot
+from training_free_grpo.experience_store import assign_ids
+from training_free_grpo.revision_shards import shard_revision, cross_shard_clusters, revise_chain
 from training_free_grpo.web.prompts import (
     SINGLE_QUERY_CRITIQUE_TEMPLATE_SP,
     SINGLE_QUERY_CRITIQUE_TEMPLATE_UP,
@@ -20,29 +23,45 @@ from training_free_grpo.web.prompts import (
 
 
 class ExperienceUpdater:
-    def __init__(self):
-        self.llm = LLM()
+    def __init__(
+        self,
+        llm: AsyncLLM | None = None,
+        controller: AdaptiveConcurrencyController | None = None,
+        batch_shard_size: int = 40,
+    ):
+        self.llm = llm or AsyncLLM()
+        # optional concurrency budget shared with the rollout workers
+        self.controller = controller
+        # max experiences + proposed operations reconciled in one batch-update call
+        self.batch_shard_size = batch_shard_size
+        # new experience ID -> IDs it was merged from, of the last `run` (the web batch update does not merge)
+        self.merges = {}
+
+    def _slot(self, stage: str):
+        return stage_slot(stage, self.controller)
     
-    def run(self, rollouts, experiences, save_dir, max_workers=16, given_ground_truth=True):
+    async def run(self, rollouts, experiences, save_dir, max_workers=16, given_ground_truth=True, only_partial_correct=True):
         # 1. Summarize trajectory for each rollout
-        problem_to_summarized_rollouts = self._single_rollout_summary(
+        problem_to_summarized_rollouts = await self._single_rollout_summary(
             rollouts=rollouts, 
             save_dir=save_dir, 
             max_workers=max_workers,
-            given_ground_truth=given_ground_truth
+            given_ground_truth=given_ground_truth,
+            only_partial_correct=only_partial_correct
         )
 
         # 2. Generate critique for each query
-        new_experiences = self._single_query_critique(
+        new_experiences = await self._single_query_critique(
             problem_to_summarized_rollouts=problem_to_summarized_rollouts, 
             experiences=experiences,
             save_dir=save_dir, 
             max_workers=max_workers,
-            given_ground_truth=given_ground_truth
+            given_ground_truth=given_ground_truth,
+            only_partial_correct=only_partial_correct
         )
 
         # 3. group update experiences
-        critiques = self._group_update(
+        critiques = await self._group_update(
             experiences=experiences, 
             new_experiences=new_experiences, 
             save_dir=save_dir,
@@ -50,25 +69,153 @@ class ExperienceUpdater:
         )
 
         # 4. batch update experiences
-        new_experiences = self._batch_update(
+        new_experiences = await self._batch_update(
             experiences=experiences, 
             critiques=critiques, 
             save_dir=save_dir
         )
 
-        # 5. assign new experience IDs
-        new_experiences = {
-            f"G{i}": exp for i, exp in enumerate(new_experiences.values())
-        }
+        # 5. assign IDs to new experiences; kept ones keep theirs, so consecutive versions differ only by the update
+        new_experiences, self.merges = assign_ids(experiences, new_experiences)
         return new_experiences
 
 
-    def _single_rollout_summary(
+    async def process_group(self, rollouts_per_problem, experiences, given_ground_truth=True, only_partial_correct=True):
+        """Summarize, critique and group-update the finished rollouts of a single problem (streaming counterpart of steps 1-3)."""
+        rollouts_per_problem = [each for each in rollouts_per_problem if each.get("trajectories")]
+        if not rollouts_per_problem or not self._is_selected(rollouts_per_problem, given_ground_truth, only_partial_correct):
+            return {"summaries": [], "critique": None, "group_update": None}
+        summaries = await asyncio.gather(*[
+            self._summarize_rollout(cur, given_ground_truth) for cur in rollouts_per_problem
+        ])
+        summaries = [each for each in summaries if each is not None]
+        critique = group_update = None
+        if summaries and self._is_selected(summaries, given_ground_truth, only_partial_correct):
+            critique = await self._critique_problem(summaries, given_ground_truth=given_ground_truth)
+        if critique is not None:
+            group_update = await self._update_group(experiences, critique)
+        return {"summaries": summaries, "critique": critique, "group_update": group_update}
+
+    def save_group_results(self, group_results, save_dir):
+        """Write `process_group` outputs in the format of the step 1-3 stage files, so `run` resumes from them."""
+        summaries = defaultdict(list)
+        critiques = []
+        group_updates = []
+        for each in group_results:
+            for summary in each["summaries"]:
+                summaries[summary["problem"]].append(summary)
+            if each["critique"] is not None:
+                critiques.append(each["critique"])
+            if each["group_update"] is not None:
+                group_updates.append(each["group_update"])
+        with open(os.path.join(save_dir, "single_rollout_summary.json"), "w") as f:
+            json.dump(summaries, f, indent=2)
+        with open(os.path.join(save_dir, "single_query_critique.json"), "w") as f:
+            json.dump(critiques, f, indent=2)
+        with open(os.path.join(save_dir, "group_update.json"), "w") as f:
+            json.dump(group_updates, f, indent=2)
+
+    @staticmethod
+    def _is_selected(rollouts_per_problem, given_ground_truth=True, only_partial_correct=True):
+        if given_ground_truth and only_partial_correct:
+            # only for those partially correct
+            scores = [each["reward"] for each in rollouts_per_problem]
+            avg_score = sum(scores) / len(scores)
+            return avg_score > 0 and avg_score < 1
+        return True
+
+    async def _summarize_rollout(self, cur, given_ground_truth=True, max_retries=3):
+        for attempt in range(max_retries):
+            try:
+                up = SINGLE_ROLLOUT_SUMMARY_TEMPLATE_UP.format(
+                    task=cur["problem"],
+                    trajectory=cur["trajectories"][0]["trajectory"], 
+                    answer=cur["groundtruth"] if given_ground_truth else "[REDACTED]"
+                )
+                async with self._slot("summary"):
+                    response = await self.llm.chat(
+                        [
+                            {"role": "system", "content": SINGLE_ROLLOUT_SUMMARY_TEMPLATE_SP},
+                            {"role": "user", "content": up}
+                        ],
+                        # a cached empty reply would be replayed on every resume
+                        refresh_cache=attempt > 0,
+                    )
+                if not response:
+                    raise ValueError("empty summary")
+                return {"trajectory_summary": response, **cur}
+            except Exception as e:
+                print(f"Warning: failed in single rollout summary, {e}")
+        return None
+
+    async def _critique_problem(self, rollouts_per_problem, given_ground_truth=True, max_retries=3):
+        for attempt in range(max_retries):
+            try:
+                problem = rollouts_per_problem[0]["problem"]
+                answer = rollouts_per_problem[0]["groundtruth"]
+                formatted_trajectories = "\n\n".join([
+                    f"Attempt {i+1} (Answer {'correct' if each['reward'] else 'wrong'}):\n{each['trajectory_summary']}"
+                    for i, each in enumerate(rollouts_per_problem)
+                ])
+                up = SINGLE_QUERY_CRITIQUE_TEMPLATE_UP.format(
+                    question=problem,
+                    answer=answer if given_ground_truth else "[REDACTED]",
+                    attempts=formatted_trajectories,
+                )
+                async with self._slot("critique"):
+                    response = await self.llm.chat(
+                        [
+                            {"role": "system", "content": SINGLE_QUERY_CRITIQUE_TEMPLATE_SP},
+                            {"role": "user", "content": up}
+                        ],
+                        # a cached reply without the <Experiences> block would fail again
+                        refresh_cache=attempt > 0,
+                    )
+                # response = response.split("```json")[-1].split("```")[0]
+                # extract experiences from the response
+                pattern = re.compile(r"<Experiences>\s*(.*?)\s*</Experiences>",re.DOTALL | re.IGNORECASE)
+                match = pattern.search(response)
+                if match is None:
+                    raise ValueError("no <Experiences> block in the critique")
+                experiences = match.group(1).strip()
+                return {"rollouts": rollouts_per_problem, "critique": response, "experiences": experiences}
+            except Exception as e:
+                print(f"Warning: failed in single query critique, {e}")
+        return None
+
+    async def _update_group(self, experiences, new_experience, max_retries=3):
+        for attempt in range(max_retries):
+            try:
+                formatted_experiences = "\n".join([ f"[{i}]. {e}" for i, e in experiences.items() ]) if experiences else "None"
+                up = GROUP_EXPERIENCE_UPDATE_TEMPLATE_UP.format(
+                    existing_experiences=formatted_experiences,
+                    new_experiences=new_experience["experiences"],
+                )
+                async with self._slot("group_update"):
+                    response = await self.llm.chat(
+                        [
+                            {"role": "system", "content": GROUP_EXPERIENCE_UPDATE_TEMPLATE_SP},
+                            {"role": "user", "content": up}
+                        ],
+                        # a cached reply that failed to decode would fail again
+                        refresh_cache=attempt > 0,
+                    )
+                # parse response
+                response = response.split("```json")[-1].split("```")[0]
+                operations = json.loads(response)
+                return {"operations": operations, **new_experience}
+            except Exception as e:
+                print(f"Warning: failed in group update, {e}")
+        return None
+
+
+    async def _single_rollout_summary(
         self,
         rollouts, 
         save_dir, 
         max_workers,
-        given_ground_truth=True
+        given_ground_truth=True,
+        only_partial_correct=True
     ):
         # check file existence
         filename = os.path.join(save_dir, "single_rollout_summary.json")
@@ -89,43 +236,22 @@ class ExperienceUpdater:
 
         all_rollouts_to_process = []
         for rollouts in problems_to_rollouts.values():
-            if given_ground_truth:
-                # only for those partially correct
-                scores = [each["reward"] for each in rollouts]
-                avg_score = sum(scores) / len(scores)
-                if avg_score > 0 and avg_score < 1:
-                    all_rollouts_to_process.extend(rollouts)
-            else:
+            if self._is_selected(rollouts, given_ground_truth, only_partial_correct):
                 all_rollouts_to_process.extend(rollouts)
 
-        def process(cur):
-            try:
-                up = SINGLE_ROLLOUT_SUMMARY_TEMPLATE_UP.format(
-                    task=cur["problem"],
-                    trajectory=cur["trajectories"][0]["trajectory"], 
-                    answer=cur["groundtruth"] if given_ground_truth else "[REDACTED]"
-                )
-                response = self.llm.chat(
-                    [
-                        {"role": "system", "content": SINGLE_ROLLOUT_SUMMARY_TEMPLATE_SP},
-                        {"role": "user", "content": up}
-                    ]
-                )
-                return {"trajectory_summary": response, **cur}
-            except Exception as e:
-                print(f"Warning: failed in single query critique, {e}")
-                return None
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def process(cur):
+            async with semaphore:
+                return await self._summarize_rollout(cur, given_ground_truth)
 
         # parallel running
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_rollout = {executor.submit(process, cur): cur for cur in all_rollouts_to_process}
-            for future in tqdm(
-                as_completed(future_to_rollout), total=len(all_rollouts_to_process), desc="Single rollout summary"
-            ):
-                result = future.result()
-                if result is not None:
-                    problem = result["problem"]
-                    results[problem].append(result)
+        tasks = [process(cur) for cur in all_rollouts_to_process]
+        for future in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Single rollout summary"):
+            result = await future
+            if result is not None:
+                problem = result["problem"]
+                results[problem].append(result)
 
         # write to file
         with open(filename, "w") as f:
@@ -133,14 +259,15 @@ class ExperienceUpdater:
         return results
 
 
-    def _single_query_critique(
+    async def _single_query_critique(
         self,
         problem_to_summarized_rollouts, 
         experiences, 
         save_dir, 
         max_workers, 
         max_operations=1,
-        given_ground_truth=True
+        given_ground_truth=True,
+        only_partial_correct=True
     ):
         # check file existence
         filename = os.path.join(save_dir, "single_query_critique.json")
@@ -154,55 +281,22 @@ class ExperienceUpdater:
 
         all_rollouts = []
         for rollouts in problem_to_summarized_rollouts.values():
-            if given_ground_truth:
-                # only for those partially correct
-                scores = [each["reward"] for each in rollouts]
-                avg_score = sum(scores) / len(scores)
-                if avg_score > 0 and avg_score < 1:
-                    all_rollouts.append(rollouts)
-            else:
+            if self._is_selected(rollouts, given_ground_truth, only_partial_correct):
                 all_rollouts.append(rollouts)
 
-        def process(rollouts_per_problem):
-            try:
-                problem = rollouts_per_problem[0]["problem"]
-                answer = rollouts_per_problem[0]["groundtruth"]
-                formatted_trajectories = "\n\n".join([
-                    f"Attempt {i+1} (Answer {'correct' if each['reward'] else 'wrong'}):\n{each['trajectory_summary']}"
-                    for i, each in enumerate(rollouts_per_problem)
-                ])
-                up = SINGLE_QUERY_CRITIQUE_TEMPLATE_UP.format(
-                    question=problem,
-                    answer=answer if given_ground_truth else "[REDACTED]",
-                    attempts=formatted_trajectories,
-                )
-                response = self.llm.chat(
-                    [
-                        {"role": "system", "content": SINGLE_QUERY_CRITIQUE_TEMPLATE_SP},
-                        {"role": "user", "content": up}
-                    ]
-                )
-                # response = response.split("```json")[-1].split("```")[0]
-                # extract experiences from the response
-                pattern = re.compile(r"<Experiences>\s*(.*?)\s*</Experiences>",re.DOTALL | re.IGNORECASE)
-                match = pattern.search(response)
-                experiences = match.group(1).strip() if match else ""
-                return {"rollouts": rollouts_per_problem, "critique": response, "experiences": experiences}
-            except Exception as e:
-                print(f"Warning: failed in single query critique, {e}")
-                return None
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def process(rollouts_per_problem):
+            async with semaphore:
+                return await self._critique_problem(rollouts_per_problem, given_ground_truth=given_ground_truth)
 
         # parallel running
         results = []
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_case = {
-                executor.submit(process, rollouts_per_problem): rollouts_per_problem
-                for rollouts_per_problem in all_rollouts
-            }
-            for future in tqdm(as_completed(future_to_case), total=len(all_rollouts), desc="Single query critique"):
-                result = future.result()
-                if result is not None:
-                    results.append(result)
+        tasks = [process(rollouts_per_problem) for rollouts_per_problem in all_rollouts]
+        for future in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Single query critique"):
+            result = await future
+            if result is not None:
+                results.append(result)
 
         # write results
         with open(filename, "w") as f:
@@ -210,7 +304,7 @@ class ExperienceUpdater:
         return results
 
 
-    def _group_update(
+    async def _group_update(
         self,
         experiences, 
         new_experiences, 
@@ -227,38 +321,19 @@ class ExperienceUpdater:
                     print("- File exists, loaded from:", filename)
                     return results
         
-        def process(new_experience):
-            try:
-                formatted_experiences = "\n".join([ f"[{i}]. {e}" for i, e in experiences.items() ]) if experiences else "None"
-                up = GROUP_EXPERIENCE_UPDATE_TEMPLATE_UP.format(
-                    existing_experiences=formatted_experiences,
-                    new_experiences=new_experience["experiences"],
-                )
-                response = self.llm.chat(
-                    [
-                        {"role": "system", "content": GROUP_EXPERIENCE_UPDATE_TEMPLATE_SP},
-                        {"role": "user", "content": up}
-                    ]
-                )
-                # parse response
-                response = response.split("```json")[-1].split("```")[0]
-                operations = json.loads(response)
-                return {"operations": operations, **new_experience}
-            except Exception as e:
-                print(f"Warning: failed in group update, {e}")
-                return None
-        
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def process(new_experience):
+            async with semaphore:
+                return await self._update_group(experiences, new_experience)
+
         # parallel running
         results = []
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_case = {
-                executor.submit(process, new_experience): new_experience
-                for new_experience in new_experiences
-            }
-            for future in tqdm(as_completed(future_to_case), total=len(new_experiences), desc="Group update"):
-                result = future.result()
-                if result is not None:
-                    results.append(result)
+        tasks = [process(new_experience) for new_experience in new_experiences]
+        for future in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Group update"):
+            result = await future
+            if result is not None:
+                results.append(result)
         
         # write results
         with open(filename, "w") as f:
@@ -266,19 +341,47 @@ class ExperienceUpdater:
         return results
 
 
-    def _batch_update(
+    async def _revise(self, experiences, operations, max_retries=3):
+        """Consolidated ADD/UPDATE/DELETE decisions for one shard; UPDATE/DELETE outside the shard are dropped."""
+        response, revision_plan = None, []
+        for attempt in range(max_retries):
+            try:
+                up = BATCH_EXPERIENCE_UPDATE_TEMPLATE_UP.format(
+                    experiences_and_operations=self._format_exp_and_ops(experiences, operations)
+                )
+                async with self._slot("batch_update"):
+                    response = await self.llm.chat(
+                        [
+                            {"role": "system", "content": BATCH_EXPERIENCE_UPDATE_TEMPLATE_SP},
+                            {"role": "user", "content": up}
+                        ],
+                        # a cached reply that failed to decode would fail again
+                        refresh_cache=attempt > 0,
+                    )
+                revision_plan = json.loads(response.split("```json")[-1].split("```")[0])
+                break
+            except Exception:
+                print("Warning: failed to decode in updating general experiences")
+        revision_plan = [
+            plan for plan in revision_plan
+            if isinstance(plan, dict) and (plan.get("operation") != "DELETE" or plan.get("id") in experiences)
+        ]
+        return {"experience_ids": list(experiences), "response": response, "revision_plan": revision_plan}
+
+    async def _batch_update(
         self,
         experiences, 
         critiques, 
         save_dir,
         max_retries=3
     ):
+        """Hierarchical batch update: shard decisions resolved in parallel, then a merge pass over the new ADDs."""
         print("Batch update")
         filename = os.path.join(save_dir, "batch_update.json")
         if os.path.exists(filename):
             results = json.load(open(filename))
             print("- File exists, loaded from:", filename)
-            return results
+            return results["new_experiences"]
         
         # collect operations
         all_operations = []
@@ -286,32 +389,65 @@ class ExperienceUpdater:
             all_operations.extend(each["operations"])
         print("- Num of operations to process:", len(all_operations))
 
-        # use LLM to get the revision plan
-        revision_plan = []
-        for _ in range(max_retries):
-            try:
-                up = BATCH_EXPERIENCE_UPDATE_TEMPLATE_UP.format(
-                    experiences_and_operations=self._format_exp_and_ops(experiences, all_operations)
-                )
-                response = self.llm.chat(
-                    [
-                        {"role": "system", "content": BATCH_EXPERIENCE_UPDATE_TEMPLATE_SP},
-                        {"role": "user", "content": up}
-                    ]
-                )
-                revision_plan = json.loads(response.split("```json")[-1].split("```")[0])
-                break
-            except Exception:
-                print("Warning: failed to decode in updating general experiences")
+        # shard by target ID / similarity and get the decisions of all shards in parallel
+        shards = shard_revision(
+            experiences,
+            all_operations,
+            active_ids=set(),
+            target=lambda op: op.get("id"),
+            content=lambda op: op.get("content") or "",
+            max_shard_size=self.batch_shard_size,
+        )
+        print("- Num of shards:", sum(len(chain) for chain in shards))
+        shard_results = await asyncio.gather(*[
+            revise_chain(
+                chain,
+                lambda shard_experiences, shard_operations: self._revise(shard_experiences, shard_operations, max_retries),
+                lambda result: {
+                    plan["id"]: plan.get("content") if plan.get("operation") == "UPDATE" else None
+                    for plan in result["revision_plan"]
+                    # as applied below: an UPDATE needs content, a DELETE only the ID
+                    if plan.get("id") is not None
+                    and (plan.get("operation") == "DELETE" or plan.get("operation") == "UPDATE" and plan.get("content"))
+                },
+            )
+            for chain in shards
+        ])
+
+        # merge pass: similar ADDs decided in different shards could not see each other
+        adds = [
+            (i, None, plan["content"])
+            for i, result in enumerate(shard_results)
+            for plan in result["revision_plan"]
+            if plan.get("operation", "ADD") == "ADD" and plan.get("content")
+        ]
+        clusters = cross_shard_clusters(adds) if len(shards) > 1 else []
+        merge_results = await asyncio.gather(*[
+            self._revise({}, [{"operation": "ADD", "id": None, "content": adds[j][2]} for j in cluster], max_retries)
+            for cluster in clusters
+        ])
+        # a failed merge call keeps the shard ADDs of its cluster
+        merged_away = {
+            adds[j][2] for cluster, result in zip(clusters, merge_results) if result["revision_plan"] for j in cluster
+        }
+        revision_plan = [
+            plan for result in shard_results for plan in result["revision_plan"]
+            if not (plan.get("operation", "ADD") == "ADD" and plan.get("content") in merged_away)
+        ]
+        revision_plan.extend(
+            plan for result in merge_results for plan in result["revision_plan"] if plan.get("operation", "ADD") == "ADD"
+        )
 
         # apply revision plan to get new experiences
         max_ID = len(experiences)
-        new_experiences = copy.deepcopy(experiences)
+        # experiences are strings: a shallow copy is enough
+        new_experiences = dict(experiences)
         for plan in revision_plan:
             operation = plan.get("operation", "ADD")
             content = plan.get("content", "")
             target_id = plan.get("id", None)
-            if not content:
+            # a DELETE needs no content
+            if not content and operation != "DELETE":
                 continue
 
             if operation == "ADD":
@@ -334,8 +470,8 @@ class ExperienceUpdater:
             json.dump(
                 {
                     "operations": all_operations,
-                    "response": response,
-                    "revision_plan": revision_plan,
+                    "shards": shard_results,
+                    "merge_pass": merge_results,
                     "new_experiences": new_experiences,
                 },
                 f,
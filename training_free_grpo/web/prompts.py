@@ -13,6 +13,23 @@ PROBLEM_WITH_EXPERIENCE_TEMPLATE = """**Task:** Solve the input problem by lever
 **CURRENT PROBLEM:**
 {problem}"""
 
+# Same content as PROBLEM_WITH_EXPERIENCE_TEMPLATE, split into a prefix shared by the whole batch and a per-problem
+# suffix, see training_free_grpo.prompting.PromptBuilder
+EXPERIENCE_PREFIX_TEMPLATE = """**Task:** Solve the input problem by leveraging relevant insights from your accumulated experiences
+
+**Instructions:**  
+1. **Understand the Problem:** Carefully analyze the **CURRENT PROBLEM** to identify key aspects that require resolution.  
+2. **Review Relevant Experiences:** Examine the **ACCUMULATED EXPERIENCES** and determine which insights, strategies, or patterns apply to the current problem.  
+3. **Apply Insights Thoughtfully:**  
+- If an experience matches the problem context, explicitly incorporate it into your reasoning.  
+- If no direct match exists, consider whether any generalized principles can still guide your approach.
+
+**ACCUMULATED EXPERIENCES:**
+{experiences}"""
+
+PROBLEM_SUFFIX_TEMPLATE = """**CURRENT PROBLEM:**
+{problem}"""
+
 SINGLE_ROLLOUT_SUMMARY_TEMPLATE_SP = """You are an AI assistant specialized in analyzing web agent trajectories. 
 Your task is to summarize the provided trajectory data by extracting **detailed, task-relevant information** from each step, including the agent's actions, tool usage, reasoning, outcomes, and—critically—**all information returned by tools that may be relevant to the task**, even if the agent did not explicitly use it.
 
@@ -409,4 +426,31 @@ Grade the student answers based ONLY on their factual accuracy. Ignore differenc
 
 QUESTION: {problem}
 CONTEXT: {answer}
-STUDENT ANSWER: {response}"""
\ No newline at end of file
+STUDENT ANSWER: {response}"""
+
+WEB_BATCH_JUDGE_TEMPLATE = """You are a teacher grading a quiz.
+You are given several graded items. Each item has a question, the context the question is about, and the student's answer. For every item, score the student's answer as either CORRECT or INCORRECT, based on its context.
+Write out in a step by step manner your reasoning to be sure that your conclusion is correct. Avoid simply stating the correct answer at the outset.
+
+Grade the student answers based ONLY on their factual accuracy. Ignore differences in punctuation and phrasing between the student answer and true answer. It is OK if the student answer contains more information than the true answer, as long as it does not contain any conflicting statements. Grade every item independently of the others.
+
+Output one entry per item in the following JSON format:
+```json
+[
+  {{
+    "id": 1,
+    "explanation": "step by step reasoning here",
+    "grade": "CORRECT or INCORRECT"
+  }}
+]
+```
+
+Begin!
+
+{items}"""
+
+WEB_BATCH_JUDGE_ITEM_TEMPLATE = """ITEM {id}
+QUESTION: {problem}
+CONTEXT: {answer}
+STUDENT ANSWER: {response}
+"""
@@ -1,11 +1,27 @@
+import asyncio
+import json
 import re
-from training_free_grpo.llm import LLM
-from training_free_grpo.web.prompts import WEB_JUDGE_TEMPLATE
+from training_free_grpo.llm import LLM, AsyncLLM
+from training_free_grpo.cache import ResponseCache
+from training_free_grpo.metrics import stage
+from training_free_grpo.web.prompts import WEB_JUDGE_TEMPLATE, WEB_BATCH_JUDGE_TEMPLATE, WEB_BATCH_JUDGE_ITEM_TEMPLATE
 
 
 llm = LLM()
 
 
+def parse_grade(response: str) -> bool:
+    """Parse the EXPLANATION/GRADE reply of `WEB_JUDGE_TEMPLATE`."""
+    pattern = re.compile(
+        r"(?=.*?EXPLANATION:\s*(?P<reasoning>.*?)(?=\n\s*\w+:|$))?"
+        r"(?=.*?GRADE:\s*(?P<correct>.*?)(?=\n\s*\w+:|$))?",
+        re.DOTALL,
+    )
+    response = response.replace("**", "")
+    match = pattern.search(response)
+    return match.group("correct").strip().upper() == "CORRECT" if match.group("correct") else False
+
+
 def verify_func(sample: dict, ground_truth: str, timeout_score: float = 0) -> float:
     """ judge the response is correct or not based on LLM """
     try:
@@ -18,17 +34,160 @@ def verify_func(sample: dict, ground_truth: str, timeout_score: float = 0) -> fl
             )
         )
         # parse the response
-        pattern = re.compile(
-            r"(?=.*?EXPLANATION:\s*(?P<reasoning>.*?)(?=\n\s*\w+:|$))?"
-            r"(?=.*?GRADE:\s*(?P<correct>.*?)(?=\n\s*\w+:|$))?",
-            re.DOTALL,
-        )
-        response = response.replace("**", "")
-        match = pattern.search(response)
-        reasoning = match.group("reasoning").strip() if match.group("reasoning") else ""
-        correct = match.group("correct").strip().upper() == "CORRECT" if match.group("correct") else False
+        correct = parse_grade(response)
         return float(correct)
     
     except Exception as e:
         print(f"Warning: failed in verifying response, {e}")
-        return 0.0
\ No newline at end of file
+        return 0.0
+
+
+class JudgeService:
+    """Async, batched and cached LLM judge; drop-in for `verify_func` (`await judge(sample, ground_truth)`).
+
+    Identical (problem, ground truth, response) triples, e.g. Pass@k duplicates, are judged once: concurrent
+    requests share one pending verdict and finished verdicts are kept in `cache` on disk. Requests arriving within
+    `batch_wait` seconds are graded together in one `WEB_BATCH_JUDGE_TEMPLATE` call (up to `batch_size`); items
+    missing from the JSON reply fall back to the single-item judge prompt. Judge calls deliberately do not take
+    rollout controller slots: they are awaited by rollout tasks that already hold one.
+    """
+
+    def __init__(
+        self,
+        llm: AsyncLLM | None = None,
+        cache: ResponseCache | None = None,
+        batch_size: int = 8,
+        batch_wait: float = 0.05,
+        max_retries: int = 3,
+    ):
+        self.llm = llm or AsyncLLM()
+        self.cache = cache
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_retries = max_retries
+
+        self._verdicts = {}
+        self._inflight = {}
+        self._pending = []
+        self._flush_handle = None
+        self._tasks = set()
+        self.num_requests = 0
+        self.num_deduped = 0
+        self.num_cache_hits = 0
+        self.num_judge_calls = 0
+        self.num_fallbacks = 0
+
+    def _key(self, problem: str, ground_truth: str, response: str) -> str:
+        return ResponseCache.make_key(
+            model=self.llm.model_name,
+            prompt=WEB_BATCH_JUDGE_TEMPLATE,
+            problem=problem,
+            answer=ground_truth,
+            response=response,
+        )
+
+    async def __call__(self, sample: dict, ground_truth: str, timeout_score: float = 0) -> float:
+        self.num_requests += 1
+        item = (sample["problem"], str(ground_truth), str(sample["response"]))
+        key = self._key(*item)
+        if key in self._verdicts:
+            self.num_deduped += 1
+            return self._verdicts[key]
+        if key in self._inflight:
+            self.num_deduped += 1
+            return await asyncio.shield(self._inflight[key])
+        if self.cache is not None:
+            verdict = self.cache.get(key)
+            if verdict is not None:
+                self.num_cache_hits += 1
+                self._verdicts[key] = verdict
+                return verdict
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._inflight[key] = future
+        self._pending.append((key, item, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_wait, self._flush)
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            # the batch task copies the current context: attribute its calls to the judge, not to the caller's stage
+            with stage("judge"):
+                task = asyncio.ensure_future(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: list[tuple]):
+        try:
+            grades = await self._judge_batch([item for _, item, _ in batch]) if len(batch) > 1 else {}
+            for i, (key, item, future) in enumerate(batch):
+                if i + 1 in grades:
+                    verdict = float(grades[i + 1])
+                else:
+                    self.num_fallbacks += len(batch) > 1
+                    verdict = await self._judge_one(item)
+                if verdict is not None:
+                    self._verdicts[key] = verdict
+                    if self.cache is not None:
+                        self.cache.put(key, verdict)
+                future.set_result(verdict if verdict is not None else 0.0)
+        except Exception as e:
+            print(f"Warning: failed in verifying response, {e}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_result(0.0)
+        finally:
+            for key, _, future in batch:
+                self._inflight.pop(key, None)
+                # e.g. the batch task was cancelled: fail the waiting callers instead of leaving them hanging
+                if not future.done():
+                    future.set_exception(RuntimeError("judge batch was cancelled"))
+
+    async def _judge_batch(self, items: list[tuple]) -> dict[int, bool]:
+        prompt = WEB_BATCH_JUDGE_TEMPLATE.format(
+            items="\n".join(
+                WEB_BATCH_JUDGE_ITEM_TEMPLATE.format(id=i + 1, problem=problem, answer=answer, response=response)
+                for i, (problem, answer, response) in enumerate(items)
+            )
+        )
+        for attempt in range(self.max_retries):
+            try:
+                self.num_judge_calls += 1
+                response = await self.llm.chat(prompt, temperature=0, refresh_cache=attempt > 0)
+                results = json.loads(response.split("```json")[-1].split("```")[0])
+                return {
+                    int(each["id"]): str(each["grade"]).strip().upper() == "CORRECT"
+                    for each in results
+                    if isinstance(each, dict) and "id" in each and "grade" in each
+                }
+            except Exception:
+                print("Warning: failed to decode batched judge response")
+        return {}
+
+    async def _judge_one(self, item: tuple) -> float | None:
+        """Single-item judge with `WEB_JUDGE_TEMPLATE`; None if the judge could not be reached."""
+        problem, answer, response = item
+        self.num_judge_calls += 1
+        try:
+            reply = await self.llm.chat(WEB_JUDGE_TEMPLATE.format(problem=problem, answer=answer, response=response))
+        except Exception as e:
+            print(f"Warning: failed in verifying response, {e}")
+            return None
+        return float(parse_grade(reply))
+
+    def stats(self) -> dict:
+        return {
+            "judge_requests": self.num_requests,
+            "judge_deduped": self.num_deduped,
+            "judge_cache_hits": self.num_cache_hits,
+            "judge_calls": self.num_judge_calls,
+            "judge_fallbacks": self.num_fallbacks,
+        }